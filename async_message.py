@@ -0,0 +1,350 @@
+"""
+asyncio transport for the message wire format.
+AsyncServerMessage and AsyncClientMessage are the async equivalents of
+ServerMessage and ClientMessage, built on asyncio.BufferedProtocol so data is
+received straight into a RecvBuffer.
+"""
+import asyncio
+import contextvars
+import inspect
+
+from header_codec import JSON_HEADER, create_header, decode_header, encode_header
+from log import get_logger
+from message import HIGH_WATERMARK, LOW_WATERMARK, MAX_SEND_QUEUE, SLOW_PEER_TIMEOUT
+from recv_buffer import RecvBuffer
+from serializers import JSON_CONTENT_TYPE, decode, encode
+from server_message import response_content_type
+
+logger = get_logger(__name__)
+
+# the AsyncServerMessage whose request is being handled, for handlers that push messages
+current_connection = contextvars.ContextVar('current_connection')
+
+
+class MessageProtocol(asyncio.BufferedProtocol):
+    """
+    frames and unframes messages, subclasses implement message_received
+    """
+    def __init__(self, header_format=JSON_HEADER):
+        """
+        constructor for the MessageProtocol class
+        """
+        self._transport = None
+        self._ipaddr = None
+        self._recv_buffer = RecvBuffer()
+        self._header = None
+        self._header_format = header_format
+        self._closed = asyncio.get_running_loop().create_future()
+        self._can_write = asyncio.Event()
+        self._can_write.set()
+
+    def connection_made(self, transport):
+        self._transport = transport
+        self._ipaddr = transport.get_extra_info('peername')
+        transport.set_write_buffer_limits(HIGH_WATERMARK, LOW_WATERMARK)
+
+    def connection_lost(self, exc):
+        self._can_write.set()
+        if not self._closed.done():
+            self._closed.set_result(exc)
+
+    def pause_writing(self):
+        self._can_write.clear()
+
+    def resume_writing(self):
+        self._can_write.set()
+
+    def get_buffer(self, sizehint):
+        return self._recv_buffer.get_buffer(sizehint)
+
+    def buffer_updated(self, nbytes):
+        """
+        parses all complete messages from the receive buffer
+        :param nbytes: number of bytes received
+        :return: None
+        """
+        self._recv_buffer.advance(nbytes)
+        try:
+            while True:
+                if self._header is None:
+                    decoded = decode_header(self._recv_buffer)
+                    if decoded is None:
+                        return
+                    self._header_format, self._header = decoded
+                content_len = self._header['content-length']
+                if len(self._recv_buffer) < content_len:
+                    return
+                header = self._header
+                with self._recv_buffer.peek(content_len) as data:
+                    content = decode(
+                        data, header['content-type'], header['content-encoding']
+                    )
+                self._recv_buffer.consume(content_len)
+                self._header = None
+                self.message_received(header, content)
+        except ValueError:
+            logger.exception('Error: invalid message from %s', self._ipaddr)
+            self._count_error()
+            self.close()
+
+    def _count_error(self):
+        """
+        called for every failed message, counted by servers
+        :return: None
+        """
+
+    def message_received(self, header, content):
+        """
+        dummy implementation must be implemented in the child class
+        :param header: dict with the header fields
+        :param content: the decoded content
+        :return:
+        """
+        raise NotImplementedError
+
+    def send(self, content, content_type, content_encoding, request_id=None, keep_alive=False):
+        """
+        frames and writes a message
+        :return: False if the peer is falling behind and the producer should wait for drain()
+        """
+        if self._transport.get_write_buffer_size() > MAX_SEND_QUEUE:
+            raise RuntimeError(
+                f'Send queue of {self._transport.get_write_buffer_size()} bytes is full: '
+                'peer is too slow.'
+            )
+        content_bytes = encode(content, content_type, content_encoding)
+        header = create_header(
+            len(content_bytes),
+            content_type,
+            content_encoding,
+            request_id=request_id,
+            keep_alive=keep_alive
+        )
+        self._transport.writelines(
+            (encode_header(header, self._header_format), content_bytes)
+        )
+        return self._can_write.is_set()
+
+    async def drain(self):
+        """
+        waits until the transport's write buffer is below its low watermark,
+        closes slow peers that don't get there within SLOW_PEER_TIMEOUT
+        """
+        if self._can_write.is_set():
+            return
+        try:
+            await asyncio.wait_for(self._can_write.wait(), SLOW_PEER_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning(
+                'Connection to %s is too slow, closing it after %ss',
+                self._ipaddr, SLOW_PEER_TIMEOUT
+            )
+            self.close()
+            raise ConnectionError('Peer is too slow.')
+
+    def close(self):
+        """
+        closes the connection
+        """
+        if self._transport is not None and not self._transport.is_closing():
+            self._transport.close()
+
+    async def wait_closed(self):
+        await asyncio.shield(self._closed)
+
+    @property
+    def ipaddr(self):
+        return self._ipaddr
+
+    @property
+    def header_format(self):
+        return self._header_format
+
+    @property
+    def send_queue_size(self):
+        return 0 if self._transport is None else self._transport.get_write_buffer_size()
+
+    @property
+    def closed(self):
+        return self._transport is None or self._transport.is_closing()
+
+
+class AsyncServerMessage(MessageProtocol):
+    """
+    Serves the requests of one connection in order with a handler
+    that takes the request and returns the response, or a coroutine for it.
+    One-shot connections are closed after their response as with ServerMessage.
+    """
+    def __init__(self, handler, deadline=None, idle_timeout=None, stats=None):
+        """
+        constructor for the AsyncServerMessage class
+        :param handler: callable(request) -> response or awaitable response
+        :param deadline: seconds a handler may take before the request fails
+        :param idle_timeout: seconds a connection may wait for its next request
+        :param stats: optional counters with connected(connection) and errors
+        """
+        super().__init__()
+        self._handler = handler
+        self._deadline = deadline
+        self._idle_timeout = idle_timeout
+        self._stats = stats
+        self._requests = asyncio.Queue()
+        self._request_header = None
+        self._task = None
+
+    def connection_made(self, transport):
+        super().connection_made(transport)
+        logger.debug('Accepted connection from %s', self._ipaddr)
+        if self._stats is not None:
+            self._stats.connected(self)
+        context = contextvars.copy_context()
+        context.run(current_connection.set, self)
+        self._task = asyncio.get_running_loop().create_task(self._serve(), context=context)
+
+    def connection_lost(self, exc):
+        super().connection_lost(exc)
+        if self._task is not None:
+            self._task.cancel()
+
+    def message_received(self, header, content):
+        self._requests.put_nowait((header, content))
+
+    async def _serve(self):
+        """
+        answers the requests of this connection one after another
+        """
+        try:
+            while True:
+                header, request = await asyncio.wait_for(
+                    self._requests.get(), self._idle_timeout
+                )
+                self._request_header = header
+                response = await self._handle(request)
+                content_type, content_encoding = response_content_type(
+                    header['content-type'], response
+                )
+                keep_alive = header.get('keep-alive', False)
+                self.send(
+                    response,
+                    content_type,
+                    content_encoding,
+                    request_id=header.get('request-id'),
+                    keep_alive=keep_alive
+                )
+                self._request_header = None
+                await self.drain()
+                if not keep_alive:
+                    break
+        except asyncio.TimeoutError:
+            logger.info('Connection to %s idle for %ss', self._ipaddr, self._idle_timeout)
+        except asyncio.CancelledError:
+            pass
+        except Exception:
+            logger.exception('Main: Error: Exception for %s', self._ipaddr)
+            self._count_error()
+        self.close()
+
+    def _count_error(self):
+        if self._stats is not None:
+            self._stats.errors += 1
+
+    @property
+    def request_header(self):
+        return self._request_header
+
+    async def _handle(self, request):
+        """
+        calls the handler, enforcing the deadline
+        :param request: the decoded request
+        :return: the response
+        """
+        response = self._handler(request)
+        if inspect.isawaitable(response):
+            try:
+                response = await asyncio.wait_for(response, self._deadline)
+            except asyncio.TimeoutError:
+                response = 'DEADLINE EXCEEDED'
+        return response
+
+
+class AsyncClientMessage(MessageProtocol):
+    """
+    Client side of a keep-alive connection. Requests may be issued
+    concurrently, responses are matched to them by their request id.
+    """
+    def __init__(self, header_format=JSON_HEADER):
+        """
+        constructor for the AsyncClientMessage class
+        """
+        super().__init__(header_format)
+        self._next_request_id = 1
+        self._pending = {}
+
+    @classmethod
+    async def connect(cls, host, port, header_format=JSON_HEADER):
+        """
+        opens a connection
+        :return: AsyncClientMessage
+        """
+        loop = asyncio.get_running_loop()
+        _, protocol = await loop.create_connection(
+            lambda: cls(header_format), host, port
+        )
+        return protocol
+
+    def connection_lost(self, exc):
+        super().connection_lost(exc)
+        for future in self._pending.values():
+            if not future.done():
+                future.set_exception(ConnectionError('Peer closed.'))
+        self._pending.clear()
+
+    def message_received(self, header, content):
+        future = self._pending.pop(header.get('request-id'), None)
+        if future is not None and not future.done():
+            future.set_result(content)
+
+    async def request(self, content, content_type=JSON_CONTENT_TYPE,
+                      content_encoding='utf-8', timeout=None):
+        """
+        sends a request and waits for its response
+        :param content: the request content
+        :param timeout: seconds to wait for the response, None waits forever
+        :return: the response content
+        """
+        if self._transport is None or self._transport.is_closing():
+            raise ConnectionError('Connection is closed.')
+        request_id = self._next_request_id
+        self._next_request_id += 1
+        future = asyncio.get_running_loop().create_future()
+        self._pending[request_id] = future
+        self.send(
+            content,
+            content_type,
+            content_encoding,
+            request_id=request_id,
+            keep_alive=True
+        )
+        try:
+            await self.drain()
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            self._pending.pop(request_id, None)
+
+
+async def start_server(handler, host, port, deadline=None, idle_timeout=None,
+                       reuse_port=False, stats=None):
+    """
+    starts an asyncio server answering requests with handler
+    :param stats: optional counters of the connections and errors, see AsyncServerMessage
+    :return: asyncio.Server
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.create_server(
+        lambda: AsyncServerMessage(handler, deadline, idle_timeout, stats),
+        host,
+        port,
+        reuse_address=True,
+        reuse_port=reuse_port,
+        backlog=1024
+    )
@@ -0,0 +1 @@
+""" Benchmarks for the kittenbot networking and game code. Run from the repository root. """
@@ -0,0 +1,101 @@
+"""
+Runs the benchmark suite, writes the results as JSON and compares them with a baseline.
+Times are compared relative to a fixed calibration loop run next to every repeat of a
+case, so the speed of the machine at that moment is divided out, but a change of the
+code is not. A case that got slower than the baseline by more than its tolerance is
+a regression, the run then exits with status 1. suite.TOLERANCES allows the noisier
+cases more.
+Every case is the median of several runs of the suite, the baseline is stored the same way.
+Usage: python -m benchmarks [--output results.json] [--save-baseline] [--runs 5]
+                            [--tolerance 0.3] [case ...]
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+
+from benchmarks import suite
+
+BASELINE = os.path.join(os.path.dirname(__file__), 'baseline.json')
+TOLERANCE = 0.3
+# runs of the suite, the median of a case is not moved by a slow phase of the machine
+# or an unlucky heap layout in a few of them
+RUNS = 5
+
+
+def compare(results, relative, baseline, tolerance):
+    """
+    prints every case next to its baseline
+    :param results: dict name -> seconds per operation
+    :param relative: dict name -> seconds per operation relative to the calibration loop
+    :param baseline: the stored baseline, with its 'results' and 'relative' dicts
+    :param tolerance: allowed slowdown, 0.25 is 25%, suite.TOLERANCES overrides it per case
+    :return: list of the names of the regressed cases
+    """
+    regressions = []
+    print(f'{"case":<36}{"us/op":>12}{"baseline":>12}{"change":>9}')
+    for name, seconds in results.items():
+        reference = baseline['relative'].get(name)
+        if reference is None:
+            print(f'{name:<36}{seconds * 1e6:>12.3f}{"-":>12}{"new":>9}')
+            continue
+        change = relative[name] / reference - 1
+        flag = ''
+        if change > suite.tolerance(name, tolerance):
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print(f'{name:<36}{seconds * 1e6:>12.3f}{baseline["results"][name] * 1e6:>12.3f}'
+              f'{change:>+9.1%}{flag}')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark suite of the kittenbot code')
+    parser.add_argument('cases', nargs='*', help='run only the cases containing one of these')
+    parser.add_argument('--output', metavar='PATH', help='write the results to this JSON file')
+    parser.add_argument('--baseline', metavar='PATH', default=BASELINE,
+                        help='baseline to compare with')
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='store the results as the new baseline instead of comparing')
+    parser.add_argument('--runs', type=int, default=RUNS,
+                        help='run the suite this many times and keep the median time of each case')
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE,
+                        help='allowed slowdown before a case fails, 0.25 is 25%%, '
+                             'some cases allow more, see suite.TOLERANCES')
+    args = parser.parse_args()
+
+    runs = []
+    for _ in range(args.runs):
+        results, relative, skipped = suite.run(args.cases)
+        runs.append((results, relative))
+    names = runs[0][0]
+    results = {name: statistics.median(run[name] for run, _ in runs) for name in names}
+    relative = {name: statistics.median(run[name] for _, run in runs) for name in names}
+    for name, reason in skipped.items():
+        print(f'{name}: skipped, {reason}')
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(suite.dumps(results, relative, skipped))
+    if args.save_baseline:
+        with open(args.baseline, 'w') as file:
+            file.write(suite.dumps(results, relative, skipped))
+        print(f'Saved the baseline to {args.baseline}')
+        return 0
+
+    try:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+    except FileNotFoundError:
+        baseline = {'results': {}, 'relative': {}}
+        print(f'No baseline at {args.baseline}, run with --save-baseline to create one')
+    regressions = compare(results, relative, baseline, args.tolerance)
+    if regressions:
+        print(f'{len(regressions)} cases regressed by more than their tolerance: '
+              f'{", ".join(regressions)}', file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
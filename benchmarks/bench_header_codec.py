@@ -0,0 +1,34 @@
+"""
+Compares encoding and decoding of the JSON header and the binary header.
+Usage: python -m benchmarks.bench_header_codec
+"""
+import timeit
+
+from header_codec import BINARY_HEADER, JSON_HEADER, create_header, decode_header, encode_header
+from recv_buffer import RecvBuffer
+
+
+def main():
+    header = create_header(42, 'text/json', 'utf-8', request_id=7, keep_alive=True)
+    number = 100000
+    for header_format in (JSON_HEADER, BINARY_HEADER):
+        encoded = encode_header(header, header_format)
+        buffer = RecvBuffer()
+
+        def decode():
+            buffer.extend(encoded)
+            decode_header(buffer)
+
+        encode_time = min(timeit.repeat(
+            lambda: encode_header(header, header_format), number=number, repeat=3
+        ))
+        decode_time = min(timeit.repeat(decode, number=number, repeat=3))
+        print(
+            f'{header_format:<8} {len(encoded):4d} bytes  '
+            f'encode {encode_time / number * 1e6:6.2f} us  '
+            f'decode {decode_time / number * 1e6:6.2f} us'
+        )
+
+
+if __name__ == '__main__':
+    main()
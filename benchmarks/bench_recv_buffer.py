@@ -0,0 +1,101 @@
+"""
+Compares the bytes-concatenating receive path with RecvBuffer.
+Usage: python -m benchmarks.bench_recv_buffer
+"""
+import time
+
+from message import Message
+from recv_buffer import RecvBuffer
+
+
+class FakeSocket:
+    """
+    replays a message in fixed-size fragments
+    """
+    def __init__(self, payload, fragment):
+        self._payload = memoryview(payload)
+        self._fragment = fragment
+        self._pos = 0
+
+    def recv(self, size):
+        size = min(size, self._fragment)
+        data = bytes(self._payload[self._pos:self._pos + size])
+        self._pos += len(data)
+        return data
+
+    def recv_into(self, view, size):
+        size = min(size, self._fragment, len(self._payload) - self._pos)
+        view[:size] = self._payload[self._pos:self._pos + size]
+        self._pos += size
+        return size
+
+
+def make_frame(size):
+    """
+    builds a framed binary message with a body of size bytes
+    :param size: body length
+    :return: bytes
+    """
+    message = Message(None, None, None)
+    return message._create_message(
+        content_bytes=b'x' * size,
+        content_type='binary/custom-server-binary-type',
+        content_encoding='binary',
+    )
+
+
+def receive_bytes(frame, fragment):
+    """
+    the previous implementation: bytes += data, slice after every parse step
+    """
+    sock = FakeSocket(frame, fragment)
+    buffer = b''
+    remaining = len(frame)
+    while remaining:
+        data = sock.recv(4096)
+        remaining -= len(data)
+        buffer += data
+    buffer = buffer[2:]
+    return buffer[:len(buffer)]
+
+
+def receive_recv_buffer(frame, fragment):
+    """
+    the RecvBuffer implementation: recv_into the free tail, consume offsets
+    """
+    sock = FakeSocket(frame, fragment)
+    buffer = RecvBuffer()
+    remaining = len(frame)
+    while remaining:
+        remaining -= buffer.recv_into(sock)
+    buffer.consume(2)
+    return buffer.take(len(buffer))
+
+
+def run(label, func, frame, fragment, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(frame, fragment)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    print(f'{label:<40} {best * 1000:10.2f} ms')
+    return best
+
+
+def main():
+    cases = [
+        ('4 MiB in 4 KiB fragments', 4 * 1024 * 1024, 4096),
+        ('16 MiB in 64 KiB fragments', 16 * 1024 * 1024, 65536),
+        ('512 KiB in 64 byte fragments', 512 * 1024, 64),
+    ]
+    for name, size, fragment in cases:
+        frame = make_frame(size)
+        print(name)
+        old = run('  bytes concatenation', receive_bytes, frame, fragment)
+        new = run('  RecvBuffer', receive_recv_buffer, frame, fragment)
+        print(f'  speedup: {old / new:.1f}x')
+
+
+if __name__ == '__main__':
+    main()
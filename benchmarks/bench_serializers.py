@@ -0,0 +1,64 @@
+"""
+Compares encoding and decoding per message type for the previous json_encode/json_decode,
+the registry JSON serializer and the compact binary serializer.
+Usage: python -m benchmarks.bench_serializers
+"""
+import io
+import json
+import timeit
+
+from serializers import COMPACT_CONTENT_TYPE, JSON_CONTENT_TYPE, get_serializer
+
+MESSAGES = {
+    'heartbeat': {'action': 'heartbeat', 'uuid': '4d6c3b0e-51a7-4b8e-9a57-2f0a1f7a6c11'},
+    'meow': {'action': 'MEOW', 'ip': '127.0.0.1', 'name': 'LucaTopBot', 'type': 'bot'},
+    'query': {'action': 'query', 'type': 'bot'},
+    'query result': [{'ip': '127.0.0.1', 'port': 65433 + i} for i in range(10)],
+    'inform': {'botname': 'LucaBot', 'event': 'PLAY', 'data': 'SKIP', 'action': 'INFORM'},
+    'start': {
+        'card_counts': [
+            {'name': name, 'count': count} for name, count in
+            (('EXPLODING_KITTEN', 3), ('DEFUSE', 6), ('SKIP', 10), ('SEE_THE_FUTURE', 5), ('NORMAL', 40))
+        ],
+        'bots': ['LucaBot', 'TemplateBot', 'RandomBot', 'CautiousBot'],
+        'action': 'START',
+    },
+}
+
+
+class LegacyJson:
+    """
+    the json_encode/json_decode functions before the serializer registry
+    """
+    def encode(self, obj, encoding='utf-8'):
+        return json.dumps(obj, ensure_ascii=False).encode(encoding)
+
+    def decode(self, data, encoding='utf-8'):
+        text_io_wrap = io.TextIOWrapper(io.BytesIO(data), encoding=encoding, newline='')
+        obj = json.load(text_io_wrap)
+        text_io_wrap.close()
+        return obj
+
+
+def main():
+    serializers = {
+        'legacy json': LegacyJson(),
+        'json': get_serializer(JSON_CONTENT_TYPE),
+        'compact': get_serializer(COMPACT_CONTENT_TYPE),
+    }
+    number = 20000
+    print(f'{"message":<14}{"serializer":<13}{"bytes":>6}{"encode us":>11}{"decode us":>11}')
+    for name, obj in MESSAGES.items():
+        for label, serializer in serializers.items():
+            data = serializer.encode(obj)
+            assert serializer.decode(data) == obj
+            encode_time = min(timeit.repeat(lambda: serializer.encode(obj), number=number, repeat=3))
+            decode_time = min(timeit.repeat(lambda: serializer.decode(data), number=number, repeat=3))
+            print(
+                f'{name:<14}{label:<13}{len(data):>6}'
+                f'{encode_time / number * 1e6:>11.2f}{decode_time / number * 1e6:>11.2f}'
+            )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+"""
+Compares the list based Services registry with the indexed one at 100k services.
+Usage: python -m benchmarks.bench_services
+"""
+import random
+import time
+import uuid
+from datetime import datetime
+
+from services import Services
+
+SERVICES = 100000
+TYPES = 1000
+OPERATIONS = 1000
+# the list registry needs up to a second per query
+LEGACY_OPERATIONS = 5
+
+
+class LegacyServices:
+    """
+    the list based registry before the indexes
+    """
+    def __init__(self):
+        self._service_list = []
+
+    def register(self, type, ipaddr, port):
+        service_uuid = str(uuid.uuid4())
+        self._service_list.append({
+            'uuid': service_uuid,
+            'type': type,
+            'ip': ipaddr,
+            'port': port,
+            'heartbeat': datetime.now()
+        })
+        return service_uuid
+
+    def heartbeat(self, service_uuid):
+        for service in self._service_list:
+            if service['uuid'] == service_uuid:
+                service['heartbeat'] = datetime.now()
+                return 'OK'
+        return 'NOT FOUND'
+
+    def query(self, type):
+        results = []
+        for service in self._service_list:
+            duration = datetime.now() - service['heartbeat']
+            if duration.total_seconds() > 5:
+                self._service_list.remove(service)
+            elif service['type'] == type:
+                results.append({'ip': service['ip'], 'port': service['port']})
+        return results
+
+
+def timed(label, func, count):
+    start = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - start
+    print(f'  {label:<12} {elapsed / count * 1e6:12.2f} us/op')
+
+
+def run(services, operations):
+    uuids = []
+    timed(
+        'register',
+        lambda: uuids.extend(
+            services.register(f'type-{n % TYPES}', '127.0.0.1', 10000 + n)
+            for n in range(SERVICES)
+        ),
+        SERVICES
+    )
+    sample = random.sample(uuids, operations)
+    timed('heartbeat', lambda: [services.heartbeat(u) for u in sample], operations)
+    timed(
+        'query',
+        lambda: [services.query(f'type-{n % TYPES}') for n in range(operations)],
+        operations
+    )
+
+
+def main():
+    print(f'{SERVICES} services, {TYPES} types')
+    print(f'list registry, {LEGACY_OPERATIONS} operations')
+    run(LegacyServices(), LEGACY_OPERATIONS)
+    print(f'indexed registry, {OPERATIONS} operations')
+    run(Services(), OPERATIONS)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,376 @@
+"""
+The cases of the benchmark suite, run by python -m benchmarks.
+Every case returns the seconds one operation takes and the same relative to a
+calibration loop run after every repeat, the best of several repeats,
+or their median for the registry cases.
+"""
+import collections
+import json
+import platform
+import random
+import statistics
+import timeit
+
+from benchmarks.bench_serializers import MESSAGES
+from header_codec import BINARY_HEADER, JSON_HEADER, create_header, decode_header, encode_header
+from message import Message, json_decode, json_encode
+from recv_buffer import RecvBuffer
+from serializers import JSON_CONTENT_TYPE
+from services import Services
+
+REPEAT = 7
+NUMBER = 5000
+REGISTRY_SIZES = (1000, 100000, 1000000)
+REGISTRY_TYPES = 1000
+REGISTRY_OPERATIONS = 10000
+# an uncached query copies all services of a type, so fewer of them are timed
+QUERY_OPERATIONS = 200
+# seconds per operation and the same in runs of the calibration loop
+Timing = collections.namedtuple('Timing', ('seconds', 'relative'))
+
+# games per repeat of the game cases
+GAMES = 50
+# runs of the calibration loop, a few milliseconds
+CALIBRATION_NUMBER = 200
+# allowed slowdown of the cases whose name starts with the first matching key, instead
+# of the default. Measured on a shared single CPU VM, 30 runs of the suite compared in
+# groups of 5: relative to the calibration loop the medians of most cases moved by less
+# than 25% in 99 of 100 comparisons, these by up to 40%
+TOLERANCES = {
+    'message.create_message.binary': 0.5,
+    'services.1000.query': 0.5,
+    'services.100000.heartbeat': 0.5,
+    'services.1000000.heartbeat': 0.5,
+}
+
+
+def best_of(func, number, repeat=REPEAT):
+    """
+    :param func: callable without arguments, one operation
+    :param number: operations per repeat
+    :return: Timing of the fastest repeat
+    """
+    timings = [calibrated(timeit.timeit(func, number=number) / number) for _ in range(repeat)]
+    return Timing(min(t.seconds for t in timings), min(t.relative for t in timings))
+
+
+def median_of(func, number, repeat=REPEAT):
+    """
+    for cases whose single repeats are long and vary with the state of the heap
+    :param func: callable without arguments, one repeat of number operations
+    :param number: operations per repeat
+    :return: Timing of the median repeat
+    """
+    timings = [calibrated(timeit.timeit(func, number=1) / number) for _ in range(repeat)]
+    return Timing(statistics.median(t.seconds for t in timings),
+                  statistics.median(t.relative for t in timings))
+
+
+def calibrated(seconds):
+    """
+    :param seconds: seconds per operation of one repeat, measured right before
+    :return: Timing with the seconds relative to the calibration loop run right after
+    """
+    return Timing(seconds, seconds / calibration())
+
+
+def calibration():
+    """
+    a fixed pure Python loop no change of the code touches, its time tells how fast
+    the machine runs Python code at the moment
+    :return: seconds of one run of the loop, the fastest of a few repeats
+    """
+    seconds = timeit.repeat(_calibration_work, number=CALIBRATION_NUMBER, repeat=3)
+    return min(seconds) / CALIBRATION_NUMBER
+
+
+def _calibration_work():
+    table = {}
+    for n in range(100):
+        table[str(n)] = n * 2
+    return sum(table.values())
+
+
+def tolerance(name, default):
+    """
+    :param name: name of a case
+    :param default: allowed slowdown of the cases without an entry in TOLERANCES
+    :return: allowed slowdown of the case
+    """
+    for prefix, allowed in TOLERANCES.items():
+        if name.startswith(prefix):
+            return allowed
+    return default
+
+
+def bench_create_message(header_format):
+    message = Message(None, None, None, header_format)
+    content = json_encode(MESSAGES['inform'], 'utf-8')
+    return best_of(lambda: message._create_message(
+        content_bytes=content,
+        content_type=JSON_CONTENT_TYPE,
+        content_encoding='utf-8',
+        request_id=7,
+        keep_alive=True,
+    ), NUMBER)
+
+
+def bench_json_encode():
+    obj = MESSAGES['start']
+    return best_of(lambda: json_encode(obj, 'utf-8'), NUMBER)
+
+
+def bench_json_decode():
+    data = json_encode(MESSAGES['start'], 'utf-8')
+    return best_of(lambda: json_decode(data, 'utf-8'), NUMBER)
+
+
+def bench_decode_header(header_format):
+    encoded = encode_header(
+        create_header(42, JSON_CONTENT_TYPE, 'utf-8', request_id=7, keep_alive=True),
+        header_format
+    )
+    buffer = RecvBuffer()
+
+    def decode():
+        buffer.extend(encoded)
+        decode_header(buffer)
+
+    return best_of(decode, NUMBER)
+
+
+def bench_registry(size):
+    """
+    fills a registry and measures register with deregister, heartbeat and query at that size,
+    each as the median of several runs.
+    The clock stands still, so nothing expires while a large registry is filled.
+    query empties the cached result of the type before every call, so it measures
+    building the result, query_cached measures the calls the cache answers.
+    :param size: number of services
+    :return: dict operation -> Timing
+    """
+    services = Services(clock=lambda: 0.0)
+    uuids = [
+        services.register(f'type-{n % REGISTRY_TYPES}', '127.0.0.1', 10000 + n % 50000)
+        for n in range(size)
+    ]
+
+    def register():
+        # removed again, so every run registers into a registry of the same size
+        # and the pair is timed together
+        added = [
+            services.register(f'type-{n % REGISTRY_TYPES}', '127.0.0.1', 10000 + n % 50000)
+            for n in range(REGISTRY_OPERATIONS)
+        ]
+        for service_uuid in added:
+            services.deregister(service_uuid)
+
+    rng = random.Random(size)
+    sample = rng.choices(uuids, k=REGISTRY_OPERATIONS)
+    types = [f'type-{rng.randrange(REGISTRY_TYPES)}' for _ in range(REGISTRY_OPERATIONS)]
+    cache = services._query_cache
+
+    def query():
+        for service_type in types[:QUERY_OPERATIONS]:
+            cache.pop(service_type, None)
+            services.query(service_type)
+
+    return {
+        'register_deregister': median_of(register, REGISTRY_OPERATIONS),
+        'heartbeat': median_of(
+            lambda: [services.heartbeat(u) for u in sample], REGISTRY_OPERATIONS
+        ),
+        'query': median_of(query, QUERY_OPERATIONS),
+        'query_cached': median_of(
+            lambda: [services.query(t) for t in types], REGISTRY_OPERATIONS
+        ),
+    }
+
+
+class StubBot:
+    """
+    answers every decision at once: no card played, a defused kitten goes on top
+    """
+    def __init__(self, name):
+        self.name = name
+
+    def request(self, payload):
+        return 0 if '"action":"DEFUSE"' in payload else None
+
+
+class StubCardCounts:
+    """
+    the card counts of a stub game, sent with START
+    """
+    def __init__(self, counts):
+        for name, count in counts.items():
+            setattr(self, name, count)
+
+
+class StubArena:
+    """
+    the turns of an Arena with fixed rules and a deck seeded by the game number:
+    a turn is PLAY and DRAW, a drawn kitten is defused while the bot has a defuse
+    and explodes it otherwise. It needs no game package, so play_game is measured
+    with the bots, the dispatcher and the events, but without the game's rules.
+    """
+    CARDS = 40
+    HAND = 4
+
+    def __init__(self, seed):
+        self._random = random.Random(seed)
+        self._deck = []
+        self._hands = []
+        self._defuses = []
+        self._alive = []
+        self._player = 0
+        self._next = None
+        self.ranking = []
+
+    def start_round(self, bots):
+        kittens = bots - 1
+        self._deck = ['EXPLODING_KITTEN'] * kittens + ['NORMAL'] * (self.CARDS - kittens)
+        self._random.shuffle(self._deck)
+        self._hands = [['DEFUSE'] + ['NORMAL'] * self.HAND for _ in range(bots)]
+        self._defuses = [1] * bots
+        self._alive = list(range(bots))
+        self._player = 0
+        self._next = ('PLAY', None)
+        self.ranking = []
+        return StubCardCounts({'EXPLODING_KITTEN': kittens, 'DEFUSE': bots,
+                               'NORMAL': self.CARDS - kittens + bots * self.HAND})
+
+    @property
+    def deck_size(self):
+        return len(self._deck)
+
+    def read_hand(self, bot_number):
+        return self._hands[bot_number]
+
+    def take_turn(self):
+        action, data = self._next
+        return self._player, action, data
+
+    def analyze_turn(self, response):
+        action = self._next[0]
+        if action == 'PLAY':
+            card = self._deck.pop(0)
+            self._next = ('DRAW', card)
+            return response is not None
+        if action == 'DRAW':
+            if self._next[1] != 'EXPLODING_KITTEN':
+                self._hands[self._player].append(self._next[1])
+                self._end_turn()
+            elif self._defuses[self._player]:
+                self._defuses[self._player] -= 1
+                self._next = ('DEFUSE', None)
+            else:
+                self._next = ('EXPLODE', None)
+            return False
+        if action == 'DEFUSE':
+            index = response if isinstance(response, int) else 0
+            self._deck.insert(min(max(index, 0), len(self._deck)), 'EXPLODING_KITTEN')
+        else:
+            self.ranking.insert(0, self._player)
+            self._alive.remove(self._player)
+            if len(self._alive) == 1:
+                self.ranking.insert(0, self._alive[0])
+        self._end_turn()
+        return False
+
+    def _end_turn(self):
+        alive = [bot for bot in self._alive if bot > self._player]
+        self._player = (alive or self._alive)[0]
+        self._next = ('PLAY', None)
+
+
+def bench_games(arena=None):
+    """
+    plays games like main.main, through the dispatcher with stub bots
+    :param arena: callable(seed) -> arena, the game's Arena if None
+    :return: Timing of a game
+    """
+    from dispatcher import BotDispatcher
+    from main import play_game
+
+    if arena is None:
+        from game.arena import Arena
+
+        def arena(seed):
+            random.seed(seed)
+            return Arena()
+
+    dispatcher = BotDispatcher([StubBot(f'stub{n}') for n in range(4)])
+
+    def games():
+        for seed in range(GAMES):
+            play_game(dispatcher.bots, arena(seed))
+
+    try:
+        return median_of(games, GAMES)
+    finally:
+        dispatcher.close()
+
+
+def cases():
+    """
+    :return: list of tuples (name, callable returning a Timing or a dict operation -> Timing)
+    """
+    benchmarks = [
+        ('message.create_message.json', lambda: bench_create_message(JSON_HEADER)),
+        ('message.create_message.binary', lambda: bench_create_message(BINARY_HEADER)),
+        ('message.json_encode', bench_json_encode),
+        ('message.json_decode', bench_json_decode),
+        ('header.decode.json', lambda: bench_decode_header(JSON_HEADER)),
+        ('header.decode.binary', lambda: bench_decode_header(BINARY_HEADER)),
+    ]
+    for size in REGISTRY_SIZES:
+        benchmarks.append((f'services.{size}', lambda size=size: bench_registry(size)))
+    benchmarks.append(('game.play', lambda: bench_games(StubArena)))
+    benchmarks.append(('game.arena', bench_games))
+    return benchmarks
+
+
+def run(selected=None):
+    """
+    runs the cases
+    :param selected: substrings of the case names to run, None runs all
+    :return: dict name -> seconds per operation, dict name -> the same relative to
+             the calibration loop, dict name -> reason of the skipped cases
+    """
+    results = {}
+    relative = {}
+    skipped = {}
+    for name, bench in cases():
+        if selected and not any(part in name for part in selected):
+            continue
+        try:
+            result = bench()
+        except ImportError as e:
+            # the game cases need the game package
+            skipped[name] = str(e)
+            continue
+        if isinstance(result, Timing):
+            result = {None: result}
+        for operation, timing in result.items():
+            case = name if operation is None else f'{name}.{operation}'
+            results[case] = timing.seconds
+            relative[case] = timing.relative
+    return results, relative, skipped
+
+
+def dumps(results, relative, skipped):
+    """
+    :param results: dict name -> seconds per operation
+    :param relative: dict name -> seconds per operation divided by those of the calibration loop
+    :param skipped: dict name -> reason of the skipped cases
+    :return: the results as JSON with the interpreter they were measured with
+    """
+    return json.dumps({
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'machine': platform.machine(),
+        'results': results,
+        'relative': relative,
+        'skipped': skipped,
+    }, indent=2, sort_keys=True)
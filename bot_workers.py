@@ -0,0 +1,350 @@
+"""
+Runs every bot in its own worker process.
+The workers are forked once and talk to the engine over a socketpair with the
+message framing of the network code: requests are the bots' JSON payloads as
+text content, responses and control messages are compact content. Requests that
+need an answer carry a request id, notifications don't and get no response.
+A worker is kept warm across games and only gets a fresh bot for a new game.
+A worker that crashes, closes its socket or misses the deadline is killed and
+restarted, the engine uses the default response of the action instead. The
+requests of the game so far are replayed to the fresh bot of the new worker, if
+that fails too the game can't go on and BotError is raised, as it is for a bot
+that raises or returns a response the compact content can't encode.
+"""
+import json
+import multiprocessing
+import random
+import signal
+import socket
+import time
+
+import log
+from dispatcher import DEADLINE, DEFAULT_RESPONSES, LatencyHistogram
+from header_codec import BINARY_HEADER, create_header, decode_header, encode_header
+from recv_buffer import RecvBuffer
+from serializers import COMPACT_CONTENT_TYPE, TEXT_CONTENT_TYPE, decode, encode
+
+logger = log.get_logger(__name__)
+
+# seconds a stopped worker gets to exit before it is killed
+STOP_TIMEOUT = 1.0
+
+
+class BotError(Exception):
+    """
+    a bot in a worker process failed, or lost the state of the game
+    """
+
+
+class BotWorkerPool:
+    """
+    one warm worker process per bot, reused for every game
+    """
+    def __init__(self, bot_classes, deadline=DEADLINE, defaults=None,
+                 header_format=BINARY_HEADER):
+        """
+        constructor for the BotWorkerPool class, starts the workers
+        :param bot_classes: list of tuples (name, bot class), see main.bot_classes
+        :param deadline: seconds a decision may take before the worker is restarted
+        :param defaults: dict action -> response used when a bot fails
+        :param header_format: JSON_HEADER or BINARY_HEADER
+        """
+        defaults = DEFAULT_RESPONSES if defaults is None else defaults
+        self.workers = [
+            RemoteBot(name, bot_class, deadline, defaults, header_format)
+            for name, bot_class in bot_classes
+        ]
+
+    def bots(self, rng=None):
+        """
+        starts a new game: every worker creates a fresh bot
+        :param rng: random.Random for the seating order, defaults to the global random
+        :return: list of RemoteBot in their seating order
+        """
+        for worker in self.workers:
+            worker.new_game()
+        bot_list = list(self.workers)
+        (rng or random).shuffle(bot_list)
+        return bot_list
+
+    def report(self):
+        """
+        logs the latency and the restarts of every bot
+        :return: None
+        """
+        for worker in self.workers:
+            logger.info('%s: %s, %d restarts', worker.name, worker.latency, worker.restarts)
+
+    def close(self):
+        """
+        stops the workers
+        :return: None
+        """
+        for worker in self.workers:
+            worker.close()
+
+
+class RemoteBot:
+    """
+    stands in for a bot that runs in a worker process
+    """
+    def __init__(self, name, bot_class, deadline, defaults, header_format=BINARY_HEADER):
+        """
+        constructor for the RemoteBot class, starts the worker
+        :param name: the name of the bot
+        :param bot_class: the class of the bot, created with the name in the worker
+        :param deadline: seconds a decision may take
+        :param defaults: dict action -> response used when the bot fails
+        :param header_format: JSON_HEADER or BINARY_HEADER
+        """
+        self.name = name
+        self.latency = LatencyHistogram()
+        self.restarts = 0
+        self._bot_class = bot_class
+        self._deadline = deadline
+        self._defaults = defaults
+        self._header_format = header_format
+        self._next_request_id = 1
+        # the requests of the game so far, replayed to a restarted worker
+        self._history = []
+        self._process = None
+        self._channel = None
+        self._start()
+
+    def request(self, payload):
+        """
+        sends a request and waits for the response until the deadline
+        :param payload: str the encoded request
+        :return: the response, or the default response of the action if the worker failed
+        :raises BotError: if the bot raised, its response can't be encoded or
+                          the restarted worker couldn't catch up with the game
+        """
+        request_id = self._next_request_id
+        self._next_request_id += 1
+        start = time.perf_counter()
+        failure = None
+        try:
+            self._channel.send(payload, TEXT_CONTENT_TYPE, 'utf-8', request_id)
+            header, content = self._channel.receive(self._deadline)
+            if header.get('request-id') != request_id:
+                raise ConnectionError(f'Response does not match request {request_id}.')
+        except socket.timeout:
+            self.latency.timeouts += 1
+            failure = f'missed the deadline of {self._deadline}s'
+        except (OSError, ValueError) as e:
+            failure = repr(e)
+        self.latency.record(time.perf_counter() - start)
+        if failure is not None:
+            # restarted outside of the except block, the new worker must not inherit the exception
+            self._recover(failure)
+            return self._defaults.get(_action(payload))
+        if 'error' in content:
+            logger.error('Bot %s failed: %s', self.name, content['error'])
+            raise BotError(f'Bot {self.name} failed: {content["error"]}')
+        self._history.append(payload)
+        return content['data']
+
+    def notify(self, payload):
+        """
+        sends a request without waiting, the worker sends no response
+        :param payload: str the encoded request
+        :return: None
+        :raises BotError: if the restarted worker couldn't catch up with the game
+        """
+        # kept before it is sent, a restarted worker gets it with the replay
+        self._history.append(payload)
+        try:
+            self._channel.send(payload, TEXT_CONTENT_TYPE, 'utf-8')
+            return
+        except OSError as e:
+            failure = repr(e)
+        self._recover(failure)
+
+    def new_game(self):
+        """
+        lets the worker replace its bot with a fresh one
+        :return: None
+        """
+        self._history = []
+        try:
+            self._channel.send({'action': 'START'}, COMPACT_CONTENT_TYPE, 'binary')
+            return
+        except OSError as e:
+            failure = repr(e)
+        # the restarted worker already has a fresh bot
+        self._restart(failure)
+
+    def close(self):
+        """
+        closes the socket, the worker exits when it reads the end of it
+        :return: None
+        """
+        self._channel.close()
+        self._process.join(STOP_TIMEOUT)
+        if self._process.is_alive():
+            self._process.kill()
+            self._process.join()
+
+    def _start(self):
+        """
+        forks the worker process
+        """
+        engine_socket, worker_socket = socket.socketpair()
+        self._process = multiprocessing.Process(
+            target=_serve,
+            args=(worker_socket, self.name, self._bot_class, self._header_format),
+            name=f'bot-{self.name}',
+            daemon=True,
+        )
+        self._process.start()
+        worker_socket.close()
+        self._channel = _Channel(engine_socket, self._header_format)
+
+    def _recover(self, reason):
+        """
+        restarts the worker and replays the requests of the game to its fresh bot
+        :raises BotError: if the replay failed, the worker is restarted once more
+                          so it is ready for the next game
+        """
+        self._restart(reason)
+        if not self._history:
+            return
+        try:
+            self._replay()
+        except (OSError, ValueError) as e:
+            failure = repr(e)
+        else:
+            return
+        self._history = []
+        self._restart(f'the replay failed: {failure}')
+        raise BotError(f'Bot {self.name} lost the state of the game: {failure}')
+
+    def _replay(self):
+        """
+        sends the requests of the game as notifications and waits until the worker
+        has handled them, each of them may take up to the deadline
+        """
+        for payload in self._history:
+            self._channel.send(payload, TEXT_CONTENT_TYPE, 'utf-8')
+        request_id = self._next_request_id
+        self._next_request_id += 1
+        self._channel.send({'action': 'SYNC'}, COMPACT_CONTENT_TYPE, 'binary', request_id)
+        header, _ = self._channel.receive(self._deadline * (len(self._history) + 1))
+        if header.get('request-id') != request_id:
+            raise ConnectionError(f'Response does not match request {request_id}.')
+
+    def _restart(self, reason):
+        """
+        kills the worker and starts a new one
+        """
+        logger.warning('Restarting the worker of bot %s: %s', self.name, reason)
+        self.restarts += 1
+        self._channel.close()
+        self._process.kill()
+        self._process.join()
+        self._start()
+
+
+class _Channel:
+    """
+    blocking message framing over a connected socket
+    """
+    def __init__(self, sock, header_format):
+        self._socket = sock
+        self._header_format = header_format
+        self._recv_buffer = RecvBuffer()
+
+    def send(self, content, content_type, content_encoding, request_id=None):
+        """
+        sends one message
+        :param request_id: id the response has to carry, None if no response is expected
+        """
+        content_bytes = encode(content, content_type, content_encoding)
+        header = create_header(len(content_bytes), content_type, content_encoding,
+                               request_id=request_id, keep_alive=True)
+        self._socket.sendall(encode_header(header, self._header_format) + content_bytes)
+
+    def receive(self, timeout):
+        """
+        blocks until the next message has arrived
+        :param timeout: seconds to wait, None waits forever
+        :return: tuple (header, content)
+        """
+        self._socket.settimeout(timeout)
+        decoded = decode_header(self._recv_buffer)
+        while decoded is None:
+            self._receive()
+            decoded = decode_header(self._recv_buffer)
+        _, header = decoded
+        content_len = header['content-length']
+        while len(self._recv_buffer) < content_len:
+            self._receive()
+        with self._recv_buffer.peek(content_len) as data:
+            content = decode(data, header['content-type'], header['content-encoding'])
+        self._recv_buffer.consume(content_len)
+        return header, content
+
+    def close(self):
+        # shut down first: forked siblings hold copies of the socket, closing alone sends no EOF
+        try:
+            self._socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._socket.close()
+
+    def _receive(self):
+        if not self._recv_buffer.recv_into(self._socket):
+            raise ConnectionError('Peer closed.')
+
+
+def _serve(sock, name, bot_class, header_format):
+    """
+    main loop of a worker process, runs until the engine closes the socket
+    :param sock: the worker's end of the socketpair
+    :param name: the name of the bot
+    :param bot_class: the class of the bot
+    :param header_format: JSON_HEADER or BINARY_HEADER
+    """
+    # Ctrl-C is handled by the engine, it stops the workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # the forked queue of the engine's log has no writer thread in this process
+    log.configure()
+    channel = _Channel(sock, header_format)
+    bot = bot_class(name)
+    while True:
+        try:
+            header, content = channel.receive(None)
+        except ConnectionError:
+            break
+        if header['content-type'] == COMPACT_CONTENT_TYPE:
+            action = content.get('action')
+            if action == 'START':
+                bot = bot_class(name)
+            elif action == 'SYNC':
+                # the engine waits until the replayed requests are handled
+                channel.send({'data': None}, COMPACT_CONTENT_TYPE, 'binary',
+                             header.get('request-id'))
+            continue
+        try:
+            response = {'data': bot.request(content)}
+        except Exception as e:
+            logger.exception('Bot %s failed to handle %s', name, log.Truncated(content))
+            response = {'error': repr(e)}
+        request_id = header.get('request-id')
+        if request_id is None:
+            continue
+        try:
+            channel.send(response, COMPACT_CONTENT_TYPE, 'binary', request_id)
+        except (TypeError, ValueError) as e:
+            logger.exception('Bot %s returned a response that can not be sent: %s',
+                             name, log.Truncated(response))
+            channel.send({'error': repr(e)}, COMPACT_CONTENT_TYPE, 'binary', request_id)
+    channel.close()
+    log.shutdown()
+
+
+def _action(payload):
+    """
+    reads the action of an encoded request, only needed after a failure
+    """
+    return json.loads(payload).get('action')
@@ -1,87 +1,622 @@
 import random
-from typing import List, Optional
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 from bot import Bot
 from card import Card, CardType
 from game_handling.game_state import GameState
 
+# seconds of rollouts per decision, far below the engine's response deadline
+DECISION_BUDGET = 0.05
+MAX_ROLLOUTS = 4096
+# rollouts between two checks of the budget
+ROLLOUT_BATCH = 256
+NUMPY_BATCH = 2048
+# own draws a rollout looks ahead
+HORIZON = 2
+# a card is only played if it raises the survival probability by more than this
+MARGIN = 0.02
+# positions in the transposition cache, shared by all games of the process
+CACHE_SIZE = 100000
+
+
+class DeckModel:
+    """
+    Incremental model of the cards: per CardType counters of the own hand,
+    of the cards not seen yet and of the known positions in the draw pile.
+    Every event is an O(1) update, the exploding kitten probability is read in O(1).
+    """
+
+    def __init__(self):
+        self.total: Dict[CardType, int] = {}
+        self.hand: Dict[CardType, int] = dict.fromkeys(CardType, 0)
+        self.played: Dict[CardType, int] = dict.fromkeys(CardType, 0)
+        self.hand_size = 0
+        self.deck_size = 0
+        # kittens in the deck, None without the card counts: then one is assumed
+        self.kittens: Optional[int] = None
+        # known cards by absolute position: draws so far + index from the top
+        self._known: Dict[int, CardType] = {}
+        self._known_kittens = 0
+        self._draws = 0
+        # the own bot put a defused kitten back, its DEFUSE is still to be reported
+        self._own_defuse = False
+
+    def start(self, card_counts: Dict[CardType, int], deck_size: int) -> None:
+        """
+        Reset the model for a new game.
+
+        :param card_counts: number of cards of each type in the game
+        :param deck_size: cards left to draw
+        :return: None
+        """
+        self.total = dict(card_counts)
+        self.played = dict.fromkeys(CardType, 0)
+        self.kittens = self.total.get(CardType.EXPLODING_KITTEN)
+        self.deck_size = deck_size
+        self._own_defuse = False
+        self._forget_positions()
+
+    def sync(self, deck_size: int) -> None:
+        """
+        Account for the cards drawn since the last update.
+
+        :param deck_size: cards left to draw
+        :return: None
+        """
+        if deck_size < self.deck_size:
+            for _ in range(self.deck_size - deck_size):
+                self._draw()
+        elif deck_size > self.deck_size:
+            # a kitten went back at an unknown position
+            self._forget_positions()
+        self.deck_size = deck_size
+
+    def add_to_hand(self, card_type: CardType) -> None:
+        self.hand[card_type] += 1
+        self.hand_size += 1
+
+    def remove_from_hand(self, card_type: CardType) -> None:
+        self.hand[card_type] -= 1
+        self.hand_size -= 1
+
+    def card_played(self, card_type: CardType) -> None:
+        """
+        Count a card played by any bot.
+
+        :param card_type: CardType object
+        :return: None
+        """
+        self.played[card_type] += 1
+        if card_type == CardType.SHUFFLE:
+            self._forget_positions()
+        elif card_type == CardType.DEFUSE:
+            if self._own_defuse:
+                # kitten_inserted already put the own kitten at its known position
+                self._own_defuse = False
+            else:
+                # the defused kitten is back in the deck at an unknown position
+                self._forget_positions()
+        elif card_type == CardType.EXPLODING_KITTEN and self.kittens:
+            self.kittens -= 1
+
+    def see_the_future(self, top: List[CardType]) -> None:
+        """
+        Remember the card types on top of the draw pile.
+
+        :param top: card types from the top down
+        :return: None
+        """
+        for index, card_type in enumerate(top):
+            self._know(self._draws + index, card_type)
+
+    def kitten_inserted(self, index: int) -> None:
+        """
+        Remember where the own bot put a defused kitten back.
+
+        :param index: position from the top
+        :return: None
+        """
+        position = self._draws + index
+        # at most three known positions move down by one
+        moved = sorted((p for p in self._known if p >= position), reverse=True)
+        for p in moved:
+            self._known[p + 1] = self._known.pop(p)
+        self._know(position, CardType.EXPLODING_KITTEN)
+        self.deck_size += 1
+        self._own_defuse = True
+
+    def known(self, index: int) -> Optional[CardType]:
+        """
+        :param index: position from the top
+        :return: the known CardType at the position or None
+        """
+        return self._known.get(self._draws + index)
+
+    def known_positions(self) -> Dict[int, CardType]:
+        """
+        :return: dict position from the top -> known CardType
+        """
+        return {position - self._draws: card_type for position, card_type in self._known.items()}
+
+    def unknown_kittens(self) -> int:
+        """
+        :return: number of kittens in the deck at unknown positions
+        """
+        kittens = 1 if self.kittens is None else self.kittens
+        return max(0, kittens - self._known_kittens)
+
+    def exploding_kitten_probability(self, index: int = 0) -> float:
+        """
+        :param index: position from the top
+        :return: probability that the card at the position is an exploding kitten
+        """
+        card_type = self._known.get(self._draws + index)
+        if card_type is not None:
+            return 1.0 if card_type == CardType.EXPLODING_KITTEN else 0.0
+        unknown = self.deck_size - len(self._known)
+        if unknown <= 0:
+            return 0.0
+        return min(1.0, self.unknown_kittens() / unknown)
+
+    def unseen(self, card_type: CardType) -> int:
+        """
+        :param card_type: CardType object
+        :return: number of cards of the type in the deck or in the other hands
+        """
+        return self.total.get(card_type, 0) - self.played[card_type] - self.hand[card_type]
+
+    def _draw(self) -> None:
+        """
+        the top card left the deck
+        """
+        card_type = self._known.pop(self._draws, None)
+        if card_type == CardType.EXPLODING_KITTEN:
+            self._known_kittens -= 1
+        self._draws += 1
+
+    def _know(self, position: int, card_type: CardType) -> None:
+        previous = self._known.get(position)
+        if previous == CardType.EXPLODING_KITTEN:
+            self._known_kittens -= 1
+        if card_type == CardType.EXPLODING_KITTEN:
+            self._known_kittens += 1
+        self._known[position] = card_type
+
+    def _forget_positions(self) -> None:
+        self._known.clear()
+        self._known_kittens = 0
+
+
+class Situation:
+    """
+    What a rollout needs to know about the game, encoded compactly for the transposition cache.
+    """
+    __slots__ = ('deck_size', 'window', 'known', 'kittens', 'unknown', 'defuses',
+                 'opponents', 'opponent_defuse', 'my_turn', 'key')
+
+    def __init__(self, deck_size: int, known: Dict[int, bool], kittens: int, defuses: int,
+                 opponents: int, opponent_defuse: float, my_turn: bool, horizon: int = HORIZON):
+        """
+        :param deck_size: cards left to draw
+        :param known: dict position from the top -> True for a kitten, False for another card
+        :param kittens: kittens at unknown positions
+        :param defuses: own defuses
+        :param opponents: bots alive besides the own bot
+        :param opponent_defuse: probability that an opponent holds a defuse
+        :param my_turn: True if the own bot draws the next card
+        :param horizon: own draws to look ahead
+        """
+        self.deck_size = deck_size
+        # only the cards drawn within the horizon matter
+        self.window = min(deck_size, (opponents + 1) * horizon + 1, 32)
+        self.known = [known.get(index) for index in range(self.window)]
+        self.kittens = kittens
+        self.unknown = deck_size - len(known)
+        self.defuses = min(defuses, horizon)
+        self.opponents = opponents
+        # eighths, so similar positions share a cache entry
+        self.opponent_defuse = round(opponent_defuse * 8) / 8
+        self.my_turn = my_turn
+        known_mask = kitten_mask = 0
+        for index, kitten in enumerate(self.known):
+            if kitten is not None:
+                known_mask |= 1 << index
+                if kitten:
+                    kitten_mask |= 1 << index
+        key = deck_size
+        for value, bits in ((max(self.unknown, 0), 16), (min(kittens, 15), 4), (self.defuses, 2),
+                            (min(opponents, 7), 3), (int(self.opponent_defuse * 8), 4),
+                            (my_turn, 1), (known_mask, 32), (kitten_mask, 32)):
+            key = key << bits | value
+        # the known cards below the window change which cards the unknown ones can be
+        beyond = tuple(sorted((index, kitten) for index, kitten in known.items()
+                              if index >= self.window))
+        self.key = (key, beyond)
+
+
+class RolloutEngine:
+    """
+    Estimates the probability that the own bot survives its next draws by
+    playing out random orders of the unknown cards. Rollouts are batched as
+    NumPy arrays if NumPy is installed, a batch runs in a Python loop otherwise.
+    Estimates are kept in a transposition cache keyed by Situation.key.
+    """
+
+    def __init__(self, budget: float = DECISION_BUDGET, max_rollouts: int = MAX_ROLLOUTS,
+                 horizon: int = HORIZON, cache_size: int = CACHE_SIZE, seed=None):
+        self.budget = budget
+        self.max_rollouts = max_rollouts
+        self.horizon = horizon
+        self._cache_size = cache_size
+        self._cache: OrderedDict = OrderedDict()
+        self._random = random.Random(seed)
+        self._numpy_random = np.random.default_rng(seed) if np is not None else None
+
+    def survival(self, situation: Situation, budget: float) -> float:
+        """
+        Estimate the probability to survive the next draws, from the cache if possible.
+
+        :param situation: Situation object
+        :param budget: seconds the rollouts may take
+        :return: float
+        """
+        estimate = self._cache.get(situation.key)
+        if estimate is not None:
+            self._cache.move_to_end(situation.key)
+            return estimate
+        if np is not None:
+            rollout, batch = self._rollouts_numpy, NUMPY_BATCH
+        else:
+            rollout, batch = self._rollouts_python, ROLLOUT_BATCH
+        deadline = time.perf_counter() + budget
+        survived = count = 0
+        while count < self.max_rollouts:
+            survived += rollout(situation, batch)
+            count += batch
+            if time.perf_counter() >= deadline:
+                break
+        estimate = survived / count
+        self._cache[situation.key] = estimate
+        if len(self._cache) > self._cache_size:
+            self._cache.popitem(last=False)
+        return estimate
+
+    def _rollouts_python(self, situation: Situation, count: int) -> int:
+        """
+        :return: number of rollouts the own bot survived
+        """
+        rng = self._random.random
+        survived = 0
+        for _ in range(count):
+            kittens, unknown = situation.kittens, situation.unknown
+            cards = []
+            for kitten in situation.known:
+                if kitten is None:
+                    kitten = rng() * unknown < kittens
+                    kittens -= kitten
+                    unknown -= 1
+                cards.append(kitten)
+            defuses = situation.defuses
+            opponent_defuses = [rng() < situation.opponent_defuse
+                                for _ in range(situation.opponents)]
+            alive = list(range(1, situation.opponents + 1))
+            # 0 is the own bot, 1.. the opponents in their order
+            order = [0] + alive
+            turn = 0 if situation.my_turn else 1
+            draws = 0
+            survived += 1
+            for kitten in cards:
+                player = order[turn]
+                if player == 0:
+                    draws += 1
+                    if kitten:
+                        if not defuses:
+                            survived -= 1
+                            break
+                        defuses -= 1
+                    if draws == self.horizon:
+                        break
+                    turn += 1
+                elif kitten and not opponent_defuses[player - 1]:
+                    del order[turn]
+                    if len(order) == 1:
+                        break
+                else:
+                    if kitten:
+                        opponent_defuses[player - 1] = False
+                    turn += 1
+                turn %= len(order)
+        return survived
+
+    def _rollouts_numpy(self, situation: Situation, count: int) -> int:
+        """
+        :return: number of rollouts the own bot survived
+        """
+        rng = self._numpy_random
+        window = situation.window
+        players = situation.opponents + 1
+        cards = np.empty((count, window), dtype=bool)
+        kittens = np.full(count, situation.kittens)
+        unknown = situation.unknown
+        draws_uniform = rng.random((count, window))
+        for index, kitten in enumerate(situation.known):
+            if kitten is None:
+                column = draws_uniform[:, index] * unknown < kittens
+                kittens -= column
+                unknown -= 1
+                cards[:, index] = column
+            else:
+                cards[:, index] = kitten
+        rows = np.arange(count)
+        defuses = np.full(count, situation.defuses)
+        opponent_defuses = rng.random((count, players)) < situation.opponent_defuse
+        alive = np.ones((count, players), dtype=bool)
+        player = np.full(count, 0 if situation.my_turn else 1)
+        draws = np.zeros(count, dtype=int)
+        dead = np.zeros(count, dtype=bool)
+        done = np.zeros(count, dtype=bool)
+        for index in range(window):
+            kitten = cards[:, index] & ~done
+            own = (player == 0) & ~done
+            draws += own
+            hit = own & kitten
+            dead |= hit & (defuses == 0)
+            defuses -= hit & (defuses > 0)
+            opponent_hit = kitten & (player > 0)
+            saved = opponent_hit & opponent_defuses[rows, player]
+            opponent_defuses[rows[saved], player[saved]] = False
+            exploded = opponent_hit & ~saved
+            alive[rows[exploded], player[exploded]] = False
+            done |= dead | (draws >= self.horizon) | ~alive[:, 1:].any(axis=1)
+            # the next alive player, the own bot is always alive while a rollout runs
+            following = np.full(count, -1)
+            for step in range(players, 0, -1):
+                candidate = (player + step) % players
+                following = np.where(alive[rows, candidate], candidate, following)
+            player = following
+        return int(count - dead.sum())
+
+
+_engine = RolloutEngine()
+
+
+class CountedHand(list):
+    """
+    List of the hand cards that keeps the hand counters of a DeckModel up to date.
+    """
+
+    def __init__(self, cards, deck: DeckModel):
+        super().__init__(cards)
+        self._deck = deck
+        for card in self:
+            deck.add_to_hand(card.card_type)
+
+    def append(self, card: Card) -> None:
+        super().append(card)
+        self._deck.add_to_hand(card.card_type)
+
+    def insert(self, index, card: Card) -> None:
+        super().insert(index, card)
+        self._deck.add_to_hand(card.card_type)
+
+    def extend(self, cards) -> None:
+        for card in cards:
+            self.append(card)
+
+    def remove(self, card: Card) -> None:
+        super().remove(card)
+        self._deck.remove_from_hand(card.card_type)
+
+    def pop(self, index=-1) -> Card:
+        card = super().pop(index)
+        self._deck.remove_from_hand(card.card_type)
+        return card
+
+    def clear(self) -> None:
+        for card in self:
+            self._deck.remove_from_hand(card.card_type)
+        super().clear()
+
+    def __delitem__(self, index) -> None:
+        removed = self[index] if isinstance(index, slice) else [self[index]]
+        for card in removed:
+            self._deck.remove_from_hand(card.card_type)
+        super().__delitem__(index)
+
+    def first(self, card_type: CardType) -> Optional[Card]:
+        """
+        :param card_type: CardType object
+        :return: the first card of the type or None
+        """
+        if not self._deck.hand[card_type]:
+            return None
+        return next(card for card in self if card.card_type == card_type)
+
 
 class LucaBot(Bot):
     def __init__(self, name=None, **kwargs):
+        self.deck = DeckModel()
         super().__init__(name=name, **kwargs)
-        self.future_cards = []
-        self.defuses_used_by_others = 0
+        if not hasattr(self, '_hand'):
+            self.hand = []
+        self._started = False
+
+    @property
+    def hand(self) -> CountedHand:
+        return self._hand
+
+    @hand.setter
+    def hand(self, cards) -> None:
+        # the hand counters follow every change of the hand, however Bot changes it
+        self.deck.hand = dict.fromkeys(CardType, 0)
+        self.deck.hand_size = 0
+        self._hand = CountedHand(cards, self.deck)
+
+    def observe(self, state: GameState) -> None:
+        """
+        Bring the deck model up to date with the game state.
+
+        :param state: GameState object
+        :return: None
+        """
+        if not self._started:
+            self._started = True
+            self.deck.start(_card_counts(state), state.cards_left_to_draw)
+        else:
+            self.deck.sync(state.cards_left_to_draw)
+        alive_bots = getattr(state, 'alive_bots', None)
+        if alive_bots is not None:
+            # while bots are alive, one kitten less than bots is left
+            self.deck.kittens = alive_bots - 1
 
     def play(self, state: GameState) -> Optional[Card]:
         """
-        Play cards strategically based on deck size, hand, and future knowledge.
+        Play the card that gives the best chance to survive the next draws.
 
         :param state: GameState object
         :return: Card object or None
         """
-        playable_cards = [card for card in self.hand if card.card_type != CardType.DEFUSE]
-        if not playable_cards:
+        self.observe(state)
+        deck = self.deck
+        if deck.hand_size == deck.hand[CardType.DEFUSE]:
             return None
 
-        deck_size = state.cards_left_to_draw
-        see_future_cards = [card for card in playable_cards if card.card_type == CardType.SEE_THE_FUTURE]
-        defuse_count = sum(1 for card in self.hand if card.card_type == CardType.DEFUSE)
-
-        if see_future_cards and (not self.future_cards or deck_size < 5):
-            return see_future_cards[0]
-
-        if self.future_cards and self.future_cards[0].card_type == CardType.EXPLODING_KITTEN and defuse_count == 0:
-            return random.choice(playable_cards)
+        if deck.hand[CardType.SEE_THE_FUTURE] and (deck.known(0) is None or deck.deck_size < 5):
+            return self.hand.first(CardType.SEE_THE_FUTURE)
 
-        if deck_size < 5 and self.defuses_used_by_others < 2 and defuse_count > 0:
+        if deck.exploding_kitten_probability() == 0.0:
+            # the next draw is safe, the cards are kept for later
             return None
 
-        if (len(self.hand) > 4 or deck_size < 3) and defuse_count > 0:
-            return random.choice(playable_cards)
+        options = {None: self._situation()}
+        if deck.hand[CardType.SKIP]:
+            options[CardType.SKIP] = self._situation(my_turn=False)
+        if deck.hand[CardType.SHUFFLE]:
+            options[CardType.SHUFFLE] = self._situation(shuffled=True)
+        if len(options) == 1:
+            return None
 
-        return None
+        budget = DECISION_BUDGET / len(options)
+        survival = {card_type: _engine.survival(situation, budget)
+                    for card_type, situation in options.items()}
+        best = max(survival, key=survival.get)
+        if best is None or survival[best] <= survival[None] + MARGIN:
+            return None
+        return self.hand.first(best)
 
     def handle_exploding_kitten(self, state: GameState) -> int:
         """
-        Place the Exploding Kitten optimally based on future knowledge.
+        Place the Exploding Kitten where the own bot is least likely to draw it,
+        as near to the top as possible.
 
         :param state: GameState object
         :return: int index of the draw pile
         """
+        self.observe(state)
         deck_size = state.cards_left_to_draw
         if deck_size <= 1:
-            return 0
-
-        if self.future_cards:
-            deepest_ek = -1
-            for i, card in enumerate(self.future_cards[:min(3, deck_size)]):
-                if card.card_type == CardType.EXPLODING_KITTEN:
-                    deepest_ek = i
-            if deepest_ek >= 0 and deepest_ek + 1 < deck_size:
-                return deepest_ek + 1
-
-        return random.randint(max(0, deck_size - deck_size//4), deck_size - 1)
+            index = 0
+        else:
+            window = (self._opponents() + 1) * HORIZON + 1
+            candidates = list(range(min(deck_size, window)))
+            if deck_size - 1 not in candidates:
+                candidates.append(deck_size - 1)
+            # the drawn kitten is still counted at an unknown position
+            others_unknown = self.deck.unknown_kittens() > 1
+            if not others_unknown and not any(
+                    self.deck.exploding_kitten_probability(i) == 1.0 for i in range(window)):
+                # no other kitten can be drawn within the horizon,
+                # on top the next opponent draws it and the own bot is safe
+                index = 0
+            else:
+                budget = DECISION_BUDGET / len(candidates)
+                survival = [_engine.survival(self._situation(my_turn=False, insert_at=i), budget)
+                            for i in candidates]
+                best = max(survival)
+                index = next(i for i, p in zip(candidates, survival) if p >= best - MARGIN)
+        self.deck.kitten_inserted(index)
+        return index
 
     def see_the_future(self, state: GameState, top_three: List[Card]) -> None:
         """
-        Store and analyze top three cards for bomb density.
+        Store the top three cards in the deck model.
 
         :param state: GameState object
         :param top_three: List of top three cards
         :return: None
         """
-        self.future_cards = top_three.copy()
+        self.observe(state)
+        self.deck.see_the_future([card.card_type for card in top_three])
 
     def card_played(self, card_type: CardType, position: int) -> bool:
         """
-        Track opponent Defuse usage and clear future cards if deck changes.
+        Update the deck model with a played card.
 
         :param card_type: CardType object
         :param position: int
         :return: bool
         """
-        if card_type == CardType.SEE_THE_FUTURE:
-            self.future_cards = []
-        elif card_type == CardType.DEFUSE:
-            self.defuses_used_by_others += 1
-        return True
\ No newline at end of file
+        self.deck.card_played(card_type)
+        return True
+
+    def _opponents(self) -> int:
+        """
+        :return: number of opponents alive, one less kitten than bots is in the game
+        """
+        return max(1, self.deck.kittens or 1)
+
+    def _situation(self, my_turn: bool = True, shuffled: bool = False,
+                   insert_at: Optional[int] = None) -> Situation:
+        """
+        Describe the game for the rollout engine.
+
+        :param my_turn: True if the own bot draws the next card
+        :param shuffled: the deck is shuffled first, all positions become unknown
+        :param insert_at: the own bot puts the kitten it drew back at this position
+        :return: Situation object
+        """
+        deck = self.deck
+        deck_size = deck.deck_size
+        kittens = deck.unknown_kittens()
+        known = {index: card_type == CardType.EXPLODING_KITTEN
+                 for index, card_type in deck.known_positions().items()}
+        if shuffled:
+            kittens += sum(known.values())
+            known = {}
+        if insert_at is not None:
+            # the drawn kitten was counted in the deck at an unknown position
+            kittens = max(0, kittens - 1)
+            known = {index + (index >= insert_at): kitten for index, kitten in known.items()}
+            known[insert_at] = True
+            deck_size += 1
+        opponents = self._opponents()
+        if deck.total:
+            opponent_defuse = min(1.0, max(0, deck.unseen(CardType.DEFUSE)) / opponents)
+        else:
+            opponent_defuse = 0.5
+        return Situation(deck_size, known, kittens, deck.hand[CardType.DEFUSE],
+                         opponents, opponent_defuse, my_turn)
+
+def _card_counts(state: GameState) -> Dict[CardType, int]:
+    """
+    Read the card counts sent with START from the game state.
+
+    :param state: GameState object
+    :return: dict CardType -> count, empty if the state has none
+    """
+    card_counts = getattr(state, 'total_cards_in_deck', None)
+    if card_counts is None:
+        return {}
+    counts = {}
+    for card_type in CardType:
+        count = getattr(card_counts, card_type.name, None)
+        if count is not None:
+            counts[card_type] = count
+    return counts
@@ -2,18 +2,23 @@
 This module contains the ClientMessage class, which is a subclass of the Message class.
 It is used to handle messages sent by the client to the server.
 """
-from message import Message, json_encode, json_decode
+from header_codec import JSON_HEADER
+from log import Truncated, get_logger
+from message import Message
+from serializers import JSON_CONTENT_TYPE, encode
+
+logger = get_logger(__name__)
 
 
 class ClientMessage(Message):
     """
     constructor for ClientMessage
     """
-    def __init__(self, selector, socket, ipaddr, request):
+    def __init__(self, selector, socket, ipaddr, request, header_format=JSON_HEADER):
         """
         constructor for the ClientMessage class
         """
-        super().__init__(selector, socket, ipaddr)
+        super().__init__(selector, socket, ipaddr, header_format)
         self._request = request
         self._request_queued = False
         self._response = None
@@ -25,7 +30,7 @@ class ClientMessage(Message):
         """
         self._process_headers()
 
-        if self._jsonheader:
+        if self._header:
             if self._response is None:
                 self.process_response()
 
@@ -34,16 +39,14 @@ class ClientMessage(Message):
         process the response content
         :return:
         """
-        content = self._response
-        print(f'Got result: {content}')
+        logger.debug('Got result: %s', Truncated(self._response))
 
     def _process_response_binary_content(self):
         """
         process binary content in the response
         :return:
         """
-        content = self._response
-        print(f'Got response: {content!r}')
+        logger.debug('Got response: %s', Truncated(self._response))
 
     def _process_write(self):
         """
@@ -57,7 +60,7 @@ class ClientMessage(Message):
         self._write()
 
         if self._request_queued:
-            if not self._send_buffer:
+            if not self._send_queue:
                 self.set_selector_events_mask('r')
 
     def _queue_request(self):
@@ -65,23 +68,8 @@ class ClientMessage(Message):
         queues up the request to be sent
         :return:
         """
-        content = self._request['content']
-        content_type = self._request['type']
-        content_encoding = self._request['encoding']
-        if content_type == 'text/json':
-            req = {
-                'content_bytes': json_encode(content, content_encoding),
-                'content_type': content_type,
-                'content_encoding': content_encoding,
-            }
-        else:
-            req = {
-                'content_bytes': content,
-                'content_type': content_type,
-                'content_encoding': content_encoding,
-            }
-        message = self._create_message(**req)
-        self._send_buffer += message
+        message = self._create_message(**encode_request(self._request))
+        self._queue_send(message)
         self._request_queued = True
 
     def process_response(self):
@@ -89,21 +77,118 @@ class ClientMessage(Message):
         Process the response from the server
         :return:
         """
-        content_len = self._jsonheader['content-length']
-        if not len(self._recv_buffer) >= content_len:
+        if not self._content_received():
             return
-        data = self._recv_buffer[:content_len]
-        self._recv_buffer = self._recv_buffer[content_len:]
-        if self._jsonheader['content-type'] == 'text/json':
-            encoding = self._jsonheader['content-encoding']
-            self._response = json_decode(data, encoding)
-            print(f'Received response {self.response!r} from {self._ipaddr}')
+        self._response = self._take_content()
+        if self._header['content-type'] == JSON_CONTENT_TYPE:
+            logger.debug('Received response %s from %s', Truncated(self._response), self._ipaddr)
             self._process_response_json_content()
         else:
-            self._response = data
-            print(
-                f'Received {self._jsonheader["content-type"]} '
-                f'response from {self._ipaddr}'
+            logger.debug(
+                'Received %s response from %s', self._header['content-type'], self._ipaddr
             )
             self._process_response_binary_content()
         self._close()
+
+
+class KeepAliveClientMessage(ClientMessage):
+    """
+    Client side of a keep-alive connection: many requests are pipelined over one
+    connection and the responses are matched by their request id.
+    """
+    def __init__(self, selector, socket, ipaddr, header_format=JSON_HEADER):
+        """
+        constructor for the KeepAliveClientMessage class
+        """
+        super().__init__(selector, socket, ipaddr, None, header_format)
+        self._next_request_id = 1
+        self._pending = set()
+        self._responses = {}
+
+    def queue_request(self, request):
+        """
+        queues a request, it is sent with the next write-events
+        :param request: dict with type, encoding and content
+        :return: the request id to collect the response with
+        """
+        request_id = self._next_request_id
+        self._next_request_id += 1
+        message = self._create_message(
+            **encode_request(request),
+            request_id=request_id,
+            keep_alive=True
+        )
+        self._queue_send(message)
+        self._pending.add(request_id)
+        self.set_selector_events_mask('rw')
+        return request_id
+
+    def pop_response(self, request_id):
+        """
+        returns the response for a request and forgets it
+        :param request_id: the id returned by queue_request
+        :return: the response content
+        """
+        return self._responses.pop(request_id)
+
+    @property
+    def pending(self):
+        return len(self._pending)
+
+    def close(self):
+        """
+        closes the connection
+        """
+        self._close()
+
+    def _process_read(self):
+        """
+        process read-event, several responses may arrive in one read
+        :return:
+        """
+        self._process_headers()
+
+        while self._header:
+            self.process_response()
+            if self._header:
+                break
+            self._parse_headers()
+
+    def _process_write(self):
+        """
+        process the write-event
+        :return:
+        """
+        self._event = 'WRITE'
+        self._write()
+
+        if not self._send_queue:
+            self.set_selector_events_mask('r')
+
+    def process_response(self):
+        """
+        stores the next response under its request id
+        :return:
+        """
+        if not self._content_received():
+            return
+        request_id = self._header.get('request-id')
+        response = self._take_content()
+        self._responses[request_id] = response
+        self._pending.discard(request_id)
+        self._header = None
+
+
+def encode_request(request):
+    """
+    encodes the content of a request
+    :param request: dict with type, encoding and content
+    :return: dict with the arguments for _create_message
+    """
+    content_type = request['type']
+    content_encoding = request['encoding']
+    return {
+        'content_bytes': encode(request['content'], content_type, content_encoding),
+        'content_type': content_type,
+        'content_encoding': content_encoding,
+    }
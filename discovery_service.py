@@ -1,79 +1,416 @@
 """ Implements a simple discovery service that listens for incoming connections """
 
+import argparse
+import asyncio
+import multiprocessing
 import selectors
+import signal
 import socket
-import traceback
+import time
+import weakref
+from multiprocessing.managers import BaseManager
 
-from server_message import ServerMessage
-from services import Services
+import log
+from async_message import current_connection, start_server
+from profiling import profiler
+from registry_store import RegistryStore
+from server_message import ServerMessage, reap_when_idle
+from services import LockedServices, Services
+from timers import TimerWheel
+from watchers import Watchers
+
+logger = log.get_logger(__name__)
 
 HOST = '127.0.0.1'
 PORT = 65432
+IDLE_TIMEOUT = 30
+# expired services are removed in slices of EXPIRE_SLICE every EXPIRE_INTERVAL seconds
+EXPIRE_INTERVAL = 0.5
+EXPIRE_SLICE = 1000
+# seconds between two measurements of the asyncio loop's lag
+LAG_INTERVAL = 0.1
+
+
+class RegistryManager(BaseManager):
+    """
+    runs the Services registry in a coordinator process shared by the workers,
+    the manager serves every worker connection on its own thread, so the registry is locked
+    """
+
+
+RegistryManager.register('Services', LockedServices)
+
 
+class ServerStats:
+    """
+    counters of one server process, answered to the 'stats' action.
+    The maxima cover the time since the previous report.
+    """
+    def __init__(self, clock=time.monotonic):
+        """
+        constructor for the ServerStats class
+        :param clock: monotonic clock returning seconds
+        """
+        self._clock = clock
+        self._started = clock()
+        self.accepted = 0
+        self.requests = 0
+        self.errors = 0
+        self._connections = weakref.WeakSet()
+        self._max_ready = 0
+        self._max_lag = 0.0
+
+    def connected(self, connection):
+        """
+        counts a new connection
+        :param connection: ServerMessage or AsyncServerMessage
+        """
+        self.accepted += 1
+        self._connections.add(connection)
+
+    def ready(self, count):
+        """
+        :param count: events returned by one select call
+        """
+        if count > self._max_ready:
+            self._max_ready = count
 
-def main():
+    def lag(self, seconds):
+        """
+        :param seconds: time the loop could not react to new events
+        """
+        if seconds > self._max_lag:
+            self._max_lag = seconds
+
+    def report(self):
+        """
+        :return: dictionary of the counters, the send queues of the open connections
+                 and the maxima since the previous report
+        """
+        queued = [
+            connection.send_queue_size for connection in self._connections
+            if not connection.closed
+        ]
+        report = {
+            'uptime': self._clock() - self._started,
+            'accepted': self.accepted,
+            'connections': len(queued),
+            'requests': self.requests,
+            'errors': self.errors,
+            'send_queued': sum(queued),
+            'send_queued_max': max(queued, default=0),
+            'ready_max': self._max_ready,
+            'lag_max': self._max_lag,
+        }
+        self._max_ready = 0
+        self._max_lag = 0.0
+        return report
+
+
+def main(services=None, reuse_port=False):
     """
     main entry point for the discovery service
+    :param services: the services object, defaults to a new registry
+    :param reuse_port: bind with SO_REUSEPORT so several workers share HOST:PORT
     """
     sel = selectors.DefaultSelector()
-    services = Services()
+    if services is None:
+        services = Services()
 
     lsock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     # Avoid bind() exception: OSError: [Errno 48] Address already in use
     lsock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        lsock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
     lsock.bind((HOST, PORT))
     lsock.listen()
-    print(f'Listening on {(HOST, PORT)}')
+    logger.info('Listening on %s', (HOST, PORT))
     lsock.setblocking(False)
     sel.register(lsock, selectors.EVENT_READ, data=None)
+    watchers = Watchers()
+    timers = TimerWheel()
+    timers.schedule(EXPIRE_INTERVAL, maintain, timers, services)
+    stats = ServerStats()
+    profiler.install_signals()
 
     try:
         while True:
-            events = sel.select(timeout=None)
+            events = sel.select(timeout=timers.next_timeout())
+            busy_since = time.monotonic()
+            stats.ready(len(events))
             for key, mask in events:
                 if key.data is None:
-                    accept_wrapper(sel, key.fileobj)
+                    accept_wrapper(sel, key.fileobj, timers, stats)
                 else:
                     message = key.data
                     try:
                         message.process_events(mask)
-                        process_action(message, services)
+                        with profiler.span('process_action'):
+                            process_action(message, services, watchers, stats)
                     except Exception:
-                        print(
-                            f'Main: Error: Exception for {message.ipaddr}:\n'
-                            f'{traceback.format_exc()}'
-                        )
+                        stats.errors += 1
+                        logger.exception('Main: Error: Exception for %s', message.ipaddr)
                         message._close()
+            timers.run_due()
+            watchers.notify(services)
+            stats.lag(time.monotonic() - busy_since)
     except KeyboardInterrupt:
-        print('Caught keyboard interrupt, exiting')
+        logger.info('Caught keyboard interrupt, exiting')
     finally:
         sel.close()
+        profiler.stop()
+
 
+def maintain(timers, services):
+    """
+    expires one slice of services and flushes the store, then schedules the next run:
+    right away while there are more expired services, otherwise after EXPIRE_INTERVAL
+    :param timers: the TimerWheel of the loop
+    :param services: the services object
+    """
+    expired = len(expire_slice(services))
+    services.flush()
+    timers.schedule(0 if expired == EXPIRE_SLICE else EXPIRE_INTERVAL, maintain, timers, services)
+
+
+def expire_slice(services):
+    """
+    removes at most EXPIRE_SLICE expired services, watchers get expire events for them
+    :param services: the services object
+    :return: list of the removed services
+    """
+    expired = services.expire(EXPIRE_SLICE)
+    if expired:
+        logger.debug('Expired %d services', len(expired))
+    return expired
 
-def process_action(message, services):
+
+def process_action(message, services, watchers=None, stats=None):
     """
     process the action from the client
     :param message: the message object
     :param services: the services object
+    :param watchers: the Watchers for WATCH requests
+    :param stats: the ServerStats of the process
     """
 
-    if message.event == 'READ':
-        action = message.request['action']
-        # TODO call the methods on the Services-object depending on the action
-        message.response = 'TODO Response from the method'
+    if message.event == 'READ' and message.request is not None:
+        if stats is not None:
+            stats.requests += 1
+        message.response = handle_request(message.request, services, message, watchers, stats)
         message.set_selector_events_mask('w')
 
 
-def accept_wrapper(sel, sock):
+def handle_request(request, services, connection=None, watchers=None, stats=None):
+    """
+    calls the method on the Services-object depending on the action.
+    MEOW with a list of 'services' and HEARTBEAT with a list of 'uuids'
+    are answered with a list of per-item results.
+    WATCH answers with the changes of a type since a version or a snapshot,
+    a kept-alive connection then gets the following changes pushed.
+    The admin action stats answers with the counters of the server process,
+    profile switches the profiler on with 'enable' true, off with false or toggles it.
+    :param request: the decoded request
+    :param services: the services object
+    :param connection: the connection the request came in on
+    :param watchers: the Watchers for WATCH requests
+    :param stats: the ServerStats of the process
+    :return: the response
+    """
+    action = request['action']
+    if action in ('MEOW', 'register'):
+        if 'services' in request:
+            return services.register_many(request['services'])
+        return services.register(request['type'], request['ip'], request['port'])
+    if action in ('HEARTBEAT', 'heartbeat'):
+        if 'uuids' in request:
+            return services.heartbeat_many(request['uuids'])
+        return services.heartbeat(request['uuid'])
+    if action == 'deregister':
+        return services.deregister(request['uuid'])
+    if action == 'query':
+        return services.query(request['type'])
+    if action == 'WATCH':
+        if watchers is None or connection is None:
+            return services.changes(request['type'], request.get('since'), request.get('epoch'))
+        return watchers.watch(connection, request, services)
+    if action == 'stats':
+        return stats.report() if stats is not None else {}
+    if action == 'profile':
+        return profiler.control(request.get('enable'))
+    return f'UNKNOWN ACTION {action}'
+
+
+def accept_wrapper(sel, sock, timers=None, stats=None):
     """
     accept a connection
+    :param timers: TimerWheel that closes the connection when it is idle
+    :param stats: the ServerStats of the process
     """
     conn, addr = sock.accept()  # Should be ready to read
-    print(f'Accepted connection from {addr}')
+    logger.debug('Accepted connection from %s', addr)
     conn.setblocking(False)
     message = ServerMessage(sel, conn, addr)
     sel.register(conn, selectors.EVENT_READ, data=message)
+    if timers is not None:
+        reap_when_idle(timers, message, IDLE_TIMEOUT)
+    if stats is not None:
+        stats.connected(message)
+
+
+async def serve_async(services, host=HOST, port=PORT, reuse_port=False):
+    """
+    serves the discovery service with the asyncio transport
+    :param services: the services object
+    :param reuse_port: bind with SO_REUSEPORT so several workers share the port
+    """
+    watchers = Watchers()
+    stats = ServerStats()
+    loop = asyncio.get_running_loop()
+
+    def respond(request):
+        # notified once the response is sent, so pushes don't overtake it
+        loop.call_soon(watchers.notify, services)
+        connection = current_connection.get()
+        stats.requests += 1
+        with profiler.span('process_action'):
+            return handle_request(request, services, connection, watchers, stats)
+
+    server = await start_server(
+        respond,
+        host,
+        port,
+        idle_timeout=IDLE_TIMEOUT,
+        reuse_port=reuse_port,
+        stats=stats
+    )
+    logger.info('Listening on %s', (host, port))
+    async with server, asyncio.TaskGroup() as group:
+        group.create_task(server.serve_forever())
+        group.create_task(maintain_async(services, watchers))
+        group.create_task(measure_lag(stats))
+
+
+async def measure_lag(stats):
+    """
+    measures how late the loop wakes up a sleeping task
+    :param stats: the ServerStats of the process
+    """
+    while True:
+        start = time.monotonic()
+        await asyncio.sleep(LAG_INTERVAL)
+        stats.lag(time.monotonic() - start - LAG_INTERVAL)
+
+
+async def maintain_async(services, watchers):
+    """
+    expires services in slices and flushes the store, as maintain does for the select loop
+    :param services: the services object
+    :param watchers: the Watchers to notify of expired services
+    """
+    while True:
+        expired = len(expire_slice(services))
+        if expired:
+            watchers.notify(services)
+        services.flush()
+        await asyncio.sleep(0 if expired == EXPIRE_SLICE else EXPIRE_INTERVAL)
+
+
+def main_async(services=None, reuse_port=False):
+    """
+    entry point for the discovery service on the asyncio transport
+    :param services: the services object, defaults to a new registry
+    :param reuse_port: bind with SO_REUSEPORT so several workers share HOST:PORT
+    """
+    if services is None:
+        services = Services()
+    profiler.install_signals()
+    try:
+        asyncio.run(serve_async(services, HOST, PORT, reuse_port))
+    except KeyboardInterrupt:
+        logger.info('Caught keyboard interrupt, exiting')
+    finally:
+        profiler.stop()
+
+
+def main_workers(workers, use_asyncio=False, store=None):
+    """
+    runs the discovery service in several worker processes that all accept
+    on HOST:PORT through SO_REUSEPORT and share one registry in a coordinator process
+    :param workers: number of worker processes
+    :param use_asyncio: run the workers on the asyncio transport
+    :param store: optional RegistryStore, used by the coordinator
+    """
+    if not hasattr(socket, 'SO_REUSEPORT'):
+        raise RuntimeError('SO_REUSEPORT is not supported on this platform.')
+    manager = RegistryManager()
+    # the coordinator is shut down by this process, not by Ctrl-C
+    manager.start(signal.signal, (signal.SIGINT, signal.SIG_IGN))
+    services = manager.Services(store=store)
+    processes = [
+        multiprocessing.Process(
+            target=run_worker,
+            args=(services, use_asyncio),
+            name=f'discovery-worker-{number}'
+        )
+        for number in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    logger.info('Started %d workers on %s', workers, (HOST, PORT))
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        logger.info('Caught keyboard interrupt, stopping the workers')
+        for process in processes:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+                process.join()
+    finally:
+        services.close()
+        manager.shutdown()
+
+
+def run_worker(services, use_asyncio):
+    """
+    entry point of a worker process
+    :param services: proxy to the shared registry
+    :param use_asyncio: run on the asyncio transport
+    """
+    log.configure()
+    if use_asyncio:
+        main_async(services, reuse_port=True)
+    else:
+        main(services, reuse_port=True)
 
 
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser(description='discovery service')
+    parser.add_argument(
+        '--asyncio', action='store_true', help='use the asyncio transport'
+    )
+    parser.add_argument(
+        '--workers', type=int, default=1,
+        help='number of worker processes sharing the port with SO_REUSEPORT'
+    )
+    parser.add_argument(
+        '--state', metavar='PATH',
+        help='persist the registry to PATH.snap and PATH.log and restore it at startup'
+    )
+    args = parser.parse_args()
+    log.configure()
+    store = RegistryStore(args.state) if args.state else None
+    if args.workers > 1:
+        main_workers(args.workers, args.asyncio, store)
+    else:
+        registry = Services(store=store)
+        try:
+            if args.asyncio:
+                main_async(registry)
+            else:
+                main(registry)
+        finally:
+            registry.close()
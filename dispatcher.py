@@ -0,0 +1,216 @@
+"""
+Concurrent dispatch of the requests to the bots.
+Every bot gets its own worker thread, so a bot only ever handles one request
+at a time and in the order they were sent, while different bots work in parallel.
+Notifications are queued without waiting, decisions wait up to a deadline
+and fall back to a default response when the bot is too slow.
+The worker threads are daemon threads: a bot that hangs is abandoned on close
+and doesn't keep the process from exiting.
+"""
+import bisect
+import json
+import queue
+import threading
+import time
+from concurrent.futures import Future, TimeoutError
+
+from log import get_logger
+
+logger = get_logger(__name__)
+
+DEADLINE = 2.0
+# responses used when a bot misses the deadline: play no card, put the kitten on top
+DEFAULT_RESPONSES = {
+    'PLAY': None,
+    'DEFUSE': 0,
+}
+# upper bounds of the latency histogram buckets in seconds, the last one is open
+LATENCY_BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+    0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+)
+
+
+class BotDispatcher:
+    """
+    sends requests to the bots from one worker thread per bot
+    """
+    def __init__(self, bot_list, deadline=DEADLINE, defaults=None):
+        """
+        constructor for the BotDispatcher class
+        :param bot_list: List of Bot objects
+        :param deadline: seconds a decision may take, None waits forever
+        :param defaults: dict action -> response used after a missed deadline
+        """
+        self._deadline = deadline
+        self._defaults = DEFAULT_RESPONSES if defaults is None else defaults
+        self.bots = [DispatchedBot(bot, self) for bot in bot_list]
+
+    def report(self):
+        """
+        logs the latency of every bot
+        :return: None
+        """
+        for bot in self.bots:
+            logger.info('%s: %s', bot.name, bot.latency)
+
+    def close(self):
+        """
+        stops the worker threads once they have handled the queued requests,
+        the threads of hanging bots are abandoned
+        :return: None
+        """
+        for bot in self.bots:
+            bot.close()
+
+
+class DispatchedBot:
+    """
+    stands in for a bot: requests go to the bot's worker thread
+    """
+    def __init__(self, bot, dispatcher):
+        """
+        constructor for the DispatchedBot class
+        :param bot: the Bot object
+        :param dispatcher: the BotDispatcher
+        """
+        self.bot = bot
+        self.name = bot.name
+        self.latency = LatencyHistogram()
+        self._dispatcher = dispatcher
+        self._busy = False
+        self._requests = queue.SimpleQueue()
+        self._thread = threading.Thread(target=self._run, name=f'bot-{bot.name}', daemon=True)
+        self._thread.start()
+
+    def request(self, payload):
+        """
+        sends a request and waits for the response until the deadline
+        :param payload: str the encoded request
+        :return: the response, or the default response of the action if the deadline passed
+        """
+        future = self._submit(payload)
+        try:
+            return future.result(timeout=self._dispatcher._deadline)
+        except TimeoutError:
+            self.latency.timeouts += 1
+            action = _action(payload)
+            logger.warning(
+                'Bot %s missed the deadline of %ss for %s', self.name,
+                self._dispatcher._deadline, action
+            )
+            return self._dispatcher._defaults.get(action)
+
+    def notify(self, payload):
+        """
+        queues a request without waiting for the response
+        :param payload: str the encoded request
+        :return: None
+        """
+        self._submit(payload).add_done_callback(self._check)
+
+    def close(self):
+        """
+        stops the worker thread once it has handled the queued requests
+        """
+        if self._busy:
+            logger.warning('Bot %s is still handling a request, abandoning it', self.name)
+        self._requests.put(None)
+
+    def _submit(self, payload):
+        """
+        queues a request for the worker thread
+        :return: Future of the response
+        """
+        future = Future()
+        self._requests.put((future, payload))
+        return future
+
+    def _run(self):
+        """
+        main loop of the worker thread, runs until close
+        """
+        while True:
+            item = self._requests.get()
+            if item is None:
+                return
+            future, payload = item
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(self._call(payload))
+            except Exception as e:
+                future.set_exception(e)
+
+    def _call(self, payload):
+        """
+        calls the bot and measures the time it took
+        """
+        start = time.perf_counter()
+        self._busy = True
+        try:
+            return self.bot.request(payload)
+        finally:
+            self._busy = False
+            self.latency.record(time.perf_counter() - start)
+
+    def _check(self, future):
+        """
+        logs the exception of a notification
+        """
+        if not future.cancelled() and future.exception() is not None:
+            logger.error('Bot %s failed to handle a notification: %r', self.name, future.exception())
+
+
+class LatencyHistogram:
+    """
+    counts the response times in the buckets of LATENCY_BUCKETS
+    """
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.total = 0.0
+        self.maximum = 0.0
+        self.timeouts = 0
+
+    def record(self, seconds):
+        """
+        adds a response time
+        :param seconds: float
+        """
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.total += seconds
+        self.maximum = max(self.maximum, seconds)
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+    def percentile(self, fraction):
+        """
+        upper bound of the bucket holding the percentile
+        :param fraction: e.g. 0.99
+        :return: seconds, the maximum for the open last bucket, 0.0 without samples
+        """
+        rank = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                return LATENCY_BUCKETS[index] if index < len(LATENCY_BUCKETS) else self.maximum
+        return 0.0
+
+    def __str__(self):
+        count = self.count
+        mean = self.total / count if count else 0.0
+        return (
+            f'{count} requests, mean {mean * 1000:.3f}ms, '
+            f'p50 <= {self.percentile(0.5) * 1000:g}ms, p99 <= {self.percentile(0.99) * 1000:g}ms, '
+            f'max {self.maximum * 1000:.3f}ms, {self.timeouts} timeouts'
+        )
+
+
+def _action(payload):
+    """
+    reads the action of an encoded request, only needed after a missed deadline
+    """
+    return json.loads(payload).get('action')
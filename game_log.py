@@ -0,0 +1,282 @@
+"""
+Binary log of played games and their replay.
+A game is recorded as its seed, the bot order, the result of every
+Arena.take_turn() and the response the engine used for it. Replaying a game
+seeds the global random the same way, runs the real Arena and hands it the
+recorded responses instead of asking the bots, so the engine can be profiled
+on its own and a bad game can be played again exactly.
+The arena must be the only user of the global random during a game,
+a replay that takes another turn than the recorded one raises ReplayError.
+
+File: header '>4sB' (magic, version), then records '>I' (length) followed by
+the record as compact content: [GAME, seed, bot names], [TURN, bot number,
+action, data, response] for every turn and [OVER, ranking] at the end.
+Cards in the data and the responses are stored as {CARD: card type name},
+card types as {CARD_TYPE: name}, and rebuilt when the game is replayed.
+"""
+import argparse
+import mmap
+import os
+import random
+import struct
+import time
+
+import log
+from card import Card, CardType
+from game.arena import Arena
+from serializers import COMPACT
+
+logger = log.get_logger(__name__)
+
+# 2: cards are stored as their card type instead of their string
+VERSION = 2
+MAGIC = b'KGAM'
+HEADER = struct.Struct('>4sB')
+LENGTH = struct.Struct('>I')
+
+GAME = 0
+TURN = 1
+OVER = 2
+
+CARD = '__card__'
+CARD_TYPE = '__card_type__'
+
+
+class ReplayError(Exception):
+    """
+    a replayed game took another course than the recorded one
+    """
+
+
+class GameRecorder:
+    """
+    collects the records of one game, passed to play_game as recorder
+    """
+    def __init__(self, seed, bot_names):
+        """
+        constructor for the GameRecorder class
+        :param seed: the seed of the global random for the game
+        :param bot_names: names of the bots in their seating order
+        """
+        self.data = bytearray()
+        self._append([GAME, seed, list(bot_names)])
+
+    def turn(self, bot_number, action, data, response):
+        """
+        records the result of Arena.take_turn() and the response used for it
+        """
+        self._append([TURN, bot_number, action, _plain(data), _plain(response)])
+
+    def finish(self, ranking):
+        """
+        records the ranking at the end of the game
+        :param ranking: list of the bot names, the winner first
+        """
+        self._append([OVER, list(ranking)])
+
+    def _append(self, record):
+        content = COMPACT.encode(record)
+        self.data += LENGTH.pack(len(content))
+        self.data += content
+
+
+class GameLogWriter:
+    """
+    appends recorded games to a log file
+    """
+    def __init__(self, path):
+        """
+        constructor for the GameLogWriter class
+        :param path: path of the log, it is created if it doesn't exist
+        """
+        self.path = path
+        self._file = open(path, 'ab')
+        if self._file.tell() == 0:
+            self._file.write(HEADER.pack(MAGIC, VERSION))
+
+    def write(self, recorder):
+        """
+        appends a recorded game
+        :param recorder: GameRecorder or the bytes of its records
+        """
+        self._file.write(getattr(recorder, 'data', recorder))
+
+    def close(self):
+        """
+        flushes and closes the file
+        """
+        self._file.close()
+
+
+class LoggedGame:
+    """
+    a game read from a log
+    """
+    __slots__ = ('seed', 'bots', 'turns', 'ranking')
+
+    def __init__(self, seed, bots):
+        self.seed = seed
+        self.bots = bots
+        # lists [bot number, action, data, response]
+        self.turns = []
+        # None if the game was not finished
+        self.ranking = None
+
+
+def read_games(path):
+    """
+    reads the games of a log one at a time, so logs of any size can be streamed
+    :param path: path of the log
+    :return: generator of LoggedGame
+    """
+    with open(path, 'rb') as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            return
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            magic, version = HEADER.unpack_from(data)
+            if magic != MAGIC or version != VERSION:
+                raise ValueError(f'{path} is not a game log.')
+            pos = HEADER.size
+            size = len(data)
+            game = None
+            while pos + LENGTH.size <= size:
+                length, = LENGTH.unpack_from(data, pos)
+                end = pos + LENGTH.size + length
+                if end > size:
+                    break
+                record = COMPACT.decode(data[pos + LENGTH.size:end])
+                pos = end
+                kind = record[0]
+                if kind == TURN:
+                    game.turns.append(record[1:])
+                elif kind == GAME:
+                    if game is not None:
+                        yield game
+                    game = LoggedGame(record[1], record[2])
+                elif kind == OVER:
+                    game.ranking = record[1]
+                    yield game
+                    game = None
+                else:
+                    raise ValueError(f'Unknown record {kind} in {path}.')
+            if pos != size:
+                logger.warning('Ignoring a partial record at the end of %s', path)
+            if game is not None:
+                yield game
+
+
+class ReplayArena(Arena):
+    """
+    Arena that checks every turn against the log and knows its recorded response
+    """
+    def __init__(self, turns):
+        """
+        constructor for the ReplayArena class
+        :param turns: the recorded turns of the game
+        """
+        super().__init__()
+        self._turns = iter(turns)
+        self._number = 0
+        self.response = None
+
+    def take_turn(self):
+        turn = super().take_turn()
+        recorded = next(self._turns, None)
+        bot_number, action, data = turn
+        if recorded is None or recorded[:3] != [bot_number, action, _plain(data)]:
+            raise ReplayError(f'Turn {self._number} is {turn}, the log has {recorded}.')
+        self._number += 1
+        self.response = _rebuild(recorded[3])
+        return turn
+
+    def recorded_response(self, bot, action, data):
+        """
+        used by play_game instead of asking the bot
+        """
+        return self.response
+
+
+class ReplayBot:
+    """
+    stands in for a bot during a replay, it ignores all requests
+    """
+    def __init__(self, name):
+        self.name = name
+
+    def request(self, payload):
+        return None
+
+
+def replay_game(game):
+    """
+    plays a logged game again with the recorded responses
+    :param game: LoggedGame
+    :return: List of the bot names, the winner first
+    """
+    # imported here, main imports this module for the recorder
+    from main import play_game
+
+    random.seed(game.seed)
+    arena = ReplayArena(game.turns)
+    ranking = play_game(
+        [ReplayBot(name) for name in game.bots], arena=arena, decide=arena.recorded_response
+    )
+    if game.ranking is not None and ranking != game.ranking:
+        raise ReplayError(f'The ranking is {ranking}, the log has {game.ranking}.')
+    return ranking
+
+
+def _plain(obj):
+    """
+    converts an object to the types the compact content supports,
+    tuples become lists, cards and card types dicts that _rebuild turns back
+    and other objects their string
+    """
+    if obj is None or isinstance(obj, (str, bool, int, float)):
+        return obj
+    if isinstance(obj, Card):
+        return {CARD: obj.card_type.name}
+    if isinstance(obj, CardType):
+        return {CARD_TYPE: obj.name}
+    if isinstance(obj, (list, tuple)):
+        return [_plain(item) for item in obj]
+    if isinstance(obj, dict):
+        return {key: _plain(value) for key, value in obj.items()}
+    return str(obj)
+
+
+def _rebuild(obj):
+    """
+    turns the cards and card types that _plain stored back into objects
+    """
+    if isinstance(obj, list):
+        return [_rebuild(item) for item in obj]
+    if isinstance(obj, dict):
+        if len(obj) == 1:
+            if CARD in obj:
+                return Card(CardType[obj[CARD]])
+            if CARD_TYPE in obj:
+                return CardType[obj[CARD_TYPE]]
+        return {key: _rebuild(value) for key, value in obj.items()}
+    return obj
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='replay the games of a game log')
+    parser.add_argument('path', help='path of the game log')
+    args = parser.parse_args()
+    log.configure()
+    count = failed = 0
+    start = time.perf_counter()
+    for logged_game in read_games(args.path):
+        count += 1
+        try:
+            replay_game(logged_game)
+        except ReplayError as e:
+            failed += 1
+            logger.error('Game with seed %s: %s', logged_game.seed, e)
+    seconds = time.perf_counter() - start
+    logger.info(
+        'Replayed %d games in %.2fs, %.1f games/s, %d failed',
+        count, seconds, count / seconds if seconds else 0.0, failed
+    )
@@ -0,0 +1,187 @@
+"""
+Encodes and decodes message headers.
+Two formats share the wire and are told apart by the first byte:
+ - JSON header: 2 byte big-endian length followed by a JSON object
+ - binary header: 0xFF magic byte followed by a fixed-size struct
+"""
+import struct
+import sys
+
+from serializers import COMPACT_CONTENT_TYPE, JSON, JSON_CONTENT_TYPE, TEXT_CONTENT_TYPE
+
+JSON_HEADER = 'json'
+BINARY_HEADER = 'binary'
+
+PROTOHEADER = struct.Struct('>H')
+# magic, version, content-type, content-encoding, flags, content-length, request-id
+BINARY_STRUCT = struct.Struct('>BBBBBII')
+BINARY_MAGIC = 0xFF
+BINARY_VERSION = 1
+# JSON header lengths must never start with the magic byte
+MAX_JSON_HEADER_LEN = (BINARY_MAGIC << 8) - 1
+
+FLAG_KEEP_ALIVE = 0x01
+FLAG_LITTLE_ENDIAN = 0x02
+FLAG_REQUEST_ID = 0x04
+
+# append only: the position of a content-type is its code on the wire
+CONTENT_TYPES = (
+    JSON_CONTENT_TYPE,
+    TEXT_CONTENT_TYPE,
+    'binary/custom-client-binary-type',
+    'binary/custom-server-binary-type',
+    COMPACT_CONTENT_TYPE,
+)
+CONTENT_ENCODINGS = (
+    'utf-8',
+    'binary',
+)
+_CONTENT_TYPE_CODES = {name: code for code, name in enumerate(CONTENT_TYPES, 1)}
+_CONTENT_ENCODING_CODES = {name: code for code, name in enumerate(CONTENT_ENCODINGS, 1)}
+
+REQUIRED_HEADERS = (
+    'byteorder',
+    'content-length',
+    'content-type',
+    'content-encoding',
+)
+
+
+def encode_header(header, header_format=JSON_HEADER):
+    """
+    encodes a header, including the prefix that identifies its format.
+    Headers that do not fit the binary format fall back to JSON.
+    :param header: dict with the header fields
+    :param header_format: JSON_HEADER or BINARY_HEADER
+    :return: bytes
+    """
+    if header_format == BINARY_HEADER:
+        encoded = _encode_binary(header)
+        if encoded is not None:
+            return encoded
+    return _encode_json(header)
+
+
+def decode_header(buffer):
+    """
+    decodes the next header from a receive buffer and consumes it
+    :param buffer: RecvBuffer
+    :return: tuple (header_format, header) or None if the header is incomplete
+    """
+    if len(buffer) < PROTOHEADER.size:
+        return None
+    prefix = buffer.unpack(PROTOHEADER)[0]
+    if prefix >> 8 == BINARY_MAGIC:
+        return _decode_binary(buffer)
+    return _decode_json(buffer, prefix)
+
+
+def _encode_json(header):
+    """
+    encodes the header as length prefixed JSON
+    :param header: dict with the header fields
+    :return: bytes
+    """
+    header_bytes = JSON.encode(header, 'utf-8')
+    if len(header_bytes) > MAX_JSON_HEADER_LEN:
+        raise ValueError(f'JSON header too long ({len(header_bytes)} bytes).')
+    return PROTOHEADER.pack(len(header_bytes)) + header_bytes
+
+
+def _decode_json(buffer, header_len):
+    """
+    decodes a length prefixed JSON header
+    :param buffer: RecvBuffer
+    :param header_len: length of the JSON header
+    :return: tuple (JSON_HEADER, header) or None
+    """
+    if len(buffer) < PROTOHEADER.size + header_len:
+        return None
+    buffer.consume(PROTOHEADER.size)
+    with buffer.peek(header_len) as data:
+        header = JSON.decode(data, 'utf-8')
+    buffer.consume(header_len)
+    for reqhdr in REQUIRED_HEADERS:
+        if reqhdr not in header:
+            raise ValueError(f'Missing required header "{reqhdr}".')
+    return JSON_HEADER, header
+
+
+def _encode_binary(header):
+    """
+    packs the header into the fixed-size binary struct
+    :param header: dict with the header fields
+    :return: bytes or None if the header can't be represented
+    """
+    content_type = _CONTENT_TYPE_CODES.get(header['content-type'])
+    content_encoding = _CONTENT_ENCODING_CODES.get(header['content-encoding'])
+    if content_type is None or content_encoding is None:
+        return None
+    flags = 0
+    if header.get('keep-alive'):
+        flags |= FLAG_KEEP_ALIVE
+    if header['byteorder'] == 'little':
+        flags |= FLAG_LITTLE_ENDIAN
+    request_id = header.get('request-id')
+    if request_id is not None:
+        flags |= FLAG_REQUEST_ID
+    try:
+        return BINARY_STRUCT.pack(
+            BINARY_MAGIC,
+            BINARY_VERSION,
+            content_type,
+            content_encoding,
+            flags,
+            header['content-length'],
+            request_id or 0,
+        )
+    except struct.error:
+        return None
+
+
+def _decode_binary(buffer):
+    """
+    unpacks a binary header
+    :param buffer: RecvBuffer
+    :return: tuple (BINARY_HEADER, header) or None
+    """
+    if len(buffer) < BINARY_STRUCT.size:
+        return None
+    _, version, content_type, content_encoding, flags, length, request_id = \
+        buffer.unpack(BINARY_STRUCT)
+    if version != BINARY_VERSION:
+        raise ValueError(f'Unsupported binary header version {version}.')
+    if not 0 < content_type <= len(CONTENT_TYPES) or \
+            not 0 < content_encoding <= len(CONTENT_ENCODINGS):
+        raise ValueError('Unknown content-type or content-encoding code.')
+    header = {
+        'byteorder': 'little' if flags & FLAG_LITTLE_ENDIAN else 'big',
+        'content-type': CONTENT_TYPES[content_type - 1],
+        'content-encoding': CONTENT_ENCODINGS[content_encoding - 1],
+        'content-length': length,
+    }
+    buffer.consume(BINARY_STRUCT.size)
+    if flags & FLAG_KEEP_ALIVE:
+        header['keep-alive'] = True
+    if flags & FLAG_REQUEST_ID:
+        header['request-id'] = request_id
+    return BINARY_HEADER, header
+
+
+def create_header(content_length, content_type, content_encoding,
+                  request_id=None, keep_alive=False):
+    """
+    builds the header fields for a message
+    :return: dict
+    """
+    header = {
+        'byteorder': sys.byteorder,
+        'content-type': content_type,
+        'content-encoding': content_encoding,
+        'content-length': content_length,
+    }
+    if request_id is not None:
+        header['request-id'] = request_id
+    if keep_alive:
+        header['keep-alive'] = True
+    return header
@@ -0,0 +1,373 @@
+"""
+Load generator for the discovery service.
+Simulates many bots on loopback, each with its own keep-alive connection: a bot
+registers with MEOW and then sends a mix of MEOW, HEARTBEAT and query requests
+with Poisson arrivals at a target rate. The latency is measured from the time a
+request was due, not from the time it was sent, so a server that falls behind
+shows up in the percentiles instead of slowing the bots down (coordinated omission).
+A monitor connection polls the stats action of the server for its open
+connections, send queues and loop lag. With several rates the load is raised
+step by step until the server no longer keeps up: the saturation point.
+The server's stats come from the process that accepted the monitor connection,
+with --workers they cover that worker only.
+"""
+import argparse
+import asyncio
+import random
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+
+import log
+from async_message import AsyncClientMessage
+from header_codec import BINARY_HEADER, JSON_HEADER
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+logger = log.get_logger(__name__)
+
+HOST = '127.0.0.1'
+PORT = 65432
+OPERATIONS = ('MEOW', 'HEARTBEAT', 'query')
+DEFAULT_MIX = 'MEOW=1,HEARTBEAT=8,query=1'
+# seconds a request may take before it counts as an error and the bot reconnects
+REQUEST_TIMEOUT = 5.0
+RECONNECT_DELAY = 0.1
+STATS_INTERVAL = 1.0
+# a stage is saturated when less than this part of the requests that came due is answered
+SATURATION_RATIO = 0.9
+PERCENTILES = (0.5, 0.99, 0.999)
+
+
+class Results:
+    """
+    latencies and errors of the simulated bots, mergeable across processes
+    """
+    def __init__(self):
+        self.latencies = {operation: array('d') for operation in OPERATIONS}
+        self.errors = {}
+        # requests that came due, answered or not
+        self.due = 0
+
+    def record(self, operation, seconds):
+        self.latencies[operation].append(seconds)
+
+    def error(self, kind):
+        self.errors[kind] = self.errors.get(kind, 0) + 1
+
+    def merge(self, other):
+        """
+        adds the results of another process
+        :param other: Results
+        """
+        for operation, latencies in other.latencies.items():
+            self.latencies[operation].extend(latencies)
+        for kind, count in other.errors.items():
+            self.errors[kind] = self.errors.get(kind, 0) + count
+        self.due += other.due
+
+    @property
+    def count(self):
+        return sum(len(latencies) for latencies in self.latencies.values())
+
+    def percentiles(self, operation=None):
+        """
+        :param operation: one of OPERATIONS, None for all requests
+        :return: list of seconds for PERCENTILES, empty without samples
+        """
+        if operation is None:
+            latencies = [s for samples in self.latencies.values() for s in samples]
+        else:
+            latencies = self.latencies[operation]
+        if not latencies:
+            return []
+        ordered = sorted(latencies)
+        return [ordered[min(len(ordered) - 1, int(p * len(ordered)))] for p in PERCENTILES]
+
+
+def parse_mix(text):
+    """
+    :param text: weights like 'MEOW=1,HEARTBEAT=8,query=1'
+    :return: dict operation -> weight
+    """
+    mix = {}
+    for part in text.split(','):
+        operation, _, weight = part.partition('=')
+        operation = operation.strip()
+        if operation not in OPERATIONS:
+            raise ValueError(f'Unknown operation {operation}, expected one of {OPERATIONS}.')
+        mix[operation] = float(weight or 1)
+    if not any(mix.values()):
+        raise ValueError('The mix needs a positive weight.')
+    return mix
+
+
+def raise_file_limit(needed):
+    """
+    raises the soft limit of open files up to the hard limit, every bot needs a socket
+    :param needed: number of file descriptors
+    """
+    if resource is None:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != resource.RLIM_INFINITY and soft < needed:
+        target = needed if hard == resource.RLIM_INFINITY else min(needed, hard)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (target, hard))
+        if target < needed:
+            logger.warning('Only %d open files allowed, %d needed', target, needed)
+
+
+async def simulated_bot(number, host, port, mix, rate, start, end, results,
+                        types=100, header_format=JSON_HEADER):
+    """
+    one bot: registers, then sends requests until end, reconnects after an error.
+    The arrivals keep their schedule across reconnects, requests that came due
+    while the bot reconnected are sent late or counted as missed at the end.
+    :param number: number of the bot, used for its service type, port and random
+    :param mix: dict operation -> weight
+    :param rate: requests per second of this bot
+    :param start: loop time to connect at
+    :param end: loop time to stop at
+    :param results: Results to record into
+    :param types: number of service types the bots are spread over
+    """
+    loop = asyncio.get_running_loop()
+    rng = random.Random(number)
+    operations = list(mix)
+    weights = list(mix.values())
+    service = {'type': f'loadgen-{number % types}', 'ip': HOST, 'port': 10000 + number % 50000}
+    await asyncio.sleep(max(0.0, start - loop.time()))
+    due = loop.time()
+    while loop.time() < end:
+        try:
+            client = await AsyncClientMessage.connect(host, port, header_format)
+        except OSError:
+            results.error('connect')
+            await asyncio.sleep(RECONNECT_DELAY)
+            continue
+        try:
+            uuid = await client.request(
+                {'action': 'MEOW', **service}, timeout=REQUEST_TIMEOUT
+            )
+            while True:
+                due += rng.expovariate(rate)
+                if due >= end:
+                    return
+                results.due += 1
+                if loop.time() >= end:
+                    # came due, but the bot is too far behind to send it
+                    continue
+                delay = due - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                operation = rng.choices(operations, weights)[0]
+                if operation == 'MEOW':
+                    request = {'action': 'MEOW', **service}
+                elif operation == 'HEARTBEAT':
+                    request = {'action': 'HEARTBEAT', 'uuid': uuid}
+                else:
+                    request = {'action': 'query', 'type': service['type']}
+                response = await client.request(request, timeout=REQUEST_TIMEOUT)
+                results.record(operation, loop.time() - due)
+                if operation == 'MEOW':
+                    uuid = response
+        except asyncio.TimeoutError:
+            results.error('timeout')
+        except OSError:
+            # ConnectionError included
+            results.error('connection')
+        finally:
+            client.close()
+    # no connection until the end, the arrivals since the last one were missed
+    while True:
+        due += rng.expovariate(rate)
+        if due >= end:
+            return
+        results.due += 1
+
+
+async def run_bots(first, count, host, port, mix, rate, duration, ramp, types, header_format):
+    """
+    runs the bots first .. first + count - 1 in this process
+    :param ramp: seconds over which the bots connect
+    :return: Results
+    """
+    results = Results()
+    loop = asyncio.get_running_loop()
+    now = loop.time()
+    end = now + ramp + duration
+    await asyncio.gather(*(
+        simulated_bot(
+            number, host, port, mix, rate, now + ramp * (number - first) / count, end,
+            results, types, header_format
+        )
+        for number in range(first, first + count)
+    ))
+    return results
+
+
+def run_process(first, count, *args):
+    """
+    entry point of a generator process, see run_bots
+    """
+    raise_file_limit(count + 64)
+    return asyncio.run(run_bots(first, count, *args))
+
+
+async def monitor(host, port, interval, stop, samples):
+    """
+    polls the stats action of the server until stop is set
+    :param stop: asyncio.Event
+    :param samples: list to append the tuples (seconds since the start, stats) to
+    """
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    try:
+        client = await AsyncClientMessage.connect(host, port)
+    except OSError as e:
+        logger.warning('No server stats: %r', e)
+        return
+    previous = None
+    try:
+        while not stop.is_set():
+            try:
+                await asyncio.wait_for(stop.wait(), interval)
+            except asyncio.TimeoutError:
+                pass
+            try:
+                stats = await client.request({'action': 'stats'}, timeout=REQUEST_TIMEOUT)
+            except (asyncio.TimeoutError, OSError) as e:
+                logger.warning('Server stats failed: %r', e)
+                return
+            if not isinstance(stats, dict) or not stats:
+                logger.warning('The server does not answer the stats action')
+                return
+            samples.append((loop.time() - start, stats))
+            if previous is not None:
+                rate = (stats['requests'] - previous['requests']) / (stats['uptime'] - previous['uptime'])
+                logger.info(
+                    'server: %d connections, %.0f requests/s, send queue %d bytes (max %d), '
+                    'lag max %.1fms, %d errors',
+                    stats['connections'], rate, stats['send_queued'], stats['send_queued_max'],
+                    stats['lag_max'] * 1000, stats['errors']
+                )
+            previous = stats
+    finally:
+        client.close()
+
+
+async def run_stage(host, port, mix, rate, bots, duration, ramp, processes, types,
+                    header_format):
+    """
+    runs one load stage with the bots spread over the processes and a monitor
+    :return: tuple (Results, list of server stats samples, seconds the load ran)
+    """
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    stop = asyncio.Event()
+    samples = []
+    watch = loop.create_task(monitor(host, port, STATS_INTERVAL, stop, samples))
+    results = Results()
+    args = (host, port, mix, rate, duration, ramp, types, header_format)
+    try:
+        if processes > 1:
+            share = -(-bots // processes)
+            with ProcessPoolExecutor(max_workers=processes) as executor:
+                parts = await asyncio.gather(*(
+                    loop.run_in_executor(
+                        executor, run_process, first, min(share, bots - first), *args
+                    )
+                    for first in range(0, bots, share)
+                ))
+            for part in parts:
+                results.merge(part)
+        else:
+            results = await run_bots(0, bots, *args)
+    finally:
+        stop.set()
+        await watch
+    return results, samples, loop.time() - start
+
+
+def report(results, samples, seconds):
+    """
+    logs throughput, latency percentiles, errors and the growth of the server's queues
+    :param seconds: time the stage ran
+    :return: None
+    """
+    logger.info(
+        '%d requests due, %d answered in %.1fs, %.0f requests/s',
+        results.due, results.count, seconds, results.count / seconds
+    )
+    for operation in (None,) + OPERATIONS:
+        percentiles = results.percentiles(operation)
+        if not percentiles:
+            continue
+        count = results.count if operation is None else len(results.latencies[operation])
+        logger.info(
+            '%-9s %8d requests, %8.0f/s, p50 %7.2fms, p99 %7.2fms, p999 %7.2fms',
+            operation or 'all', count, count / seconds, *(p * 1000 for p in percentiles)
+        )
+    if results.errors:
+        logger.warning('errors: %s', ', '.join(f'{k} {v}' for k, v in sorted(results.errors.items())))
+    if samples:
+        first, last = samples[0][1], samples[-1][1]
+        logger.info(
+            'server: send queue %d -> %d bytes (max %d), max %d ready events, max lag %.1fms',
+            first['send_queued'], last['send_queued'],
+            max(stats['send_queued_max'] for _, stats in samples),
+            max(stats['ready_max'] for _, stats in samples),
+            max(stats['lag_max'] for _, stats in samples) * 1000
+        )
+
+
+def main(host, port, bots, rates, mix, duration, ramp, processes=1, types=100,
+         header_format=JSON_HEADER):
+    """
+    runs a stage for every rate, in order, and stops at the first saturated one
+    :param rates: requests per second of every bot, one stage each
+    :return: the offered load of the saturated stage, None if the server kept up
+    """
+    raise_file_limit(bots + 64)
+    for rate in rates:
+        offered = bots * rate
+        logger.info(
+            'stage: %d bots at %g requests/s each, %.0f requests/s offered, mix %s',
+            bots, rate, offered, mix
+        )
+        results, samples, seconds = asyncio.run(run_stage(
+            host, port, mix, rate, bots, duration, ramp, processes, types, header_format
+        ))
+        report(results, samples, seconds)
+        if results.count < SATURATION_RATIO * results.due or results.errors:
+            logger.info('saturated at %.0f offered requests/s', offered)
+            return offered
+    logger.info('not saturated up to %.0f requests/s', bots * rates[-1])
+    return None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='load generator for the discovery service')
+    parser.add_argument('--host', default=HOST, help='host of the discovery service')
+    parser.add_argument('--port', type=int, default=PORT, help='port of the discovery service')
+    parser.add_argument('--bots', type=int, default=1000, help='number of simulated bots')
+    parser.add_argument(
+        '--rate', default='1', metavar='RATES',
+        help='requests per second of every bot, several comma separated rates run '
+             'one stage each until the server saturates'
+    )
+    parser.add_argument('--mix', default=DEFAULT_MIX, help='weights of the operations')
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds of full load per stage')
+    parser.add_argument('--ramp', type=float, default=2.0, help='seconds over which the bots connect')
+    parser.add_argument('--processes', type=int, default=1, help='number of generator processes')
+    parser.add_argument('--types', type=int, default=100, help='number of service types')
+    parser.add_argument('--binary', action='store_true', help='use the binary header')
+    args = parser.parse_args()
+    log.configure()
+    main(
+        args.host, args.port, args.bots, [float(r) for r in args.rate.split(',')],
+        parse_mix(args.mix), args.duration, args.ramp, args.processes, args.types,
+        BINARY_HEADER if args.binary else JSON_HEADER
+    )
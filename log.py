@@ -0,0 +1,121 @@
+"""
+Leveled logging for the networking and game code.
+Records are handed to a queue unformatted and formatted and written by a
+background thread, so neither formatting nor a slow stdout blocks an event loop.
+Payloads are wrapped in Truncated, which only formats them if the record is
+actually emitted. The arguments of a record are formatted later, so they must
+not be changed after they were logged.
+"""
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+
+ROOT_LOGGER = 'kittenbot'
+DEFAULT_LEVEL = 'INFO'
+MAX_PAYLOAD = 200
+
+DEBUG = logging.DEBUG
+INFO = logging.INFO
+WARNING = logging.WARNING
+ERROR = logging.ERROR
+
+_listener = None
+
+
+def get_logger(name):
+    """
+    returns the logger for a module
+    :param name: the module name
+    :return: logging.Logger
+    """
+    return logging.getLogger(f'{ROOT_LOGGER}.{name}')
+
+
+def configure(level=None, sample_rate=None, stream=None):
+    """
+    routes all kittenbot loggers through a queue to a background writer thread.
+    Level and sample rate default to the environment variables
+    KITTENBOT_LOG_LEVEL and KITTENBOT_LOG_SAMPLE.
+    :param level: level name or number
+    :param sample_rate: fraction of DEBUG and INFO records to keep, 1.0 keeps all
+    :param stream: where to write, defaults to stdout
+    :return: None
+    """
+    global _listener
+    shutdown()
+    if level is None:
+        level = os.environ.get('KITTENBOT_LOG_LEVEL', DEFAULT_LEVEL)
+    if sample_rate is None:
+        sample_rate = float(os.environ.get('KITTENBOT_LOG_SAMPLE', 1.0))
+
+    records = queue.SimpleQueue()
+    writer = logging.StreamHandler(stream or sys.stdout)
+    writer.setFormatter(logging.Formatter('%(message)s'))
+    _listener = logging.handlers.QueueListener(records, writer)
+    _listener.start()
+
+    handler = DeferredQueueHandler(records)
+    if sample_rate < 1.0:
+        handler.addFilter(SampleFilter(sample_rate))
+    root = logging.getLogger(ROOT_LOGGER)
+    root.handlers = [handler]
+    root.setLevel(level)
+    root.propagate = False
+
+
+def shutdown():
+    """
+    flushes the queue and stops the background writer
+    :return: None
+    """
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    queues the records as they are, the handlers of the listener format them
+    """
+    def prepare(self, record):
+        return record
+
+
+class SampleFilter(logging.Filter):
+    """
+    keeps a random fraction of the records below WARNING
+    """
+    def __init__(self, rate):
+        super().__init__()
+        self._rate = rate
+
+    def filter(self, record):
+        return record.levelno >= WARNING or random.random() < self._rate
+
+
+class Truncated:
+    """
+    formats a payload lazily, cut off after limit characters
+    """
+    __slots__ = ('_payload', '_limit')
+
+    def __init__(self, payload, limit=MAX_PAYLOAD):
+        self._payload = payload
+        self._limit = limit
+
+    def __str__(self):
+        payload = self._payload
+        if isinstance(payload, (bytes, bytearray, memoryview)) and len(payload) > self._limit:
+            return f'{bytes(payload[:self._limit])!r}... ({len(payload)} bytes)'
+        text = repr(payload)
+        if len(text) > self._limit:
+            return f'{text[:self._limit]}... ({len(text)} chars)'
+        return text
+
+
+atexit.register(shutdown)
@@ -1,60 +1,135 @@
 """ Main logic for the application. """
+import argparse
 import importlib
-import json
 import os
 import random
-from typing import List
+from typing import TYPE_CHECKING, List, Optional
 
-from game.arena import Arena
-from game.bot import Bot
+import log
+from log import Truncated
+from bot_workers import BotWorkerPool
+from dispatcher import BotDispatcher
+from profiling import profiler
+from serializers import JSON_CONTENT_TYPE, get_serializer
 
+BOT_CONTENT_TYPE = JSON_CONTENT_TYPE
+# send the events of a turn as one EVENTS request per bot instead of one INFORM per event,
+# only for bots that understand EVENTS
+BATCH_EVENTS = False
+# seconds a bot may take for a decision before its default response is used
+BOT_DEADLINE = 2.0
 
-def main():
-    bot_list = load_bots('bots')
+logger = log.get_logger(__name__)
+
+# the game package is imported where an Arena is created, so the loop can be
+# played with another arena, e.g. the stub arena of the benchmarks
+if TYPE_CHECKING:
+    from game.arena import Arena
+    from game.bot import Bot
+
+
+def main(seed: Optional[int] = None, record: Optional[str] = None, processes: bool = False):
+    """
+    Play one game with the bots of the bots directory.
+    :param seed: seed of the global random and the seating order, random if None
+    :param record: path of a game log to append the game to
+    :param processes: run every bot in its own worker process instead of a thread
+    """
+    from game_log import GameLogWriter, GameRecorder
+
+    if seed is None:
+        seed = random.randrange(2 ** 32)
+    logger.info('Seed %d', seed)
+    random.seed(seed)
+    if processes:
+        runner = BotWorkerPool(bot_classes('bots'), deadline=BOT_DEADLINE)
+        bot_list = runner.bots(random.Random(seed))
+    else:
+        runner = BotDispatcher(load_bots('bots', random.Random(seed)), deadline=BOT_DEADLINE)
+        bot_list = runner.bots
+    recorder = GameRecorder(seed, [bot.name for bot in bot_list]) if record else None
+    profiler.install_signals()
+    try:
+        play_game(bot_list, recorder=recorder)
+    finally:
+        profiler.stop()
+        runner.report()
+        runner.close()
+        if recorder is not None:
+            # unfinished games are written as well, they can be replayed up to the failure
+            writer = GameLogWriter(record)
+            writer.write(recorder)
+            writer.close()
+
+
+def play_game(bot_list: List, arena: Optional['Arena'] = None, recorder=None,
+              decide=None) -> List[str]:
+    """
+    Play one game with the bots.
+    :param bot_list: List of Bot, DispatchedBot or RemoteBot objects
+    :param arena: Arena object, a new one if None
+    :param recorder: GameRecorder that records the turns and the ranking
+    :param decide: callable(bot, action, data) -> response used for the decisions
+                   instead of send_request, a replay uses the recorded responses
+    :return: List of the bot names, the winner first
+    """
     alive_count = len(bot_list)
-    arena = Arena()
+    if arena is None:
+        from game.arena import Arena
+        arena = Arena()
+    decide = decide or send_request
     start_round(arena, bot_list)
+    events = [] if BATCH_EVENTS else None
 
-    print('----------- Game Start -----------')
+    logger.info('----------- Game Start -----------')
     save_bot = -1
     while alive_count > 1:
-        bot_number, action, data = arena.take_turn()
+        with profiler.span('Arena.take_turn'):
+            bot_number, action, data = arena.take_turn()
         active_bot = bot_list[bot_number]
         if bot_number != save_bot:
-            print(f'Active bot: {active_bot.name}')
+            logger.debug('Active bot: %s', active_bot.name)
             save_bot = bot_number
-        print(f'  - Action={action} / Data={data}')
+        logger.debug('  - Action=%s / Data=%s', action, Truncated(data))
         if action == 'PLAY':
-            response = send_request(active_bot, action, data)
+            response = decide(active_bot, action, data)
         elif action == 'DRAW':
             if data == 'EXPLODING_KITTEN':
                 response = None
             else:
-                response = send_request(active_bot, 'DRAW', {'card': data})
-            print(f'=> {arena.read_hand(bot_number)}')
-            inform_bots(active_bot.name, bot_list, 'DRAW', None)
+                response = decide(active_bot, 'DRAW', {'card': data})
+            if logger.isEnabledFor(log.DEBUG):
+                logger.debug('=> %s', Truncated(arena.read_hand(bot_number)))
+            inform_bots(active_bot.name, bot_list, 'DRAW', None, events)
         elif action == 'DEFUSE':
-            response = send_request(active_bot, 'DEFUSE', {'decksize': arena.deck_size})
-            print(f'  => Bot {active_bot.name} defused the exploding kitten')
-            inform_bots(active_bot.name, bot_list, 'DEFUSE', '')
+            response = decide(active_bot, 'DEFUSE', {'decksize': arena.deck_size})
+            logger.info('  => Bot %s defused the exploding kitten', active_bot.name)
+            inform_bots(active_bot.name, bot_list, 'DEFUSE', '', events)
         elif action == 'EXPLODE':
-            response = send_request(active_bot, 'EXPLODE', None)
-            print(f'  => Bot {active_bot.name} exploded')
+            response = decide(active_bot, 'EXPLODE', None)
+            logger.info('  => Bot %s exploded', active_bot.name)
             alive_count -= 1
-            inform_bots(active_bot.name, bot_list, 'EXPLODE', '')
+            inform_bots(active_bot.name, bot_list, 'EXPLODE', '', events)
         elif action == 'FUTURE':
-            response = send_request(active_bot, 'FUTURE', {'cards': data})
+            response = decide(active_bot, 'FUTURE', {'cards': data})
         elif action == 'NEXTBOT':
             response = None
             # input('Press Enter to continue...')
-        print(f'  - Response={response}')
+        logger.debug('  - Response=%s', Truncated(response))
+        if recorder is not None:
+            recorder.turn(bot_number, action, data, response)
         if arena.analyze_turn(response):
-            inform_bots(active_bot.name, bot_list, action, response)
+            inform_bots(active_bot.name, bot_list, action, response, events)
+        if events:
+            flush_events(bot_list, events)
 
-    finish_round(bot_list, arena)
+    ranking = finish_round(bot_list, arena)
+    if recorder is not None:
+        recorder.finish(ranking)
+    return ranking
 
 
-def give_cards(arena: Arena, bot_list: List) -> None:
+def give_cards(arena: 'Arena', bot_list: List) -> None:
     """
     Give cards to the bots in the list.
     :param arena: Arena object
@@ -69,13 +144,25 @@ def give_cards(arena: Arena, bot_list: List) -> None:
         active_bot += 1
 
 
-def load_bots(directory: str) -> List[Bot]:
+def load_bots(directory: str, rng: Optional[random.Random] = None) -> List['Bot']:
     """
     Load all bots from a directory.
     :param directory:
+    :param rng: random.Random for the seating order, defaults to the global random
     :return:
     """
-    bots = []
+    bots = [bot_class(name) for name, bot_class in bot_classes(directory)]
+    (rng or random).shuffle(bots)
+    return bots
+
+
+def bot_classes(directory: str) -> List[tuple]:
+    """
+    Find the bot classes in a directory, a module holds the class of the same name.
+    :param directory:
+    :return: List of tuples (module name, bot class)
+    """
+    classes = []
     for filename in os.listdir(directory):
         if filename.endswith('.py') and \
                 filename != '__init__.py' and \
@@ -85,11 +172,8 @@ def load_bots(directory: str) -> List[Bot]:
             for attr_name in dir(module):
                 attr = getattr(module, attr_name)
                 if isinstance(attr, type) and attr_name.lower() == module_name:
-                    bot_instance = attr(module_name)
-                    bots.append(bot_instance)
-
-    random.shuffle(bots)
-    return bots
+                    classes.append((module_name, attr))
+    return classes
 
 
 def start_round(arena, bot_list):
@@ -115,66 +199,110 @@ def start_round(arena, bot_list):
             )
 
     ''' Inform all the bots that the round has started. '''
-    for bot in bot_list:
-        send_request(bot, 'START', data)
+    broadcast(bot_list, 'START', data)
 
 
-def finish_round(bot_list: List[Bot], arena: Arena) -> None:
+def finish_round(bot_list: List['Bot'], arena: 'Arena') -> List[str]:
     """
     Finish the round.
     :param bot_list: List of Bot objects
     :param arena: Arena object
-    :return: None
+    :return: List of the bot names, the winner first
     """
-    print('----------- Game Over -----------')
+    logger.info('----------- Game Over -----------')
 
     ranking = []
     rank = 1
     for bot_number in arena.ranking:
-        print(f'{rank}. {bot_list[bot_number].name}')
+        logger.info('%d. %s', rank, bot_list[bot_number].name)
         ranking.append(bot_list[bot_number].name)
         rank += 1
 
     ''' Inform all the bots that the round has ended. '''
-    for bot in bot_list:
-        send_request(bot, 'OVER', {'ranks': ranking})
+    broadcast(bot_list, 'OVER', {'ranks': ranking})
+    return ranking
 
 
 
-def inform_bots(botname, bot_list: List[Bot], action: str, response: str) -> None:
+def inform_bots(botname, bot_list: List['Bot'], action: str, response: str,
+                events: Optional[List[dict]] = None) -> None:
     """
     Inform all the bots of the action that just occurred.
     :param botname: str The name of the bot who took the action
     :param bot_list: List of Bot objects
     :param action: str action
     :param response: str the response from the bot
+    :param events: list collecting the events of the turn, None sends them right away
+    :return: None
+    """
+    data = {
+        'botname': botname,
+        'event': action,
+        'data': response,
+    }
+    if events is not None:
+        events.append(data)
+    else:
+        broadcast(bot_list, 'INFORM', data)
+
+
+def flush_events(bot_list: List['Bot'], events: List[dict]) -> None:
+    """
+    Send the events collected during a turn to all the bots in one EVENTS request.
+    :param bot_list: List of Bot objects
+    :param events: list of the events, emptied afterwards
     :return: None
     """
+    broadcast(bot_list, 'EVENTS', {'events': events})
+    events.clear()
 
+
+def broadcast(bot_list: List['Bot'], action: str, data: dict) -> None:
+    """
+    Send the same request to all the bots, it is encoded only once.
+    Dispatched bots get it queued without waiting for their responses.
+    :param bot_list: List of Bot objects or DispatchedBot objects
+    :param action: str action
+    :param data: dict data
+    :return: None
+    """
+    payload = encode_request(action, data)
     for bot in bot_list:
-        data = {
-            'botname': botname,
-            'event': action,
-            'data': response,
-        }
-        # bot.inform(botname, action, response)
-        send_request(bot, 'INFORM', data)
+        notify = getattr(bot, 'notify', None)
+        if notify is not None:
+            notify(payload)
+        else:
+            bot.request(payload)
 
 
-def send_request(bot: Bot, action: str, data: dict) -> str:
+def send_request(bot: 'Bot', action: str, data: dict) -> str:
     """
     Send a request to a bot.
     :param bot: Bot object
     :param action: str action
-    :param data: str data
+    :param data: dict data, it is not modified
     :return: str response
     """
-    if data is None:
-        data = {}
-    data['action'] = action
+    return bot.request(encode_request(action, data))
 
-    return bot.request(json.dumps(data))
+
+def encode_request(action: str, data: Optional[dict]) -> str:
+    """
+    Encode a request for the bots.
+    :param action: str action
+    :param data: dict data, it is not modified
+    :return: str the encoded request, immutable so it can be shared by all bots
+    """
+    return get_serializer(BOT_CONTENT_TYPE).dumps({**(data or {}), 'action': action})
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='play one game with the bots')
+    parser.add_argument('--seed', type=int, default=None, help='seed of the game')
+    parser.add_argument('--record', metavar='PATH', default=None,
+                        help='append the game to this game log')
+    parser.add_argument('--processes', action='store_true',
+                        help='run every bot in its own worker process')
+    args = parser.parse_args()
+    log.configure()
+    main(args.seed, args.record, args.processes)
\ No newline at end of file
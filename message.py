@@ -1,25 +1,47 @@
 """ Provides the Message class for the server and client classes to inherit from. """
-import io
-import json
+import collections
+import itertools
 import selectors
-import struct
-import sys
+import time
+
+from header_codec import JSON_HEADER, create_header, decode_header, encode_header
+from log import DEBUG, Truncated, get_logger
+from recv_buffer import RecvBuffer
+from serializers import JSON, decode, encode
+
+logger = get_logger(__name__)
+
+# the producer should pause above HIGH_WATERMARK queued bytes and may resume below LOW_WATERMARK
+HIGH_WATERMARK = 256 * 1024
+LOW_WATERMARK = 64 * 1024
+# peers that let more than MAX_SEND_QUEUE bytes pile up or stay paused longer are disconnected
+MAX_SEND_QUEUE = 4 * 1024 * 1024
+SLOW_PEER_TIMEOUT = 10
+# buffers handed to one sendmsg call
+MAX_IOV = 512
 
 
 class Message:
     """
     constructor for super-class
     """
-    def __init__(self, selector, socket, ipaddr):
+    def __init__(self, selector, socket, ipaddr, header_format=JSON_HEADER):
         self._selector = selector
         self._socket = socket
         self._ipaddr = ipaddr
         self._event = ''
-        self._recv_buffer = b''
-        self._send_buffer = b''
+        self._recv_buffer = RecvBuffer()
+        self._send_queue = collections.deque()
+        self._send_queued = 0
+        self._paused_since = None
+        self.on_resume = None
         self._request = None
-        self._jsonheader_len = None
-        self._jsonheader = None
+        self._header = None
+        self._header_format = header_format
+        self._keep_alive = False
+        self._request_id = None
+        self._last_activity = time.monotonic()
+        self._last_received = self._last_activity
 
     def process_events(self, mask):
         """
@@ -55,13 +77,20 @@ class Message:
         """
         self._event = 'READ'
         self._read()
+        if self.closed:
+            return
+        self._parse_headers()
 
-        if self._jsonheader_len is None:
-            self._process_protoheader()
-
-        if self._jsonheader_len is not None:
-            if self._jsonheader is None:
-                self._process_jsonheader()
+    def _parse_headers(self):
+        """
+        parses the message header from the data already received,
+        the header format of the peer is used for the replies
+        :return:
+        """
+        if self._header is None:
+            decoded = decode_header(self._recv_buffer)
+            if decoded is not None:
+                self._header_format, self._header = decoded
 
     def _process_read(self):
         """
@@ -76,38 +105,54 @@ class Message:
         :return: None
         """
         try:
-            data = self._socket.recv(4096)
+            count = self._recv_buffer.recv_into(self._socket)
         except BlockingIOError:
             pass
         else:
-            if data:
-                self._recv_buffer += data
-            else:
+            if not count:
+                if self._keep_alive and self._header is None and not self._recv_buffer:
+                    # the peer closed a keep-alive connection between two requests
+                    self._close()
+                    return
                 raise RuntimeError('Peer closed.')
+            self._last_activity = time.monotonic()
+            self._last_received = self._last_activity
 
-    def _create_response_json_content(self):
-        content_encoding = 'utf-8'
-        content = json_encode(self._response, content_encoding)
-
+    def _create_response_content(self, content_type, content_encoding='utf-8'):
+        """
+        creates the response content with the serializer for content_type
+        :param content_type: content-type of the response
+        :param content_encoding: the codec to use for encoding
+        :return: dict
+        """
         response = {
-            'content_bytes': content,
-            'content_type': 'text/json',
+            'content_bytes': encode(self._response, content_type, content_encoding),
+            'content_type': content_type,
             'content_encoding': content_encoding,
         }
-
         return response
 
-    def _create_response_text_content(self):
+    def _content_received(self):
         """
-        creates the response content as text
-        :return: dict
+        checks if the content of the current message is in the receive buffer
+        :return: bool
         """
-        response = {
-            'content_bytes': bytes(self._response, 'utf-8'),
-            'content_type': 'text/plain',
-            'content_encoding': 'utf-8',
-        }
-        return response
+        return len(self._recv_buffer) >= self._header['content-length']
+
+    def _take_content(self):
+        """
+        decodes the content of the current message and removes it from the receive buffer
+        :return: the decoded content
+        """
+        content_len = self._header['content-length']
+        with self._recv_buffer.peek(content_len) as data:
+            content = decode(
+                data,
+                self._header['content-type'],
+                self._header['content-encoding']
+            )
+        self._recv_buffer.consume(content_len)
+        return content
 
     def _process_write(self):
         """
@@ -118,102 +163,173 @@ class Message:
 
     def _write(self):
         """
-        sends the response to the client
+        sends as much of the send queue as the socket takes, in one sendmsg call
         :return:
         """
-        if self._send_buffer:
-            print(f'Sending {self._send_buffer!r} to {self._ipaddr}')
+        if self._send_queue:
+            if logger.isEnabledFor(DEBUG):
+                logger.debug(
+                    'Sending %s to %s', Truncated(self._send_queue[0]), self._ipaddr
+                )
             try:
-                sent = self._socket.send(self._send_buffer)
+                if len(self._send_queue) == 1 or not hasattr(self._socket, 'sendmsg'):
+                    sent = self._socket.send(self._send_queue[0])
+                else:
+                    sent = self._socket.sendmsg(
+                        list(itertools.islice(self._send_queue, MAX_IOV))
+                    )
             except BlockingIOError:
                 pass
             else:
-                self._send_buffer = self._send_buffer[sent:]
-                if type(self).__name__ == 'ServerMessage' and \
-                        sent and \
-                        not self._send_buffer:
-                    self._close()
+                self._consume_sent(sent)
+                self._last_activity = time.monotonic()
+                if sent and not self._send_queue:
+                    self._write_complete()
 
-    def _process_protoheader(self):
+    def _queue_send(self, data):
         """
-        process the protocol header
-        :return:
+        appends a framed message to the send queue
+        :param data: bytes-like object
+        :return: False if the producer should pause until on_resume is called
         """
-        hdrlen = 2
-        if len(self._recv_buffer) >= hdrlen:
-            self._jsonheader_len = struct.unpack(
-                '>H', self._recv_buffer[:hdrlen]
-            )[0]
-            self._recv_buffer = self._recv_buffer[hdrlen:]
+        if self._send_queued + len(data) > MAX_SEND_QUEUE:
+            raise RuntimeError(
+                f'Send queue of {self._send_queued} bytes is full: peer is too slow.'
+            )
+        self._send_queue.append(data)
+        self._send_queued += len(data)
+        if self._paused_since is None and self._send_queued > HIGH_WATERMARK:
+            self._paused_since = time.monotonic()
+        return self._paused_since is None
 
-    def _process_jsonheader(self):
+    def _consume_sent(self, sent):
         """
-        process the json header
+        removes sent bytes from the send queue, resumes the producer below the low watermark
+        :param sent: number of bytes sent
+        :return:
+        """
+        self._send_queued -= sent
+        while sent:
+            head = self._send_queue[0]
+            if sent < len(head):
+                self._send_queue[0] = memoryview(head)[sent:]
+                break
+            sent -= len(head)
+            self._send_queue.popleft()
+        if self._paused_since is not None and self._send_queued <= LOW_WATERMARK:
+            self._paused_since = None
+            if self.on_resume is not None:
+                self.on_resume(self)
+
+    def _write_complete(self):
+        """
+        called once the send buffer has been flushed completely
         :return:
         """
-        hdrlen = self._jsonheader_len
-        if len(self._recv_buffer) >= hdrlen:
-            self._jsonheader = json_decode(
-                self._recv_buffer[:hdrlen], 'utf-8'
-            )
-            self._recv_buffer = self._recv_buffer[hdrlen:]
-            for reqhdr in (
-                    'byteorder',
-                    'content-length',
-                    'content-type',
-                    'content-encoding',
-            ):
-                if reqhdr not in self._jsonheader:
-                    raise ValueError(f'Missing required header "{reqhdr}".')
 
     def _create_message(
             self,
             *,
             content_bytes,
             content_type,
-            content_encoding
+            content_encoding,
+            request_id=None,
+            keep_alive=False
     ):
         """
         creates the encoded message to send to the client
         :param content_bytes:
         :param content_type:
         :param content_encoding:
+        :param request_id: matches a response to its request on a keep-alive connection
+        :param keep_alive: keep the connection open after the response
         :return:
         """
+        header = create_header(
+            len(content_bytes),
+            content_type,
+            content_encoding,
+            request_id=request_id,
+            keep_alive=keep_alive
+        )
+        message_hdr = encode_header(header, self._header_format)
 
-        jsonheader = {
-            'byteorder': sys.byteorder,
-            'content-type': content_type,
-            'content-encoding': content_encoding,
-            'content-length': len(content_bytes),
-        }
-        jsonheader_bytes = json_encode(jsonheader, 'utf-8')
-        message_hdr = struct.pack('>H', len(jsonheader_bytes))
-
-        response_message = message_hdr + jsonheader_bytes + content_bytes
+        response_message = message_hdr + content_bytes
         return response_message
 
     def _close(self):
         """
         closes the connection
         """
-        print(f'Closing connection to {self._ipaddr}')
+        logger.debug('Closing connection to %s', self._ipaddr)
         try:
             self._selector.unregister(self._socket)
         except Exception as e:
-            print(
-                f'Error: selector.unregister() exception for '
-                f'{self._ipaddr}: {e!r}'
+            logger.error(
+                'Error: selector.unregister() exception for %s: %r',
+                self._ipaddr, e
             )
 
         try:
             self._socket.close()
         except OSError as e:
-            print(f'Error: socket.close() exception for {self._ipaddr}: {e!r}')
+            logger.error('Error: socket.close() exception for %s: %r', self._ipaddr, e)
         finally:
             # Delete reference to socket object for garbage collection
             self._socket = None
 
+    def send(self, content, content_type, content_encoding='utf-8', request_id=None):
+        """
+        queues a message outside the request/response cycle, e.g. a push notification
+        :param content: the content to send
+        :param content_type: content-type of the content
+        :param content_encoding: the codec to use for encoding
+        :param request_id: the request the message belongs to
+        :return: False if the peer is falling behind and the producer should pause
+        """
+        message = self._create_message(
+            content_bytes=encode(content, content_type, content_encoding),
+            content_type=content_type,
+            content_encoding=content_encoding,
+            request_id=request_id,
+            keep_alive=True
+        )
+        writable = self._queue_send(message)
+        self.set_selector_events_mask('rw')
+        return writable
+
+    @property
+    def paused(self):
+        return self._paused_since is not None
+
+    @property
+    def send_queue_size(self):
+        return self._send_queued
+
+    def paused_time(self):
+        """
+        seconds the send queue has been above the high watermark
+        :return: float
+        """
+        if self._paused_since is None:
+            return 0.0
+        return time.monotonic() - self._paused_since
+
+    def idle_time(self):
+        """
+        seconds since data was last received or sent on this connection
+        :return: float
+        """
+        return time.monotonic() - self._last_activity
+
+    def receive_idle_time(self):
+        """
+        seconds since data was last received, a peer that vanished stays silent
+        even while messages are still pushed to it
+        :return: float
+        """
+        return time.monotonic() - self._last_received
+
     @property
     def ipaddr(self):
         return self._ipaddr
@@ -222,6 +338,18 @@ class Message:
     def ipaddr(self, value):
         self._ipaddr = value
 
+    @property
+    def header_format(self):
+        return self._header_format
+
+    @property
+    def request_header(self):
+        return self._header
+
+    @property
+    def closed(self):
+        return self._socket is None
+
     @property
     def event(self):
         return self._event
@@ -250,19 +378,14 @@ def json_encode(obj, encoding):
     :param encoding: the codec to use for encoding
     :return: String
     """
-    return json.dumps(obj, ensure_ascii=False).encode(encoding)
+    return JSON.encode(obj, encoding)
 
 
 def json_decode(json_bytes, encoding):
     """
     decodes json data into an object
-    :param json_bytes: the json data to be decoded
+    :param json_bytes: the json data to be decoded, any bytes-like object
     :param encoding: the codec to use for decoding
     :return: Object
     """
-    text_io_wrap = io.TextIOWrapper(
-        io.BytesIO(json_bytes), encoding=encoding, newline=''
-    )
-    obj = json.load(text_io_wrap)
-    text_io_wrap.close()
-    return obj
+    return JSON.decode(json_bytes, encoding)
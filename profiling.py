@@ -0,0 +1,313 @@
+"""
+Profiling hooks that are switched on and off while a process runs.
+The profiler samples the stacks of all threads from a background thread,
+traces the allocations with tracemalloc and records timing spans around the
+hot calls of the loops, e.g. process_action or Arena.take_turn. While it is
+off a span only checks whether the profiler runs.
+SIGUSR1 switches the profiler on and off, SIGUSR2 writes an allocation
+snapshot while it runs, the servers also answer the admin action profile.
+The signal handlers only queue the command, a control thread carries it out,
+so a signal that interrupts a log call can't deadlock on the log's queue.
+Every process has its own profiler, with several workers each one is toggled
+on its own.
+
+Stopping writes to DIRECTORY, named after the process id and the start time:
+  .collapsed   sampled stacks, one 'frame;frame;frame count' line per stack,
+               for speedscope or flamegraph.pl
+  .trace.json  spans in the Chrome trace event format, for Perfetto or chrome://tracing
+  .tracemalloc allocation snapshot, tracemalloc.Snapshot.load() reads it
+  .memory.txt  the lines that allocated the most memory
+"""
+import collections
+import json
+import os
+import queue
+import signal
+import sys
+import threading
+import time
+import tracemalloc
+
+import log
+
+logger = log.get_logger(__name__)
+
+DIRECTORY = 'profiles'
+# seconds between two stack samples
+SAMPLE_INTERVAL = 0.005
+# frames stored per traced allocation
+TRACE_FRAMES = 16
+# spans kept per run, about 10 MB, later spans are counted but dropped
+MAX_SPANS = 100000
+TOP_ALLOCATIONS = 50
+
+
+class Profiler:
+    """
+    sampling profiler, allocation tracing and timing spans of one process
+    """
+    def __init__(self, directory=DIRECTORY, interval=SAMPLE_INTERVAL):
+        """
+        constructor for the Profiler class
+        :param directory: directory the results are written to
+        :param interval: seconds between two stack samples
+        """
+        self.directory = directory
+        self.interval = interval
+        self.active = False
+        self._stamp = None
+        self._start_ns = 0
+        self._spans = []
+        self._dropped = 0
+        self._stacks = collections.Counter()
+        self._labels = {}
+        self._stopped = threading.Event()
+        self._thread = None
+        self._own_tracemalloc = False
+        # start, stop and snapshot come from the loop and from the control thread
+        self._lock = threading.Lock()
+        self._commands = None
+
+    def start(self):
+        """
+        starts sampling, allocation tracing and recording spans
+        :return: None
+        """
+        with self._lock:
+            self._start()
+
+    def _start(self):
+        if self.active:
+            return
+        self._stamp = time.strftime('%Y%m%d-%H%M%S')
+        self._start_ns = time.perf_counter_ns()
+        self._spans = []
+        self._dropped = 0
+        self._stacks = collections.Counter()
+        # an allocation trace started with PYTHONTRACEMALLOC is left running
+        self._own_tracemalloc = not tracemalloc.is_tracing()
+        if self._own_tracemalloc:
+            tracemalloc.start(TRACE_FRAMES)
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._sample, name='profiler', daemon=True)
+        self._thread.start()
+        self.active = True
+        logger.info('Profiling started, sampling every %gs', self.interval)
+
+    def stop(self):
+        """
+        stops profiling and writes the results
+        :return: list of the paths written, empty if the profiler was not running
+        """
+        with self._lock:
+            return self._stop()
+
+    def _stop(self):
+        if not self.active:
+            return []
+        self.active = False
+        self._stopped.set()
+        self._thread.join()
+        self._thread = None
+        os.makedirs(self.directory, exist_ok=True)
+        paths = [self._write_stacks(), self._write_spans()]
+        paths.extend(self._snapshot())
+        if self._own_tracemalloc:
+            tracemalloc.stop()
+        logger.info('Profiling stopped, wrote %s', ', '.join(paths))
+        return paths
+
+    def toggle(self):
+        """
+        stops a running profiler or starts a stopped one
+        :return: list of the paths written by stop
+        """
+        with self._lock:
+            if self.active:
+                return self._stop()
+            self._start()
+            return []
+
+    def control(self, enable=None):
+        """
+        answers the admin action profile
+        :param enable: True starts, False stops, None toggles
+        :return: dict with 'active' and the 'files' written
+        """
+        if enable is None:
+            files = self.toggle()
+        elif enable:
+            self.start()
+            files = []
+        else:
+            files = self.stop()
+        return {'active': self.active, 'files': files}
+
+    def snapshot(self):
+        """
+        writes the allocations traced so far
+        :return: list of the paths written, empty if allocations are not traced
+        """
+        with self._lock:
+            return self._snapshot()
+
+    def _snapshot(self):
+        if not tracemalloc.is_tracing():
+            return []
+        os.makedirs(self.directory, exist_ok=True)
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, __file__),
+        ))
+        prefix = self._prefix(time.strftime('%Y%m%d-%H%M%S'))
+        snapshot.dump(f'{prefix}.tracemalloc')
+        with open(f'{prefix}.memory.txt', 'w', encoding='utf-8') as file:
+            for statistic in snapshot.statistics('lineno')[:TOP_ALLOCATIONS]:
+                file.write(f'{statistic}\n')
+        return [f'{prefix}.tracemalloc', f'{prefix}.memory.txt']
+
+    def span(self, name):
+        """
+        times a block: with profiler.span('process_action'): ...
+        :param name: the name shown in the trace viewer
+        :return: context manager
+        """
+        if not self.active:
+            return _NO_SPAN
+        return _Span(self, name)
+
+    def install_signals(self):
+        """
+        SIGUSR1 toggles the profiler, SIGUSR2 writes an allocation snapshot,
+        only possible in the main thread and on platforms that have the signals,
+        elsewhere it does nothing
+        :return: None
+        """
+        if not hasattr(signal, 'SIGUSR1'):
+            return
+        if threading.current_thread() is not threading.main_thread():
+            return
+        if self._commands is None:
+            # SimpleQueue.put is reentrant, unlike everything the commands do
+            self._commands = queue.SimpleQueue()
+            threading.Thread(target=self._control, name='profiler-control', daemon=True).start()
+        signal.signal(signal.SIGUSR1, lambda signum, frame: self._commands.put(self.toggle))
+        signal.signal(signal.SIGUSR2, lambda signum, frame: self._commands.put(self._log_snapshot))
+
+    def _control(self):
+        """
+        main loop of the control thread, runs the commands queued by the signal handlers
+        """
+        while True:
+            command = self._commands.get()
+            try:
+                command()
+            except Exception:
+                logger.exception('Profiler command failed')
+
+    def _log_snapshot(self):
+        paths = self.snapshot()
+        if paths:
+            logger.info('Wrote %s', ', '.join(paths))
+        else:
+            logger.warning('No allocation snapshot, the profiler is not running')
+
+    def _add_span(self, name, start_ns, end_ns):
+        if len(self._spans) < MAX_SPANS:
+            self._spans.append((name, start_ns, end_ns - start_ns, threading.get_ident()))
+        else:
+            self._dropped += 1
+
+    def _sample(self):
+        """
+        main loop of the sampling thread
+        """
+        own = threading.get_ident()
+        names = {}
+        while not self._stopped.wait(self.interval):
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                labels = []
+                while frame is not None:
+                    labels.append(self._label(frame.f_code))
+                    frame = frame.f_back
+                if ident not in names:
+                    names = {thread.ident: thread.name for thread in threading.enumerate()}
+                labels.append(names.get(ident, str(ident)))
+                labels.reverse()
+                self._stacks[';'.join(labels)] += 1
+
+    def _label(self, code):
+        label = self._labels.get(code)
+        if label is None:
+            label = f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})'
+            self._labels[code] = label
+        return label
+
+    def _prefix(self, stamp):
+        return os.path.join(self.directory, f'profile-{os.getpid()}-{stamp}')
+
+    def _write_stacks(self):
+        path = f'{self._prefix(self._stamp)}.collapsed'
+        with open(path, 'w', encoding='utf-8') as file:
+            for stack, count in self._stacks.most_common():
+                file.write(f'{stack} {count}\n')
+        return path
+
+    def _write_spans(self):
+        path = f'{self._prefix(self._stamp)}.trace.json'
+        pid = os.getpid()
+        events = [
+            {
+                'name': name, 'ph': 'X', 'pid': pid, 'tid': tid,
+                'ts': (start_ns - self._start_ns) / 1000, 'dur': duration_ns / 1000,
+            }
+            for name, start_ns, duration_ns, tid in self._spans
+        ]
+        with open(path, 'w', encoding='utf-8') as file:
+            json.dump({
+                'traceEvents': events,
+                'displayTimeUnit': 'ms',
+                'otherData': {'dropped_spans': self._dropped},
+            }, file)
+        return path
+
+
+class _Span:
+    """
+    records one span when the block is left
+    """
+    __slots__ = ('_profiler', '_name', '_start_ns')
+
+    def __init__(self, profiler, name):
+        self._profiler = profiler
+        self._name = name
+        self._start_ns = 0
+
+    def __enter__(self):
+        self._start_ns = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._profiler._add_span(self._name, self._start_ns, time.perf_counter_ns())
+        return False
+
+
+class _NoSpan:
+    """
+    stands in for a span while the profiler is off
+    """
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_NO_SPAN = _NoSpan()
+
+# the profiler of this process, used by the loops of the servers and the game
+profiler = Profiler()
@@ -0,0 +1,131 @@
+""" Provides a growable receive buffer that avoids copying on every read. """
+
+# initial capacity, the buffer doubles when a message doesn't fit
+INITIAL_SIZE = 4096
+# free bytes a read needs at least, a larger free tail is filled as a whole
+MIN_FREE = 1024
+
+
+class RecvBuffer:
+    """
+    bytearray-backed buffer with a read and a write offset.
+    Data is received directly into the free tail of the buffer and parsed
+    through memoryviews; consumed bytes are only discarded when the tail
+    runs out of space. It starts small, so an idle connection holds little memory.
+    """
+    def __init__(self, size=INITIAL_SIZE):
+        """
+        constructor for the RecvBuffer class
+        :param size: initial capacity in bytes
+        """
+        self._buffer = bytearray(size)
+        self._start = 0
+        self._end = 0
+
+    def __len__(self):
+        return self._end - self._start
+
+    def __bool__(self):
+        return self._end > self._start
+
+    def recv_into(self, sock, size=MIN_FREE):
+        """
+        receives from the socket into the free tail of the buffer
+        :param sock: the socket to read from
+        :param size: minimum number of free bytes, the buffer grows if it has less
+        :return: number of bytes received, 0 if the peer closed
+        """
+        self._reserve(size)
+        with memoryview(self._buffer) as view:
+            free = view[self._end:]
+            count = sock.recv_into(free, len(free))
+        self._end += count
+        return count
+
+    def get_buffer(self, size=-1):
+        """
+        returns a view on the free bytes at the end of the buffer,
+        for asyncio.BufferedProtocol. Call advance with the number of bytes written.
+        :param size: minimum number of free bytes, asyncio's sizehint,
+                     at least MIN_FREE, -1 for no hint
+        :return: memoryview
+        """
+        self._reserve(max(size, MIN_FREE))
+        return memoryview(self._buffer)[self._end:]
+
+    def advance(self, count):
+        """
+        marks count bytes written into the view from get_buffer as received
+        :param count: number of bytes
+        :return: None
+        """
+        self._end += count
+
+    def extend(self, data):
+        """
+        appends data to the buffer
+        :param data: bytes-like object
+        :return: None
+        """
+        size = len(data)
+        self._reserve(size)
+        self._buffer[self._end:self._end + size] = data
+        self._end += size
+
+    def unpack(self, fmt):
+        """
+        unpacks a struct from the start of the buffer without consuming it
+        :param fmt: a struct.Struct instance
+        :return: tuple of unpacked values
+        """
+        return fmt.unpack_from(self._buffer, self._start)
+
+    def peek(self, size):
+        """
+        returns a view on the first size bytes without copying them.
+        The view must be released before the next read.
+        :param size: number of bytes
+        :return: memoryview
+        """
+        return memoryview(self._buffer)[self._start:self._start + size]
+
+    def take(self, size):
+        """
+        removes the first size bytes and returns them as bytes
+        :param size: number of bytes
+        :return: bytes
+        """
+        data = bytes(self._buffer[self._start:self._start + size])
+        self.consume(size)
+        return data
+
+    def consume(self, size):
+        """
+        discards the first size bytes
+        :param size: number of bytes
+        :return: None
+        """
+        self._start += size
+        if self._start >= self._end:
+            self._start = 0
+            self._end = 0
+
+    def _reserve(self, size):
+        """
+        makes room for size bytes at the end of the buffer,
+        compacting before growing
+        :param size: number of bytes needed
+        :return: None
+        """
+        if len(self._buffer) - self._end >= size:
+            return
+        pending = self._end - self._start
+        if self._start and len(self._buffer) - pending >= size:
+            self._buffer[:pending] = self._buffer[self._start:self._end]
+        else:
+            capacity = max(len(self._buffer) * 2, pending + size)
+            grown = bytearray(capacity)
+            grown[:pending] = self._buffer[self._start:self._end]
+            self._buffer = grown
+        self._start = 0
+        self._end = pending
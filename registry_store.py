@@ -0,0 +1,314 @@
+"""
+Persistence for the Services registry: a snapshot plus an append-only log.
+Every register, heartbeat and expire is appended to the log as a small binary
+record. When the log has grown well beyond the registry it is compacted into a
+new snapshot. At startup both files are read through mmap, so a restart
+only costs a parse of the snapshot and the log.
+
+Snapshot: header '>4sBdII' (magic, version, saved at, service count, string count),
+the strings (type and ip values, '>H' length + utf-8), then the services
+oldest heartbeat first, stored column by column so each column is decoded in one go:
+the uuids as 36 ascii characters each, then little-endian arrays of the heartbeats
+(double), ports (uint16), type indexes and ip indexes (uint32).
+Log: header '>4sB' (magic, version), then records '>Bd16s' (event, time, uuid),
+register records followed by '>HHH' (port, type length, ip length), type and ip.
+Times are wall clock seconds, the registry converts them to its own clock.
+"""
+import mmap
+import os
+import struct
+import sys
+import time
+from array import array
+
+from log import get_logger
+
+logger = get_logger(__name__)
+
+VERSION = 1
+SNAPSHOT_MAGIC = b'KSNP'
+LOG_MAGIC = b'KLOG'
+
+SNAPSHOT_HEADER = struct.Struct('>4sBdII')
+SNAPSHOT_STRING = struct.Struct('>H')
+UUID_LENGTH = 36
+LOG_HEADER = struct.Struct('>4sB')
+LOG_RECORD = struct.Struct('>Bd16s')
+LOG_REGISTER = struct.Struct('>HHH')
+
+REGISTER = 1
+HEARTBEAT = 2
+EXPIRE = 3
+
+COMPACT_AFTER = 100000
+FLUSH_INTERVAL = 1.0
+
+
+class RegistryStore:
+    """
+    Snapshot and log files of one registry, named path + '.snap' and path + '.log'.
+    Holds only its configuration until open(), so it can be handed to another process.
+    """
+    def __init__(self, path, compact_after=COMPACT_AFTER, flush_interval=FLUSH_INTERVAL):
+        """
+        constructor for the RegistryStore class
+        :param path: path and file name prefix of the snapshot and the log
+        :param compact_after: log records before a compaction is considered,
+                              it also waits until the log is twice the size of the registry
+        :param flush_interval: seconds the log may stay in the write buffer
+        """
+        self.snapshot_path = path + '.snap'
+        self.log_path = path + '.log'
+        self._compact_after = compact_after
+        self._flush_interval = flush_interval
+        self._log = None
+        self._log_records = 0
+        self._log_end = None
+        self._last_flush = 0.0
+
+    def load(self):
+        """
+        reads the snapshot and replays the log
+        :return: tuple (iterable of (uuid, type, ip, port, heartbeat) oldest heartbeat first,
+                 wall clock time of the last write or None if there is nothing stored)
+        """
+        services = {}
+        saved_at = _map_file(self.snapshot_path, self._read_snapshot, services)
+        log_saved_at = _map_file(self.log_path, self._read_log, services)
+        if log_saved_at is not None:
+            saved_at = max(saved_at or 0.0, log_saved_at)
+        logger.info('Loaded %d services from %s', len(services), self.snapshot_path)
+        return (
+            (service_uuid, *record) for service_uuid, record in services.items()
+        ), saved_at
+
+    def open(self):
+        """
+        opens the log for appending, cuts off a partially written last record
+        """
+        exists = os.path.exists(self.log_path)
+        self._log = open(self.log_path, 'r+b' if exists else 'wb')
+        if self._log_end is not None:
+            self._log.truncate(self._log_end)
+        self._log.seek(0, os.SEEK_END)
+        if self._log.tell() == 0:
+            self._log.write(LOG_HEADER.pack(LOG_MAGIC, VERSION))
+        self._last_flush = time.monotonic()
+
+    def register(self, service_uuid, type, ipaddr, port):
+        """
+        appends a registration
+        """
+        type_bytes = type.encode('utf-8')
+        ip_bytes = ipaddr.encode('utf-8')
+        self._append(
+            LOG_RECORD.pack(REGISTER, time.time(), _uuid_bytes(service_uuid))
+            + LOG_REGISTER.pack(port, len(type_bytes), len(ip_bytes))
+            + type_bytes + ip_bytes
+        )
+
+    def heartbeat(self, service_uuid):
+        """
+        appends a heartbeat
+        """
+        self._append(LOG_RECORD.pack(HEARTBEAT, time.time(), _uuid_bytes(service_uuid)))
+
+    def expire(self, service_uuid):
+        """
+        appends the removal of a service
+        """
+        self._append(LOG_RECORD.pack(EXPIRE, time.time(), _uuid_bytes(service_uuid)))
+
+    def should_compact(self, live_services):
+        """
+        :param live_services: number of services in the registry
+        :return: True when the log should be compacted into a snapshot
+        """
+        return (self._log_records >= self._compact_after
+                and self._log_records >= 2 * live_services)
+
+    def compact(self, services):
+        """
+        writes a new snapshot and starts an empty log.
+        The snapshot replaces the old one atomically, a crash before the log
+        is reset only leaves records that are replayed again on load.
+        :param services: iterable of (uuid, type, ip, port, wall clock heartbeat),
+                         oldest heartbeat first
+        """
+        strings = {}
+        uuids = []
+        heartbeats = array('d')
+        ports = array('H')
+        types = array('I')
+        ips = array('I')
+        for service_uuid, type, ipaddr, port, heartbeat in services:
+            uuids.append(service_uuid)
+            heartbeats.append(heartbeat)
+            ports.append(port)
+            types.append(strings.setdefault(type, len(strings)))
+            ips.append(strings.setdefault(ipaddr, len(strings)))
+        count = len(uuids)
+        string_table = bytearray()
+        for string in strings:
+            data = string.encode('utf-8')
+            string_table += SNAPSHOT_STRING.pack(len(data)) + data
+
+        temp_path = self.snapshot_path + '.tmp'
+        with open(temp_path, 'wb') as file:
+            file.write(SNAPSHOT_HEADER.pack(
+                SNAPSHOT_MAGIC, VERSION, time.time(), count, len(strings)
+            ))
+            file.write(string_table)
+            file.write(''.join(uuids).encode('ascii'))
+            for column in (heartbeats, ports, types, ips):
+                if sys.byteorder == 'big':
+                    column.byteswap()
+                file.write(column)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, self.snapshot_path)
+
+        if self._log is not None:
+            self._log.seek(0)
+            self._log.truncate()
+            self._log.write(LOG_HEADER.pack(LOG_MAGIC, VERSION))
+            self._log.flush()
+        self._log_records = 0
+        logger.info('Compacted %d services into %s', count, self.snapshot_path)
+
+    def flush(self):
+        """
+        writes the buffered log records to the file
+        """
+        if self._log is not None:
+            self._log.flush()
+        self._last_flush = time.monotonic()
+
+    def close(self):
+        """
+        flushes and closes the log
+        """
+        if self._log is not None:
+            self._log.close()
+            self._log = None
+
+    def _append(self, record):
+        """
+        appends a record, the file is flushed at most every flush_interval
+        """
+        self._log.write(record)
+        self._log_records += 1
+        if time.monotonic() - self._last_flush >= self._flush_interval:
+            self.flush()
+
+    def _read_snapshot(self, data, services):
+        """
+        reads the services of a snapshot
+        :return: wall clock time the snapshot was written
+        """
+        magic, version, saved_at, count, string_count = SNAPSHOT_HEADER.unpack_from(data)
+        if magic != SNAPSHOT_MAGIC or version != VERSION:
+            raise ValueError(f'{self.snapshot_path} is not a registry snapshot.')
+        pos = SNAPSHOT_HEADER.size
+        strings = []
+        for _ in range(string_count):
+            length, = SNAPSHOT_STRING.unpack_from(data, pos)
+            pos += SNAPSHOT_STRING.size
+            strings.append(str(data[pos:pos + length], 'utf-8'))
+            pos += length
+        end = pos + count * UUID_LENGTH
+        text = str(data[pos:end], 'ascii')
+        uuids = [text[start:start + UUID_LENGTH] for start in range(0, len(text), UUID_LENGTH)]
+        pos = end
+        columns = []
+        for typecode in 'dHII':
+            column = array(typecode)
+            end = pos + count * column.itemsize
+            column.frombytes(data[pos:end])
+            if sys.byteorder == 'big':
+                column.byteswap()
+            columns.append(column)
+            pos = end
+        heartbeats, ports, types, ips = columns
+        services.update(zip(uuids, [
+            [strings[type_index], strings[ip_index], port, heartbeat]
+            for heartbeat, port, type_index, ip_index in zip(heartbeats, ports, types, ips)
+        ]))
+        return saved_at
+
+    def _read_log(self, data, services):
+        """
+        replays the log records onto the services
+        :return: wall clock time of the last record
+        """
+        magic, version = LOG_HEADER.unpack_from(data)
+        if magic != LOG_MAGIC or version != VERSION:
+            raise ValueError(f'{self.log_path} is not a registry log.')
+        pos = LOG_HEADER.size
+        saved_at = None
+        size = len(data)
+        while pos + LOG_RECORD.size <= size:
+            event, timestamp, uuid_bytes = LOG_RECORD.unpack_from(data, pos)
+            end = pos + LOG_RECORD.size
+            service_uuid = _uuid_str(uuid_bytes)
+            if event == REGISTER:
+                if end + LOG_REGISTER.size > size:
+                    break
+                port, type_len, ip_len = LOG_REGISTER.unpack_from(data, end)
+                end += LOG_REGISTER.size
+                if end + type_len + ip_len > size:
+                    break
+                type = str(data[end:end + type_len], 'utf-8')
+                ipaddr = str(data[end + type_len:end + type_len + ip_len], 'utf-8')
+                end += type_len + ip_len
+                services.pop(service_uuid, None)
+                services[service_uuid] = [type, ipaddr, port, timestamp]
+            elif event == HEARTBEAT:
+                # reinserting keeps the dict ordered by heartbeat
+                record = services.pop(service_uuid, None)
+                if record is not None:
+                    record[3] = timestamp
+                    services[service_uuid] = record
+            elif event == EXPIRE:
+                services.pop(service_uuid, None)
+            else:
+                raise ValueError(f'Unknown event {event} in {self.log_path}.')
+            pos = end
+            saved_at = timestamp
+            self._log_records += 1
+        if pos != size:
+            logger.warning('Ignoring a partial record at the end of %s', self.log_path)
+        self._log_end = pos
+        return saved_at
+
+
+def _uuid_bytes(service_uuid):
+    """
+    packs a UUID string into 16 bytes, faster than uuid.UUID
+    """
+    return bytes.fromhex(service_uuid.replace('-', ''))
+
+
+def _uuid_str(uuid_bytes):
+    """
+    formats 16 bytes as a UUID string, faster than uuid.UUID
+    """
+    h = uuid_bytes.hex()
+    return f'{h[:8]}-{h[8:12]}-{h[12:16]}-{h[16:20]}-{h[20:]}'
+
+
+def _map_file(path, reader, services):
+    """
+    maps a file read-only and passes its contents to reader
+    :return: the result of reader, None if the file is missing or empty
+    """
+    try:
+        file = open(path, 'rb')
+    except FileNotFoundError:
+        return None
+    with file:
+        if os.fstat(file.fileno()).st_size == 0:
+            return None
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            with memoryview(data) as view:
+                return reader(view, services)
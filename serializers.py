@@ -0,0 +1,295 @@
+"""
+Registry of the serializers for message content, keyed by content-type.
+A serializer provides encode(obj, encoding) -> bytes and decode(data, encoding) -> obj,
+where data may be any bytes-like object including a memoryview on the receive buffer.
+"""
+import json
+import struct
+
+JSON_CONTENT_TYPE = 'text/json'
+TEXT_CONTENT_TYPE = 'text/plain'
+COMPACT_CONTENT_TYPE = 'binary/kitten-compact'
+
+_serializers = {}
+
+
+class JsonSerializer:
+    """
+    JSON with a reusable encoder and decoder, decodes straight from the buffer
+    """
+    content_type = JSON_CONTENT_TYPE
+
+    def __init__(self):
+        self._encoder = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'))
+        self._decoder = json.JSONDecoder()
+
+    def dumps(self, obj):
+        """
+        encodes the object as a JSON string
+        :param obj: the object to encode
+        :return: str
+        """
+        return self._encoder.encode(obj)
+
+    def encode(self, obj, encoding='utf-8'):
+        return self._encoder.encode(obj).encode(encoding)
+
+    def decode(self, data, encoding='utf-8'):
+        return self._decoder.decode(str(data, encoding))
+
+
+class TextSerializer:
+    """
+    plain text
+    """
+    content_type = TEXT_CONTENT_TYPE
+
+    def dumps(self, obj):
+        return str(obj)
+
+    def encode(self, obj, encoding='utf-8'):
+        return str(obj).encode(encoding)
+
+    def decode(self, data, encoding='utf-8'):
+        return str(data, encoding)
+
+
+class BinarySerializer:
+    """
+    raw bytes, used for content-types without a registered serializer
+    """
+    content_type = None
+
+    def encode(self, obj, encoding='binary'):
+        # bytes(n) would be n zero bytes
+        if not isinstance(obj, (bytes, bytearray, memoryview)):
+            raise TypeError(f'Can not encode {type(obj).__name__} as binary content.')
+        return bytes(obj)
+
+    def decode(self, data, encoding='binary'):
+        return bytes(data)
+
+
+class CompactSerializer:
+    """
+    Compact tagged binary encoding for the small game and registry messages.
+    Strings from STRING_TABLE are sent as a single byte, small integers
+    and lengths as varints. Supports None, bool, int, float, str, list and dict,
+    nested up to MAX_DEPTH lists and dicts deep.
+    """
+    content_type = COMPACT_CONTENT_TYPE
+
+    # deeper content raises ValueError instead of exhausting the stack
+    MAX_DEPTH = 100
+
+    # append only: the index of a string is part of the wire format
+    STRING_TABLE = (
+        'action', 'type', 'ip', 'port', 'uuid', 'name', 'uuids', 'services',
+        'botname', 'event', 'data', 'card', 'cards', 'decksize', 'card_counts',
+        'bots', 'count', 'ranks', 'results', 'version', 'since', 'events',
+        'MEOW', 'HEARTBEAT', 'register', 'heartbeat', 'query', 'bot', 'OK', 'NOT FOUND',
+        'PLAY', 'DRAW', 'DEFUSE', 'EXPLODE', 'FUTURE', 'INFORM', 'START', 'OVER',
+        'NEXTBOT', 'EXPLODING_KITTEN', 'SEE_THE_FUTURE', 'SKIP', 'SHUFFLE', 'NORMAL',
+        '127.0.0.1', 'WATCH', 'deregister', 'epoch', 'add', 'remove', 'expire',
+    )
+    _STRING_CODES = {string: code for code, string in enumerate(STRING_TABLE)}
+
+    _NONE = 0x00
+    _FALSE = 0x01
+    _TRUE = 0x02
+    _INT = 0x03
+    _FLOAT = 0x04
+    _STR = 0x05
+    _LIST = 0x06
+    _DICT = 0x07
+    _INTERNED = 0x80
+
+    _DOUBLE = struct.Struct('>d')
+
+    def encode(self, obj, encoding='binary'):
+        out = bytearray()
+        self._encode_value(obj, out, 0)
+        return bytes(out)
+
+    def decode(self, data, encoding='binary'):
+        try:
+            with memoryview(data) as view:
+                obj, pos = self._decode_value(view, 0, 0)
+        except (IndexError, struct.error) as e:
+            raise ValueError('Truncated compact content.') from e
+        except TypeError as e:
+            # a list or dict as a dict key
+            raise ValueError(f'Invalid compact content: {e}') from e
+        if pos > len(data):
+            raise ValueError('Truncated compact content.')
+        if pos != len(data):
+            raise ValueError('Trailing data after compact content.')
+        return obj
+
+    def _encode_value(self, obj, out, depth):
+        """
+        appends the encoded object to out
+        :param depth: number of lists and dicts around the object
+        """
+        if obj is None:
+            out.append(self._NONE)
+        elif obj is True:
+            out.append(self._TRUE)
+        elif obj is False:
+            out.append(self._FALSE)
+        elif isinstance(obj, str):
+            code = self._STRING_CODES.get(obj)
+            if code is not None:
+                out.append(self._INTERNED | code)
+            else:
+                data = obj.encode('utf-8')
+                out.append(self._STR)
+                _write_varint(len(data), out)
+                out += data
+        elif isinstance(obj, int):
+            out.append(self._INT)
+            _write_varint(obj << 1 if obj >= 0 else (-obj << 1) - 1, out)
+        elif isinstance(obj, float):
+            out.append(self._FLOAT)
+            out += self._DOUBLE.pack(obj)
+        elif isinstance(obj, (list, tuple)):
+            depth = self._enter(depth)
+            out.append(self._LIST)
+            _write_varint(len(obj), out)
+            for item in obj:
+                self._encode_value(item, out, depth)
+        elif isinstance(obj, dict):
+            depth = self._enter(depth)
+            out.append(self._DICT)
+            _write_varint(len(obj), out)
+            for key, value in obj.items():
+                self._encode_value(key, out, depth)
+                self._encode_value(value, out, depth)
+        else:
+            raise TypeError(f'Can not encode {type(obj).__name__} as compact content.')
+
+    def _decode_value(self, view, pos, depth):
+        """
+        decodes one value
+        :param depth: number of lists and dicts around the value
+        :return: tuple (object, position after the value)
+        """
+        tag = view[pos]
+        pos += 1
+        if tag & self._INTERNED:
+            index = tag & ~self._INTERNED
+            if index >= len(self.STRING_TABLE):
+                raise ValueError(f'Unknown interned string {index}.')
+            return self.STRING_TABLE[index], pos
+        if tag == self._STR:
+            length, pos = _read_varint(view, pos)
+            return str(view[pos:pos + length], 'utf-8'), pos + length
+        if tag == self._INT:
+            value, pos = _read_varint(view, pos)
+            return (value >> 1) ^ -(value & 1), pos
+        if tag == self._DICT:
+            depth = self._enter(depth)
+            count, pos = _read_varint(view, pos)
+            obj = {}
+            for _ in range(count):
+                key, pos = self._decode_value(view, pos, depth)
+                obj[key], pos = self._decode_value(view, pos, depth)
+            return obj, pos
+        if tag == self._LIST:
+            depth = self._enter(depth)
+            count, pos = _read_varint(view, pos)
+            obj = []
+            for _ in range(count):
+                item, pos = self._decode_value(view, pos, depth)
+                obj.append(item)
+            return obj, pos
+        if tag == self._NONE:
+            return None, pos
+        if tag == self._TRUE:
+            return True, pos
+        if tag == self._FALSE:
+            return False, pos
+        if tag == self._FLOAT:
+            return self._DOUBLE.unpack_from(view, pos)[0], pos + self._DOUBLE.size
+        raise ValueError(f'Unknown compact tag {tag:#x}.')
+
+    def _enter(self, depth):
+        """
+        :param depth: the depth of a list or dict
+        :return: the depth of its items
+        :raises ValueError: if they would be nested deeper than MAX_DEPTH
+        """
+        if depth >= self.MAX_DEPTH:
+            raise ValueError(f'Compact content is nested deeper than {self.MAX_DEPTH}.')
+        return depth + 1
+
+
+def _write_varint(value, out):
+    """
+    appends an unsigned integer as LEB128 varint
+    """
+    while value > 0x7F:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _read_varint(view, pos):
+    """
+    reads an unsigned LEB128 varint
+    :return: tuple (value, position after the varint)
+    """
+    value = 0
+    shift = 0
+    while True:
+        byte = view[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return value, pos
+        shift += 7
+
+
+def register_serializer(serializer):
+    """
+    registers a serializer for its content_type
+    :param serializer: object with content_type, encode and decode
+    :return: None
+    """
+    _serializers[serializer.content_type] = serializer
+
+
+def get_serializer(content_type):
+    """
+    looks up the serializer for a content-type
+    :param content_type: the content-type of the message
+    :return: the registered serializer, raw bytes for unknown types
+    """
+    return _serializers.get(content_type, BINARY)
+
+
+def encode(obj, content_type, encoding):
+    """
+    encodes message content with the serializer for its content-type
+    :return: bytes
+    """
+    return get_serializer(content_type).encode(obj, encoding)
+
+
+def decode(data, content_type, encoding):
+    """
+    decodes message content with the serializer for its content-type
+    :param data: bytes-like object
+    :return: the decoded content
+    """
+    return get_serializer(content_type).decode(data, encoding)
+
+
+JSON = JsonSerializer()
+TEXT = TextSerializer()
+BINARY = BinarySerializer()
+COMPACT = CompactSerializer()
+
+register_serializer(JSON)
+register_serializer(TEXT)
+register_serializer(COMPACT)
@@ -1,5 +1,9 @@
 """ ServerMessage class for handling server messages """
-from message import Message, json_decode
+from log import Truncated, get_logger
+from message import SLOW_PEER_TIMEOUT, Message
+from serializers import COMPACT_CONTENT_TYPE, JSON_CONTENT_TYPE, TEXT_CONTENT_TYPE
+
+logger = get_logger(__name__)
 
 
 class ServerMessage(Message):
@@ -13,6 +17,35 @@ class ServerMessage(Message):
         super().__init__(selector, socket, ipaddr)
         self._response = None
         self._response_created = False
+        self._timers = None
+        self._idle_timer = None
+
+    def close(self):
+        """
+        closes the connection
+        """
+        if not self.closed:
+            self._close()
+
+    def set_idle_timer(self, timers, timer):
+        """
+        remembers the timer that checks the connection, it is cancelled on close
+        :param timers: the TimerWheel of the loop
+        :param timer: Timer returned by schedule
+        """
+        self._timers = timers
+        self._idle_timer = timer
+
+    def _close(self):
+        """
+        closes the connection, cancels its idle timer and drops the receive buffer,
+        so a closed connection is not kept alive by the timer wheel
+        """
+        if self._idle_timer is not None:
+            self._timers.cancel(self._idle_timer)
+            self._timers = self._idle_timer = None
+        super()._close()
+        self._recv_buffer = None
 
     def _process_read(self):
         """
@@ -21,7 +54,7 @@ class ServerMessage(Message):
         """
         self._process_headers()
 
-        if self._jsonheader:
+        if self._header:
             if self._request is None:
                 self._process_request()
 
@@ -30,20 +63,16 @@ class ServerMessage(Message):
         process the request
         :return:
         """
-        content_len = self._jsonheader['content-length']
-        if not len(self._recv_buffer) >= content_len:
+        if not self._content_received():
             return
-        data = self._recv_buffer[:content_len]
-        self._recv_buffer = self._recv_buffer[content_len:]
-        if self._jsonheader['content-type'] == 'text/json':
-            encoding = self._jsonheader['content-encoding']
-            self._request = json_decode(data, encoding)
-            print(f'Received request {self._request!r} from {self._ipaddr}')
+        self._keep_alive = self._header.get('keep-alive', False)
+        self._request_id = self._header.get('request-id')
+        self._request = self._take_content()
+        if self._header['content-type'] == JSON_CONTENT_TYPE:
+            logger.debug('Received request %s from %s', Truncated(self._request), self._ipaddr)
         else:
-            self._request = data
-            print(
-                f"Received {self._jsonheader['content-type']} "
-                f'request from {self._ipaddr}'
+            logger.debug(
+                'Received %s request from %s', self._header['content-type'], self._ipaddr
             )
 
     def _process_write(self):
@@ -51,8 +80,12 @@ class ServerMessage(Message):
         process the write-event
         :return:
         """
-        self._event = 'WRITE'
-        if self._request:
+        # a request read in the same select round as a push is still to be answered,
+        # its READ event must reach process_action
+        if self._request is None or self._response is not None:
+            self._event = 'WRITE'
+        # the response is only set after the read, pushed messages may be written before it
+        if self._request and self._response is not None:
             if not self._response_created:
                 self._create_response()
 
@@ -63,10 +96,122 @@ class ServerMessage(Message):
         creates the response to the client
         :return:
         """
-        if self._request['action'] == 'query':
-            data = self._create_response_json_content()
+        content_type, content_encoding = response_content_type(
+            self._header['content-type'], self._response
+        )
+        data = self._create_response_content(content_type, content_encoding)
+        output = self._create_message(
+            **data,
+            request_id=self._request_id,
+            keep_alive=self._keep_alive
+        )
+        self._response_created = True
+        self._queue_send(output)
+
+    def _write_complete(self):
+        """
+        closes one-shot connections, waits for the next request on keep-alive connections
+        :return:
+        """
+        if self._request is not None and not self._response_created:
+            # only pushed messages were sent, the response is still to come
+            return
+        if self._keep_alive:
+            self._next_request()
         else:
-            data = self._create_response_text_content()
-        output = self._create_message(**data)
-        self.response_created = True
-        self._send_buffer += output
+            self._close()
+
+    def _next_request(self):
+        """
+        resets the per-request state and picks up a pipelined request
+        that is already in the receive buffer
+        :return:
+        """
+        self._header = None
+        self._request = None
+        self._request_id = None
+        self._response = None
+        self._response_created = False
+        self.set_selector_events_mask('r')
+
+        self._parse_headers()
+        if self._header:
+            self._process_request()
+        if self._request is not None:
+            self._event = 'READ'
+
+
+def response_content_type(request_content_type, response):
+    """
+    chooses the content-type of a response: compact requests get compact responses,
+    strings are sent as text and everything else as JSON
+    :param request_content_type: content-type of the request
+    :param response: the response object
+    :return: tuple (content_type, content_encoding)
+    """
+    if request_content_type == COMPACT_CONTENT_TYPE:
+        return COMPACT_CONTENT_TYPE, 'binary'
+    if isinstance(response, str):
+        return TEXT_CONTENT_TYPE, 'utf-8'
+    return JSON_CONTENT_TYPE, 'utf-8'
+
+
+def close_idle_connections(selector, timeout):
+    """
+    closes all connections that have been idle longer than timeout
+    and slow peers whose send queue stays above the high watermark
+    :param selector: the selector holding the connections
+    :param timeout: idle timeout in seconds
+    :return: None
+    """
+    for key in list(selector.get_map().values()):
+        message = key.data
+        if message is None:
+            continue
+        if message.idle_time() > timeout:
+            logger.info('Connection to %s idle for %ss', message.ipaddr, timeout)
+            message._close()
+        elif message.paused_time() > SLOW_PEER_TIMEOUT:
+            logger.warning(
+                'Connection to %s is too slow, closing it after %ss',
+                message.ipaddr, SLOW_PEER_TIMEOUT
+            )
+            message._close()
+
+
+def reap_when_idle(timers, message, timeout):
+    """
+    schedules the checks that close the connection once it has been idle for timeout,
+    or when it is a slow peer whose send queue stays above the high watermark.
+    Between requests only received data counts, so half-open connections
+    that still get messages pushed are closed as well.
+    Each check reschedules itself for the earliest time the connection can be due,
+    so an active connection costs one timer per timeout. Closing the connection
+    cancels the timer.
+    :param timers: the TimerWheel of the loop
+    :param message: the connection
+    :param timeout: idle timeout in seconds
+    :return: None
+    """
+    def check():
+        if message.closed:
+            return
+        if message.request is None:
+            idle_time = message.receive_idle_time()
+        else:
+            idle_time = message.idle_time()
+        if idle_time >= timeout:
+            logger.info('Connection to %s idle for %ss', message.ipaddr, timeout)
+            message.close()
+        elif message.paused_time() > SLOW_PEER_TIMEOUT:
+            logger.warning(
+                'Connection to %s is too slow, closing it after %ss',
+                message.ipaddr, SLOW_PEER_TIMEOUT
+            )
+            message.close()
+        else:
+            message.set_idle_timer(
+                timers, timers.schedule(min(timeout - idle_time, SLOW_PEER_TIMEOUT), check)
+            )
+
+    message.set_idle_timer(timers, timers.schedule(timeout, check))
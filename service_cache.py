@@ -0,0 +1,153 @@
+"""
+Client-side cache of the discovery service's query results.
+Results are fresh for ttl seconds. After that they are still served for up to
+stale seconds while one background refresh fetches them again, and when the
+discovery service can't be reached. Empty results are cached for a shorter time.
+Endpoints are picked at random, weighted by the inverse of their measured latency.
+"""
+import random
+import threading
+import time
+
+from log import get_logger
+
+logger = get_logger(__name__)
+
+TTL = 5
+STALE = 30
+NEGATIVE_TTL = 1
+# weight of a new latency sample in the moving average
+LATENCY_ALPHA = 0.2
+# failures count as this many seconds of latency
+FAILURE_LATENCY = 1.0
+
+
+class QueryCache:
+    """
+    caches the endpoints of each service type and tracks their latency
+    """
+    def __init__(self, fetch, ttl=TTL, stale=STALE, negative_ttl=NEGATIVE_TTL,
+                 clock=time.monotonic, rng=None):
+        """
+        constructor for the QueryCache class
+        :param fetch: callable(type) -> list of dictionaries with 'ip' and 'port'
+        :param ttl: seconds a result is fresh
+        :param stale: seconds a result may be served while it is refreshed
+        :param negative_ttl: seconds an empty result is fresh
+        :param clock: monotonic clock returning seconds
+        :param rng: random.Random used for the selection
+        """
+        self._fetch = fetch
+        self._ttl = ttl
+        self._stale = stale
+        self._negative_ttl = negative_ttl
+        self._clock = clock
+        self._rng = rng or random.Random()
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._refreshing = set()
+        self._latency = {}
+
+    def get(self, type):
+        """
+        returns the endpoints of a type, from the cache if possible
+        :param type: the type of service
+        :return: list of dictionaries with 'ip' and 'port'
+        """
+        now = self._clock()
+        with self._lock:
+            entry = self._entries.get(type)
+        if entry is not None:
+            endpoints, fresh_until, stale_until = entry
+            if now < fresh_until:
+                return endpoints
+            if now < stale_until:
+                self._refresh_in_background(type)
+                return endpoints
+        try:
+            return self._refresh(type)
+        except ValueError:
+            if entry is not None:
+                logger.warning('Discovery service unreachable, serving stale %s endpoints', type)
+                return entry[0]
+            raise
+
+    def select(self, type):
+        """
+        picks one endpoint of a type, faster endpoints are picked more often
+        :param type: the type of service
+        :return: dictionary with 'ip' and 'port', or None if there is none
+        """
+        endpoints = self.get(type)
+        if not endpoints:
+            return None
+        with self._lock:
+            latencies = [
+                self._latency.get((endpoint['ip'], endpoint['port'])) for endpoint in endpoints
+            ]
+        known = [latency for latency in latencies if latency is not None]
+        # unmeasured endpoints get the best known latency, so they are tried soon
+        default = min(known) if known else 1.0
+        weights = [1 / max(latency or default, 1e-6) for latency in latencies]
+        return self._rng.choices(endpoints, weights)[0]
+
+    def record(self, endpoint, seconds):
+        """
+        adds a latency sample for an endpoint
+        :param endpoint: dictionary with 'ip' and 'port'
+        :param seconds: measured response time
+        """
+        key = (endpoint['ip'], endpoint['port'])
+        with self._lock:
+            average = self._latency.get(key)
+            if average is None:
+                self._latency[key] = seconds
+            else:
+                self._latency[key] = average + LATENCY_ALPHA * (seconds - average)
+
+    def record_failure(self, endpoint):
+        """
+        counts a failed call as a slow response
+        :param endpoint: dictionary with 'ip' and 'port'
+        """
+        self.record(endpoint, FAILURE_LATENCY)
+
+    def invalidate(self, type):
+        """
+        forgets the cached endpoints of a type
+        :param type: the type of service
+        """
+        with self._lock:
+            self._entries.pop(type, None)
+
+    def _refresh(self, type):
+        """
+        fetches the endpoints of a type and caches them
+        :return: list of dictionaries with 'ip' and 'port'
+        """
+        endpoints = self._fetch(type)
+        now = self._clock()
+        ttl = self._ttl if endpoints else self._negative_ttl
+        with self._lock:
+            self._entries[type] = (endpoints, now + ttl, now + ttl + self._stale)
+        return endpoints
+
+    def _refresh_in_background(self, type):
+        """
+        starts a refresh of a type unless one is already running
+        """
+        with self._lock:
+            if type in self._refreshing:
+                return
+            self._refreshing.add(type)
+
+        def refresh():
+            try:
+                self._refresh(type)
+            except ValueError as e:
+                logger.warning('Refreshing %s endpoints failed: %s', type, e)
+            finally:
+                with self._lock:
+                    self._refreshing.discard(type)
+
+        threading.Thread(target=refresh, name=f'refresh-{type}', daemon=True).start()
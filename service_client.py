@@ -0,0 +1,405 @@
+"""
+Blocking client for the message wire format.
+ServiceClient keeps a bounded pool of keep-alive connections per (host, port),
+checks idle connections before reusing them and reconnects with backoff.
+"""
+import random
+import select
+import socket
+import threading
+import time
+
+from header_codec import JSON_HEADER, create_header, decode_header, encode_header
+from log import get_logger
+from recv_buffer import RecvBuffer
+from serializers import JSON_CONTENT_TYPE, decode, encode
+
+logger = get_logger(__name__)
+
+# actions that may be sent twice: a failed response on a reused connection is retried
+IDEMPOTENT_ACTIONS = frozenset(('query', 'heartbeat', 'HEARTBEAT', 'WATCH'))
+
+
+class Connection:
+    """
+    one blocking keep-alive connection, requests are sent one at a time
+    """
+    def __init__(self, host, port, timeout, header_format=JSON_HEADER):
+        """
+        constructor for the Connection class
+        :param host: host of the server
+        :param port: port of the server
+        :param timeout: seconds to wait for the connection
+        :param header_format: JSON_HEADER or BINARY_HEADER
+        """
+        self._ipaddr = (host, port)
+        self._socket = socket.create_connection(self._ipaddr, timeout)
+        self._socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._recv_buffer = RecvBuffer()
+        self._header_format = header_format
+        self._next_request_id = 1
+        self.last_used = time.monotonic()
+
+    def call(self, content, content_type, content_encoding, timeout):
+        """
+        sends a request and blocks until its response has arrived
+        :param content: the request content
+        :param content_type: content-type of the request
+        :param content_encoding: the codec to use for encoding
+        :param timeout: seconds to wait for the response
+        :return: the response content
+        """
+        request_id = self.send(content, content_type, content_encoding, timeout)
+        header, response = self.receive(timeout)
+        if header.get('request-id') != request_id:
+            raise ConnectionError(f'Response does not match request {request_id}.')
+        return response
+
+    def send(self, content, content_type, content_encoding, timeout):
+        """
+        sends a request without waiting for the response
+        :param content: the request content
+        :param content_type: content-type of the request
+        :param content_encoding: the codec to use for encoding
+        :param timeout: seconds to wait for the socket
+        :return: the request id
+        """
+        request_id = self._next_request_id
+        self._next_request_id += 1
+        content_bytes = encode(content, content_type, content_encoding)
+        header = create_header(
+            len(content_bytes),
+            content_type,
+            content_encoding,
+            request_id=request_id,
+            keep_alive=True
+        )
+        self._socket.settimeout(timeout)
+        self._socket.sendall(encode_header(header, self._header_format) + content_bytes)
+        return request_id
+
+    def receive(self, timeout):
+        """
+        blocks until the next message has arrived
+        :param timeout: seconds to wait for the message
+        :return: tuple (header, content)
+        """
+        self._socket.settimeout(timeout)
+        decoded = decode_header(self._recv_buffer)
+        while decoded is None:
+            self._receive()
+            decoded = decode_header(self._recv_buffer)
+        _, header = decoded
+        content_len = header['content-length']
+        while len(self._recv_buffer) < content_len:
+            self._receive()
+        with self._recv_buffer.peek(content_len) as data:
+            content = decode(data, header['content-type'], header['content-encoding'])
+        self._recv_buffer.consume(content_len)
+        self.last_used = time.monotonic()
+        return header, content
+
+    def pending(self):
+        """
+        :return: True if data is waiting to be read
+        """
+        if self._recv_buffer:
+            return True
+        readable, _, _ = select.select([self._socket], [], [], 0)
+        return bool(readable)
+
+    def _receive(self):
+        """
+        receives the next chunk of data
+        """
+        if not self._recv_buffer.recv_into(self._socket):
+            raise ConnectionError('Peer closed.')
+
+    def is_healthy(self):
+        """
+        an idle connection must not be readable: that means the peer closed it or sent garbage
+        :return: bool
+        """
+        if self._socket is None:
+            return False
+        try:
+            readable, _, _ = select.select([self._socket], [], [], 0)
+        except (OSError, ValueError):
+            return False
+        return not readable
+
+    def close(self):
+        """
+        closes the connection
+        """
+        if self._socket is not None:
+            try:
+                self._socket.close()
+            except OSError as e:
+                logger.error('Error: socket.close() exception for %s: %r', self._ipaddr, e)
+            self._socket = None
+
+
+class ServiceClient:
+    """
+    Reusable client with a bounded pool of connections per (host, port).
+    call() blocks only until the response has arrived.
+    """
+    def __init__(self, max_connections=4, timeout=5, max_idle=20,
+                 connect_attempts=4, backoff=0.05, max_backoff=1.0,
+                 header_format=JSON_HEADER):
+        """
+        constructor for the ServiceClient class
+        :param max_connections: connections per (host, port) used at the same time
+        :param timeout: default seconds to wait for a connection slot and a response
+        :param max_idle: idle connections older than this are not reused,
+                         must be below the server's idle timeout
+        :param connect_attempts: connection attempts before giving up
+        :param backoff: delay before the first reconnect, doubled on every attempt
+        :param max_backoff: upper limit of the reconnect delay
+        :param header_format: JSON_HEADER or BINARY_HEADER
+        """
+        self._max_connections = max_connections
+        self._timeout = timeout
+        self._max_idle = max_idle
+        self._connect_attempts = connect_attempts
+        self._backoff = backoff
+        self._max_backoff = max_backoff
+        self._header_format = header_format
+        self._lock = threading.Lock()
+        self._idle = {}
+        self._slots = {}
+
+    def call(self, host, port, content, content_type=JSON_CONTENT_TYPE,
+             content_encoding='utf-8', timeout=None):
+        """
+        sends a request over a pooled connection and returns the response
+        :param host: host of the server
+        :param port: port of the server
+        :param content: the request content
+        :param content_type: content-type of the request
+        :param content_encoding: the codec to use for encoding
+        :param timeout: seconds to wait, defaults to the client timeout
+        :return: the response content
+        """
+        if timeout is None:
+            timeout = self._timeout
+        addr = (host, port)
+        slot = self._slot(addr)
+        if not slot.acquire(timeout=timeout):
+            raise TimeoutError(f'No free connection to {addr}.')
+        try:
+            connection, reused = self._checkout(addr, timeout)
+            sent = False
+            try:
+                request_id = connection.send(content, content_type, content_encoding, timeout)
+                sent = True
+                header, response = connection.receive(timeout)
+                if header.get('request-id') != request_id:
+                    raise ConnectionError(f'Response does not match request {request_id}.')
+            except TimeoutError:
+                connection.close()
+                raise
+            except (OSError, ValueError):
+                connection.close()
+                # the server may have dropped a pooled connection: retry once on a fresh one,
+                # unless the request may have reached it and must not be handled twice
+                if not reused or (sent and not _idempotent(content)):
+                    raise
+                connection = self._connect(addr, timeout)
+                try:
+                    response = connection.call(content, content_type, content_encoding, timeout)
+                except (OSError, ValueError):
+                    connection.close()
+                    raise
+            self._checkin(addr, connection)
+            return response
+        finally:
+            slot.release()
+
+    def close(self):
+        """
+        closes all idle connections
+        """
+        with self._lock:
+            idle = self._idle
+            self._idle = {}
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
+
+    def _slot(self, addr):
+        """
+        returns the semaphore that bounds the connections to addr
+        """
+        with self._lock:
+            slot = self._slots.get(addr)
+            if slot is None:
+                slot = threading.BoundedSemaphore(self._max_connections)
+                self._slots[addr] = slot
+            return slot
+
+    def _checkout(self, addr, timeout):
+        """
+        takes a healthy idle connection from the pool or opens a new one
+        :return: tuple (connection, reused)
+        """
+        now = time.monotonic()
+        while True:
+            with self._lock:
+                connections = self._idle.get(addr)
+                connection = connections.pop() if connections else None
+            if connection is None:
+                return self._connect(addr, timeout), False
+            if now - connection.last_used < self._max_idle and connection.is_healthy():
+                return connection, True
+            connection.close()
+
+    def _checkin(self, addr, connection):
+        """
+        returns a connection to the pool
+        """
+        with self._lock:
+            self._idle.setdefault(addr, []).append(connection)
+
+    def _connect(self, addr, timeout):
+        """
+        opens a connection, retrying with exponential backoff and jitter
+        :return: Connection
+        """
+        delay = self._backoff
+        for attempt in range(1, self._connect_attempts + 1):
+            try:
+                return Connection(addr[0], addr[1], timeout, self._header_format)
+            except OSError as e:
+                if attempt == self._connect_attempts:
+                    raise
+                logger.warning('Connection to %s failed (%r), retrying in %.2fs', addr, e, delay)
+                time.sleep(delay * random.uniform(0.5, 1.0))
+                delay = min(delay * 2, self._max_backoff)
+
+
+class Watch:
+    """
+    Follows the services of one type with the WATCH action: the discovery service
+    pushes every change, and the current services are kept in the services attribute.
+    The watch is refreshed before the server's idle timeout and resumes from
+    the last seen version after a reconnect.
+    """
+    def __init__(self, host, port, type, timeout=5, refresh=10, header_format=JSON_HEADER):
+        """
+        constructor for the Watch class
+        :param host: host of the discovery service
+        :param port: port of the discovery service
+        :param type: the type of service to follow
+        :param timeout: seconds to wait for the connection and the WATCH response
+        :param refresh: seconds between WATCH requests, must be below the server's idle timeout
+        :param header_format: JSON_HEADER or BINARY_HEADER
+        """
+        self._ipaddr = (host, port)
+        self._type = type
+        self._timeout = timeout
+        self._refresh = refresh
+        self._header_format = header_format
+        self._connection = None
+        self._refreshed = 0.0
+        self.epoch = None
+        self.version = None
+        self.services = {}
+
+    def poll(self, timeout):
+        """
+        waits up to timeout for changes and applies all that have arrived
+        :param timeout: seconds to wait for a change
+        :return: list of the events applied, a snapshot counts as one 'snapshot' event
+        """
+        deadline = time.monotonic() + timeout
+        applied = []
+        if self._connection is None or time.monotonic() - self._refreshed >= self._refresh:
+            applied = self._watch()
+        while True:
+            remaining = deadline - time.monotonic()
+            if applied or remaining <= 0:
+                if not self._connection.pending():
+                    return applied
+                # only finish reading what has already arrived
+                remaining = 0
+            try:
+                _, update = self._connection.receive(max(remaining, 0.001))
+            except TimeoutError:
+                return applied
+            except (OSError, ValueError) as e:
+                logger.warning('Watch on %s lost (%r), resuming', self._ipaddr, e)
+                self.close()
+                return applied + self._watch()
+            applied += self._apply(update)
+
+    def close(self):
+        """
+        closes the connection
+        """
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def _watch(self):
+        """
+        sends a WATCH from the last seen version, connecting first if needed
+        :return: list of the events applied
+        """
+        if self._connection is None:
+            self._connection = Connection(
+                self._ipaddr[0], self._ipaddr[1], self._timeout, self._header_format
+            )
+        request_id = self._connection.send(
+            {'action': 'WATCH', 'type': self._type, 'since': self.version, 'epoch': self.epoch},
+            JSON_CONTENT_TYPE,
+            'utf-8',
+            self._timeout
+        )
+        self._refreshed = time.monotonic()
+        # changes pushed before the response are applied in version order as well
+        applied = []
+        while True:
+            header, update = self._connection.receive(self._timeout)
+            applied += self._apply(update)
+            if header.get('request-id') == request_id:
+                return applied
+
+    def _apply(self, update):
+        """
+        applies a snapshot or the events in version order
+        :param update: dictionary with 'epoch', 'version' and 'services' or 'events'
+        :return: list of the events applied
+        """
+        if 'services' in update:
+            if update['epoch'] == self.epoch and update['version'] == self.version:
+                return []
+            self.epoch = update['epoch']
+            self.version = update['version']
+            self.services = {
+                service['uuid']: {'ip': service['ip'], 'port': service['port']}
+                for service in update['services']
+            }
+            return [{'event': 'snapshot', 'version': self.version}]
+        if update['epoch'] != self.epoch:
+            return []
+        applied = []
+        for event in update['events']:
+            if event['version'] <= self.version:
+                continue
+            if event['event'] == 'add':
+                self.services[event['uuid']] = {'ip': event['ip'], 'port': event['port']}
+            else:
+                self.services.pop(event['uuid'], None)
+            self.version = event['version']
+            applied.append(event)
+        self.version = max(self.version, update['version'])
+        return applied
+
+
+def _idempotent(content):
+    """
+    :return: True if the request may be handled twice, e.g. a query or a heartbeat
+    """
+    return isinstance(content, dict) and content.get('action') in IDEMPOTENT_ACTIONS
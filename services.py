@@ -1,17 +1,49 @@
 """ This module provides a class to manage a list of services """
+import threading
+import time
 import uuid
-from datetime import datetime
+from collections import OrderedDict, deque
+
+HEARTBEAT_TIMEOUT = 5
+# the store keeps ports as uint16 and the lengths of type and ip as uint16
+MAX_PORT = 0xFFFF
+MAX_FIELD_LENGTH = 0xFFFF
+# changes kept for watchers that resume, older watchers get a snapshot
+EVENT_LOG_SIZE = 10000
 
 
 class Services:
     """
-    manages a list of registered services
+    manages the registered services.
+    Services are indexed by uuid and by type; the expiry order is kept in an
+    OrderedDict with the oldest heartbeat first, so heartbeat is O(1),
+    query is O(k) for k services of a type and expiry only looks at expired entries.
+    Queries don't expire: the loop that owns the registry calls expire in slices,
+    so no request waits for a mass expiry and the watchers learn of every removal.
+    With a RegistryStore every change is logged, and the registry is restored from it.
+    Every add and removal gets a version number, the latest changes are kept
+    so watchers can catch up, and query results are cached per type until the type changes.
     """
-    def __init__(self):
+    def __init__(self, timeout=HEARTBEAT_TIMEOUT, clock=time.monotonic, store=None):
         """
         constructor for the Services class
+        :param timeout: seconds without heartbeat after which a service expires
+        :param clock: monotonic clock returning seconds
+        :param store: optional RegistryStore to restore from and log to
         """
-        self._service_list = []
+        self._timeout = timeout
+        self._clock = clock
+        self._services = {}
+        self._services_by_type = {}
+        self._expiry = OrderedDict()
+        self._query_cache = {}
+        # a new epoch tells watchers that versions of an earlier registry don't apply
+        self._epoch = uuid.uuid4().hex
+        self._version = 0
+        self._events = deque(maxlen=EVENT_LOG_SIZE)
+        self._store = store
+        if store is not None:
+            self._restore()
 
     def register(self, type, ipaddr, port):
         """
@@ -21,15 +53,20 @@ class Services:
         :param port: Portnumber where the service can be reached
         :return: UUID identifying the service, must be supplied for 'heartbeat'
         """
-        service_uuid = str(uuid.uuid4())
-        self._service_list.append({
-            'uuid': service_uuid,
-            'type': type,
-            'ip': ipaddr,
-            'port': port,
-            'heartbeat': datetime.now()
-        })
-        return service_uuid
+        check_service(type, ipaddr, port)
+        return self._register(type, ipaddr, port)
+
+    def register_many(self, records):
+        """
+        registers several services at once
+        :param records: list of dictionaries with the keys 'type', 'ip' and 'port'
+        :return: list of UUIDs in the order of the records
+        """
+        records = [(record['type'], record['ip'], record['port']) for record in records]
+        # all records are checked first, an invalid one registers none of them
+        for type, ipaddr, port in records:
+            check_service(type, ipaddr, port)
+        return [self._register(type, ipaddr, port) for type, ipaddr, port in records]
 
     def heartbeat(self, service_uuid):
         """
@@ -37,21 +74,290 @@ class Services:
         :param service_uuid: UUID identifying the service
         :return: 'OK' / 'NOT FOUND'
         """
-        for service in self._service_list:
-            if service['uuid'] == service_uuid:
-                service['heartbeat'] = datetime.now()
-                return 'OK'
-        return 'NOT FOUND'
+        service = self._services.get(service_uuid)
+        if service is None:
+            return 'NOT FOUND'
+        now = self._clock()
+        service['heartbeat'] = now
+        self._expiry[service_uuid] = now
+        self._expiry.move_to_end(service_uuid)
+        if self._store is not None:
+            self._store.heartbeat(service_uuid)
+        return 'OK'
+
+    def heartbeat_many(self, service_uuids):
+        """
+        updates the heartbeat for several services at once
+        :param service_uuids: list of UUIDs identifying the services
+        :return: list of 'OK' / 'NOT FOUND' in the order of the UUIDs
+        """
+        return [self.heartbeat(service_uuid) for service_uuid in service_uuids]
+
+    def deregister(self, service_uuid):
+        """
+        removes a service before it expires
+        :param service_uuid: UUID identifying the service
+        :return: 'OK' / 'NOT FOUND'
+        """
+        if service_uuid not in self._services:
+            return 'NOT FOUND'
+        del self._expiry[service_uuid]
+        self._remove(service_uuid, 'remove')
+        return 'OK'
 
     def query(self, type):
         """
         Query the list for all active services of a certain type
         :param type: A keyword to identify the services
-        :return: A list of dictionaries with the ip-address and the port of each service
-        """
-        results = []
-        for service in self._service_list:
-            duration = datetime.now() - service['heartbeat']
-            if duration.total_seconds() > 5:
-                self._service_list.remove(service)
-        return str(results)
+        :return: A list of dictionaries with the ip-address and the port of each service,
+                 shared between callers until the type changes, so it must not be modified
+        """
+        result = self._query_cache.get(type)
+        if result is None:
+            services = self._services_by_type.get(type, {})
+            result = [
+                {'ip': service['ip'], 'port': service['port']}
+                for service in services.values()
+            ]
+            self._query_cache[type] = result
+        return result
+
+    def version(self):
+        """
+        :return: the version of the latest change
+        """
+        return self._version
+
+    def changes(self, type, since=None, epoch=None):
+        """
+        returns what changed for a type since a version, or a snapshot if the
+        changes are no longer known
+        :param type: A keyword to identify the services
+        :param since: version the caller has seen
+        :param epoch: epoch of that version
+        :return: dictionary with 'epoch', 'version' and either the list of 'events'
+                 or the list of 'services' with their uuid, ip-address and port
+        """
+        oldest = self._events[0][0] if self._events else self._version + 1
+        if epoch == self._epoch and since is not None and oldest - 1 <= since <= self._version:
+            events = []
+            for version, event_type, event in reversed(self._events):
+                if version <= since:
+                    break
+                if event_type == type:
+                    events.append(event)
+            events.reverse()
+            return {'epoch': self._epoch, 'version': self._version, 'events': events}
+        services = self._services_by_type.get(type, {})
+        return {
+            'epoch': self._epoch,
+            'version': self._version,
+            'services': [
+                {'uuid': service['uuid'], 'ip': service['ip'], 'port': service['port']}
+                for service in services.values()
+            ]
+        }
+
+    def expire(self, limit=None):
+        """
+        removes the services whose last heartbeat is older than the timeout
+        :param limit: maximum number of services to remove, None removes all
+        :return: list of the removed services
+        """
+        deadline = self._clock() - self._timeout
+        expired = []
+        while self._expiry and (limit is None or len(expired) < limit):
+            service_uuid, last_heartbeat = next(iter(self._expiry.items()))
+            if last_heartbeat >= deadline:
+                break
+            self._expiry.popitem(last=False)
+            expired.append(self._remove(service_uuid, 'expire'))
+        return expired
+
+    def flush(self):
+        """
+        writes the buffered changes to the store and compacts its log when it has grown
+        too long, called by the maintenance of the loops instead of a request
+        """
+        if self._store is not None:
+            self._maybe_compact()
+            self._store.flush()
+
+    def close(self):
+        """
+        flushes and closes the store
+        """
+        if self._store is not None:
+            self._store.close()
+
+    def _register(self, type, ipaddr, port):
+        """
+        registers a checked service, it is logged before it is added,
+        so a record the store can't write leaves the registry unchanged
+        """
+        service_uuid = str(uuid.uuid4())
+        if self._store is not None:
+            self._store.register(service_uuid, type, ipaddr, port)
+        service = self._insert(service_uuid, type, ipaddr, port, self._clock())
+        self._add_event('add', service)
+        return service_uuid
+
+    def _insert(self, service_uuid, type, ipaddr, port, heartbeat):
+        """
+        adds a service to all indexes, it must have the latest heartbeat
+        """
+        service = {
+            'uuid': service_uuid,
+            'type': type,
+            'ip': ipaddr,
+            'port': port,
+            'heartbeat': heartbeat
+        }
+        self._services[service_uuid] = service
+        self._services_by_type.setdefault(type, {})[service_uuid] = service
+        self._expiry[service_uuid] = heartbeat
+        self._query_cache.pop(type, None)
+        return service
+
+    def _remove(self, service_uuid, event):
+        """
+        removes a service from all indexes
+        :param service_uuid: UUID identifying the service
+        :param event: 'remove' or 'expire'
+        :return: the removed service
+        """
+        service = self._services.pop(service_uuid)
+        services = self._services_by_type[service['type']]
+        del services[service_uuid]
+        if not services:
+            del self._services_by_type[service['type']]
+        self._query_cache.pop(service['type'], None)
+        self._add_event(event, service)
+        if self._store is not None:
+            self._store.expire(service_uuid)
+        return service
+
+    def _add_event(self, event, service):
+        """
+        records a change with the next version
+        :param event: 'add', 'remove' or 'expire'
+        :param service: the service that changed
+        """
+        self._version += 1
+        self._events.append((self._version, service['type'], {
+            'event': event,
+            'version': self._version,
+            'uuid': service['uuid'],
+            'ip': service['ip'],
+            'port': service['port']
+        }))
+
+    def _restore(self):
+        """
+        loads the services from the store.
+        The downtime is not counted against them: every service keeps
+        the age its heartbeat had when the store was last written.
+        """
+        records, saved_at = self._store.load()
+        now = self._clock()
+        for service_uuid, type, ipaddr, port, heartbeat in records:
+            self._insert(service_uuid, type, ipaddr, port, now - (saved_at - heartbeat))
+        self._store.open()
+        self.expire()
+
+    def _maybe_compact(self):
+        """
+        compacts the store's log into a snapshot when it has grown too long
+        """
+        if not self._store.should_compact(len(self._services)):
+            return
+        offset = time.time() - self._clock()
+        services = (self._services[service_uuid] for service_uuid in self._expiry)
+        self._store.compact(
+            (service['uuid'], service['type'], service['ip'], service['port'],
+             service['heartbeat'] + offset)
+            for service in services
+        )
+
+    def __len__(self):
+        return len(self._services)
+
+
+class LockedServices(Services):
+    """
+    Services shared between threads, e.g. the registry of a RegistryManager,
+    which serves every proxy connection on its own thread.
+    Every public method holds the lock, so a query never iterates an index
+    that a registration changes and every change gets its own version.
+    """
+    def __init__(self, *args, **kwargs):
+        """
+        constructor for the LockedServices class, takes the arguments of Services
+        """
+        # reentrant, heartbeat_many calls heartbeat
+        self._lock = threading.RLock()
+        with self._lock:
+            super().__init__(*args, **kwargs)
+
+    def register(self, type, ipaddr, port):
+        with self._lock:
+            return super().register(type, ipaddr, port)
+
+    def register_many(self, records):
+        with self._lock:
+            return super().register_many(records)
+
+    def heartbeat(self, service_uuid):
+        with self._lock:
+            return super().heartbeat(service_uuid)
+
+    def heartbeat_many(self, service_uuids):
+        with self._lock:
+            return super().heartbeat_many(service_uuids)
+
+    def deregister(self, service_uuid):
+        with self._lock:
+            return super().deregister(service_uuid)
+
+    def query(self, type):
+        with self._lock:
+            return super().query(type)
+
+    def version(self):
+        with self._lock:
+            return super().version()
+
+    def changes(self, type, since=None, epoch=None):
+        with self._lock:
+            return super().changes(type, since, epoch)
+
+    def expire(self, limit=None):
+        with self._lock:
+            return super().expire(limit)
+
+    def flush(self):
+        with self._lock:
+            super().flush()
+
+    def close(self):
+        with self._lock:
+            super().close()
+
+    def __len__(self):
+        with self._lock:
+            return super().__len__()
+
+
+def check_service(type, ipaddr, port):
+    """
+    checks a service before it is registered
+    :raises ValueError: if the type or ip is not a string, too long for the store,
+                        or the port is not an int from 0 to MAX_PORT
+    """
+    for name, value in (('type', type), ('ip', ipaddr)):
+        if not isinstance(value, str):
+            raise ValueError(f'The {name} must be a string, not {value!r}.')
+        if len(value.encode('utf-8')) > MAX_FIELD_LENGTH:
+            raise ValueError(f'The {name} is longer than {MAX_FIELD_LENGTH} bytes.')
+    if isinstance(port, bool) or not isinstance(port, int) or not 0 <= port <= MAX_PORT:
+        raise ValueError(f'The port must be an int from 0 to {MAX_PORT}, not {port!r}.')
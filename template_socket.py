@@ -1,13 +1,31 @@
 from bots.templatebot import TemplateBot
+import argparse
+import asyncio
 import selectors
 import socket
-import traceback
-from client_message import ClientMessage
-from server_message import ServerMessage
+import threading
+import time
+import log
+from async_message import AsyncClientMessage, start_server
+from client_message import KeepAliveClientMessage
+from header_codec import JSON_HEADER
+from profiling import profiler
+from server_message import ServerMessage, close_idle_connections
+from service_cache import QueryCache
+from service_client import ServiceClient
 from services import Services
 
 HOST = '127.0.0.1'
 PORT = 65432
+BOT_HOST = '127.0.0.1'
+IDLE_TIMEOUT = 30
+HEARTBEAT_INTERVAL = 2
+REQUEST_TIMEOUT = 5
+
+logger = log.get_logger(__name__)
+
+_client = ServiceClient(timeout=REQUEST_TIMEOUT)
+_cache = QueryCache(lambda type: send_request({'action': 'query', 'type': type}))
 
 def main():
     """
@@ -16,30 +34,34 @@ def main():
     """
     bot = TemplateBot("LucaTopBot")
 
-    item = {'action': 'MEOW',
-            'ip': '127.0.0.1',
-            'name': 'LucaTopBot',
-            'type': 'bot'}
+    sel = selectors.DefaultSelector()
+    services = Services()
 
-    print(f'Registration service {item["type"]} {item["ip"]}')
-    try:
-        port1 = int(send_request(item))  # Convert to int here
-        host1 = '127.0.0.1'
+    # the OS picks a free port, which is then registered with the discovery service
+    lsock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    lsock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    lsock.bind((BOT_HOST, 0))
+    port = lsock.getsockname()[1]
+
+    item = create_registration(port)
 
-        sel = selectors.DefaultSelector()
-        services = Services()
+    logger.info('Registration service %s %s', item['type'], item['ip'])
+    try:
+        service_uuid = send_request(item)
+        logger.info('Registered as %s', service_uuid)
+        heartbeats = HeartbeatAggregator()
+        heartbeats.add(service_uuid)
+        heartbeats.start()
 
-        lsock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        lsock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        lsock.bind((host1, port1))
         lsock.listen()
-        print(f'Listening on {(port1, host1)}')
+        logger.info('Listening on %s', (BOT_HOST, port))
         lsock.setblocking(False)
         sel.register(lsock, selectors.EVENT_READ, data=None)
+        profiler.install_signals()
 
         try:
             while True:
-                events = sel.select(timeout=None)
+                events = sel.select(timeout=1)
                 for key, mask in events:
                     if key.data is None:
                         accept_wrapper(sel, key.fileobj)
@@ -47,20 +69,22 @@ def main():
                         message = key.data
                         try:
                             message.process_events(mask)
-                            process_action(message, services)
+                            with profiler.span('process_action'):
+                                process_action(message, services)
                         except Exception:
-                            print(
-                                f'Main: Error: Exception for {message.ipaddr}:\n'
-                                f'{traceback.format_exc()}'
-                            )
+                            logger.exception('Main: Error: Exception for %s', message.ipaddr)
                             message._close()
+                close_idle_connections(sel, IDLE_TIMEOUT)
         except KeyboardInterrupt:
-            print('Caught keyboard interrupt, exiting')
+            logger.info('Caught keyboard interrupt, exiting')
         finally:
+            heartbeats.stop()
             sel.close()
-            
+            profiler.stop()
+
     except ValueError as e:
-        print(f"Error: {e}")
+        logger.error('Error: %s', e)
+        lsock.close()
         return
 
 def process_action(message, services):
@@ -69,58 +93,256 @@ def process_action(message, services):
     :param message: the message object
     :param services: the services object
     """
-    if message.event == 'READ':
-        action = message.request['action']
-        message.response = 'TODO Response from the method'
+    if message.event == 'READ' and message.request is not None:
+        message.response = handle_request(message.request)
         message.set_selector_events_mask('w')
 
+def handle_request(request):
+    """
+    answers a request sent to the bot,
+    the admin action profile switches the profiler on and off
+    :param request: the decoded request
+    :return: the response, UNKNOWN ACTION for an action the bot doesn't serve
+    """
+    action = request['action']
+    if action == 'profile':
+        return profiler.control(request.get('enable'))
+    return f'UNKNOWN ACTION {action}'
+
+def create_registration(port):
+    """
+    creates the MEOW action that registers this bot
+    :param port: the port the bot listens on
+    :return: dict
+    """
+    return {'action': 'MEOW',
+            'ip': BOT_HOST,
+            'port': port,
+            'name': 'LucaTopBot',
+            'type': 'bot'}
+
+async def run_async():
+    """
+    runs the bot on the asyncio transport: serves requests and
+    sends heartbeats with deadlines on one keep-alive connection
+    :return:
+    """
+    server = await start_server(
+        handle_request, BOT_HOST, 0, deadline=REQUEST_TIMEOUT, idle_timeout=IDLE_TIMEOUT
+    )
+    port = server.sockets[0].getsockname()[1]
+    item = create_registration(port)
+    logger.info('Registration service %s %s', item['type'], item['ip'])
+
+    client = await AsyncClientMessage.connect(HOST, PORT)
+    try:
+        service_uuid = await client.request(item, timeout=REQUEST_TIMEOUT)
+        logger.info('Registered as %s, listening on %s', service_uuid, (BOT_HOST, port))
+        async with server, asyncio.TaskGroup() as group:
+            group.create_task(server.serve_forever())
+            group.create_task(heartbeat_loop(client, service_uuid))
+    finally:
+        client.close()
+
+async def heartbeat_loop(client, service_uuid, interval=HEARTBEAT_INTERVAL):
+    """
+    sends a heartbeat every interval seconds, each one must be answered within the interval
+    :param client: AsyncClientMessage connected to the discovery service
+    :param service_uuid: UUID returned by the registration
+    :param interval: seconds between heartbeats
+    :return:
+    """
+    while True:
+        await asyncio.sleep(interval)
+        response = await client.request(
+            {'action': 'heartbeat', 'uuid': service_uuid}, timeout=interval
+        )
+        if response != 'OK':
+            logger.warning('Heartbeat for %s answered with %r', service_uuid, response)
+
+def main_async():
+    """
+    main function for the socket-controller on the asyncio transport
+    :return:
+    """
+    try:
+        asyncio.run(run_async())
+    except KeyboardInterrupt:
+        logger.info('Caught keyboard interrupt, exiting')
+
 def accept_wrapper(sel, sock):
     """
     accept a connection
     """
     conn, addr = sock.accept()
-    print(f'Accepted connection from {addr}')
+    logger.debug('Accepted connection from %s', addr)
     conn.setblocking(False)
     message = ServerMessage(sel, conn, addr)
     sel.register(conn, selectors.EVENT_READ, data=message)
 
 def send_request(action):
     """
-    sends a request to the server
+    sends a request to the server over a pooled connection
     :param action: the action to send
-    :return: the port number received from server
+    :return: the response received from server
+    """
+    try:
+        return _client.call(HOST, PORT, action, timeout=REQUEST_TIMEOUT)
+    except OSError as e:
+        raise ValueError(f'No response received from server: {e!r}')
+
+def locate(type):
+    """
+    finds a service of a type through the query cache, faster services are preferred
+    :param type: the type of service
+    :return: dictionary with 'ip' and 'port', or None if there is none
+    """
+    return _cache.select(type)
+
+def call_service(type, content):
+    """
+    sends a request to a service of a type and measures its latency for locate
+    :param type: the type of service
+    :param content: the request content
+    :return: the response received from the service
+    """
+    endpoint = locate(type)
+    if endpoint is None:
+        raise ValueError(f'No service of type {type} registered')
+    start = time.monotonic()
+    try:
+        response = _client.call(endpoint['ip'], endpoint['port'], content, timeout=REQUEST_TIMEOUT)
+    except OSError as e:
+        _cache.record_failure(endpoint)
+        raise ValueError(f'No response received from {type} service: {e!r}')
+    _cache.record(endpoint, time.monotonic() - start)
+    return response
+
+def register_services(records):
+    """
+    registers several services with one batched MEOW
+    :param records: list of dictionaries with the keys 'type', 'ip' and 'port'
+    :return: list of UUIDs in the order of the records
+    """
+    return send_request({'action': 'MEOW', 'services': list(records)})
+
+def send_heartbeats(service_uuids):
+    """
+    sends the heartbeats of several services with one batched HEARTBEAT
+    :param service_uuids: list of UUIDs returned by the registration
+    :return: list of 'OK' / 'NOT FOUND' in the order of the UUIDs
+    """
+    return send_request({'action': 'HEARTBEAT', 'uuids': list(service_uuids)})
+
+class HeartbeatAggregator:
+    """
+    Collects the services running in this process and keeps them all alive
+    with one batched HEARTBEAT every interval, sent from a background thread.
+    Services the discovery service no longer knows are dropped.
+    """
+    def __init__(self, interval=HEARTBEAT_INTERVAL):
+        """
+        constructor for the HeartbeatAggregator class
+        :param interval: seconds between heartbeats, must stay below the heartbeat timeout
+        """
+        self._interval = interval
+        self._lock = threading.Lock()
+        self._service_uuids = set()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def add(self, service_uuid):
+        """
+        adds a service to the next heartbeats
+        :param service_uuid: UUID returned by the registration
+        """
+        with self._lock:
+            self._service_uuids.add(service_uuid)
+
+    def remove(self, service_uuid):
+        """
+        stops sending heartbeats for a service
+        :param service_uuid: UUID returned by the registration
+        """
+        with self._lock:
+            self._service_uuids.discard(service_uuid)
+
+    def start(self):
+        """
+        starts the background thread
+        """
+        if self._thread is None:
+            self._stopped.clear()
+            self._thread = threading.Thread(
+                target=self._run, name='heartbeat-aggregator', daemon=True
+            )
+            self._thread.start()
+
+    def stop(self):
+        """
+        stops the background thread
+        """
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def beat(self):
+        """
+        sends one batched heartbeat for all services
+        :return: dict with the result per UUID
+        """
+        with self._lock:
+            service_uuids = list(self._service_uuids)
+        if not service_uuids:
+            return {}
+        results = dict(zip(service_uuids, send_heartbeats(service_uuids)))
+        lost = [service_uuid for service_uuid, result in results.items() if result != 'OK']
+        if lost:
+            logger.warning('Services %s are no longer registered', lost)
+            with self._lock:
+                self._service_uuids.difference_update(lost)
+        return results
+
+    def _run(self):
+        """
+        sends a heartbeat every interval until stopped
+        """
+        while not self._stopped.wait(self._interval):
+            try:
+                self.beat()
+            except ValueError as e:
+                logger.error('Error: %s', e)
+
+def send_requests(actions, header_format=JSON_HEADER):
+    """
+    sends several requests pipelined over one keep-alive connection
+    :param actions: list of actions to send
+    :param header_format: JSON_HEADER or BINARY_HEADER, the server answers in kind
+    :return: list of responses in the order of the actions
     """
     sel = selectors.DefaultSelector()
-    request = create_request(action)
-    start_connection(sel, HOST, PORT, request)
-    
-    return_port = None
-    
+    message = start_keep_alive_connection(sel, HOST, PORT, header_format)
+    request_ids = [
+        message.queue_request(create_request(action)) for action in actions
+    ]
+
     try:
-        while True:
-            events = sel.select(timeout=1)
+        while message.pending:
+            events = sel.select(timeout=IDLE_TIMEOUT)
+            if not events:
+                raise ValueError('Timeout waiting for responses from server')
             for key, mask in events:
-                message = key.data
-                try:
-                    message.process_events(mask)
-                    if message.response is not None:
-                        return_port = message.response
-                except Exception:
-                    print(
-                        f'Main: Error: Exception for {message.ipaddr}:\n'
-                        f'{traceback.format_exc()}'
-                    )
-                    message._close()
-            if not sel.get_map():
-                break
-    except KeyboardInterrupt:
-        print('Caught keyboard interrupt, exiting')
+                key.data.process_events(mask)
+    except (OSError, RuntimeError) as e:
+        # the server closed the connection or reset it before all responses arrived
+        raise ValueError(f'No response received from server: {e!r}')
     finally:
+        if sel.get_map():
+            message.close()
         sel.close()
-    
-    if return_port is None:
-        raise ValueError("No port received from server")
-    return return_port
+
+    return [message.pop_response(request_id) for request_id in request_ids]
 
 def create_request(action_item):
     return dict(
@@ -129,15 +351,24 @@ def create_request(action_item):
         content=action_item,
     )
 
-def start_connection(sel, host, port, request):
+def start_keep_alive_connection(sel, host, port, header_format=JSON_HEADER):
     addr = (host, port)
-    print(f'Starting connection to {addr}')
+    logger.debug('Starting keep-alive connection to %s', addr)
     sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     sock.setblocking(False)
     sock.connect_ex(addr)
-    events = selectors.EVENT_READ | selectors.EVENT_WRITE
-    message = ClientMessage(sel, sock, addr, request)
-    sel.register(sock, events, data=message)
+    message = KeepAliveClientMessage(sel, sock, addr, header_format)
+    sel.register(sock, selectors.EVENT_READ, data=message)
+    return message
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='socket-controller for a bot')
+    parser.add_argument(
+        '--asyncio', action='store_true', help='use the asyncio transport'
+    )
+    args = parser.parse_args()
+    log.configure()
+    if args.asyncio:
+        main_async()
+    else:
+        main()
\ No newline at end of file
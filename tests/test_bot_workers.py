@@ -0,0 +1,79 @@
+import json
+import os
+
+import pytest
+
+from bot_workers import BotError, RemoteBot
+
+DEFAULTS = {'PLAY': 'default'}
+
+
+class CountingBot:
+    """
+    answers with the number of requests it has seen, exits on CRASH
+    """
+    def __init__(self, name):
+        self.name = name
+        self.seen = 0
+
+    def request(self, payload):
+        action = json.loads(payload)['action']
+        if action in ('CRASH', 'POISON'):
+            os._exit(1)
+        if action == 'RAISE':
+            raise KeyError('kitten')
+        if action == 'SET':
+            return {1, 2}
+        self.seen += 1
+        return self.seen
+
+
+def payload(action):
+    return json.dumps({'action': action})
+
+
+@pytest.fixture
+def bot():
+    remote = RemoteBot('counter', CountingBot, 2.0, DEFAULTS)
+    remote.new_game()
+    yield remote
+    remote.close()
+
+
+def test_requests_are_answered(bot):
+    assert [bot.request(payload('PLAY')) for _ in range(3)] == [1, 2, 3]
+
+
+def test_restarted_worker_catches_up_with_the_game(bot):
+    bot.request(payload('PLAY'))
+    bot.notify(payload('INFORM'))
+    assert bot.request(payload('PLAY')) == 3
+    assert bot.request(payload('CRASH')) is None
+    assert bot.restarts == 1
+    # the fresh bot saw the requests of the game again
+    assert bot.request(payload('PLAY')) == 4
+
+
+def test_new_game_starts_without_history(bot):
+    bot.request(payload('PLAY'))
+    bot.new_game()
+    bot.request(payload('CRASH'))
+    assert bot.request(payload('PLAY')) == 1
+
+
+def test_failed_replay_ends_the_game(bot):
+    bot.request(payload('PLAY'))
+    # the worker exits on the notification, the replay sends it again
+    bot.notify(payload('POISON'))
+    with pytest.raises(BotError):
+        bot.request(payload('PLAY'))
+    # the next game gets a working bot
+    bot.new_game()
+    assert bot.request(payload('PLAY')) == 1
+
+
+@pytest.mark.parametrize('action', ['RAISE', 'SET'])
+def test_failing_bot_raises(bot, action):
+    with pytest.raises(BotError):
+        bot.request(payload(action))
+    assert bot.restarts == 0
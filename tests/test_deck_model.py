@@ -0,0 +1,74 @@
+import pytest
+
+# LucaBot needs the card types of the game package
+lucabot = pytest.importorskip('bots.lucabot')
+CardType = lucabot.CardType
+DeckModel = lucabot.DeckModel
+
+
+def new_deck(deck_size=10, kittens=2, defuses=4):
+    deck = DeckModel()
+    deck.start({CardType.EXPLODING_KITTEN: kittens, CardType.DEFUSE: defuses}, deck_size)
+    return deck
+
+
+def test_probability_of_unknown_cards():
+    deck = new_deck(deck_size=10, kittens=2)
+    assert deck.unknown_kittens() == 2
+    assert deck.exploding_kitten_probability() == pytest.approx(0.2)
+
+
+def test_see_the_future_and_draws():
+    deck = new_deck(deck_size=10, kittens=2)
+    deck.see_the_future([CardType.SKIP, CardType.EXPLODING_KITTEN, CardType.SHUFFLE])
+    assert deck.exploding_kitten_probability() == 0.0
+    assert deck.exploding_kitten_probability(1) == 1.0
+    # one kitten left at the 7 unknown positions
+    assert deck.exploding_kitten_probability(3) == pytest.approx(1 / 7)
+    deck.sync(9)
+    assert deck.known(0) == CardType.EXPLODING_KITTEN
+    assert deck.known_positions() == {0: CardType.EXPLODING_KITTEN, 1: CardType.SHUFFLE}
+
+
+def test_shuffle_forgets_the_positions():
+    deck = new_deck()
+    deck.see_the_future([CardType.EXPLODING_KITTEN, CardType.SKIP, CardType.SKIP])
+    deck.card_played(CardType.SHUFFLE)
+    assert deck.known_positions() == {}
+    assert deck.unknown_kittens() == 2
+
+
+def test_own_defuse_keeps_the_inserted_kitten():
+    deck = new_deck(deck_size=10)
+    deck.see_the_future([CardType.SKIP, CardType.SKIP, CardType.SKIP])
+    deck.kitten_inserted(1)
+    # the DEFUSE of the own bot is reported after handle_exploding_kitten
+    deck.card_played(CardType.DEFUSE)
+    assert deck.deck_size == 11
+    assert deck.known_positions() == {
+        0: CardType.SKIP, 1: CardType.EXPLODING_KITTEN, 2: CardType.SKIP, 3: CardType.SKIP,
+    }
+    # a defuse of another bot puts a kitten back at an unknown position
+    deck.card_played(CardType.DEFUSE)
+    assert deck.known_positions() == {}
+
+
+def test_hand_counters():
+    deck = new_deck(defuses=4)
+    deck.add_to_hand(CardType.DEFUSE)
+    deck.add_to_hand(CardType.SKIP)
+    deck.remove_from_hand(CardType.SKIP)
+    deck.card_played(CardType.DEFUSE)
+    assert deck.hand_size == 1
+    assert deck.unseen(CardType.DEFUSE) == 2
+
+
+def test_situation_key_tells_deck_states_apart():
+    Situation = lucabot.Situation
+    base = Situation(20, {}, 1, 1, 1, 0.5, True)
+    # a known safe card below the window leaves fewer unknown cards for the kitten
+    beyond = Situation(20, {15: False}, 1, 1, 1, 0.5, True)
+    kitten_beyond = Situation(20, {15: True}, 1, 1, 1, 0.5, True)
+    assert base.window < 15
+    assert len({base.key, beyond.key, kitten_beyond.key}) == 3
+    assert Situation(20, {}, 1, 1, 1, 0.5, True).key == base.key
@@ -0,0 +1,50 @@
+import multiprocessing
+
+from discovery_service import RegistryManager, handle_request
+
+REQUESTS = 300
+WORKERS = 3
+
+
+def register_worker(services, number, errors):
+    try:
+        for port in range(REQUESTS):
+            handle_request({'action': 'MEOW', 'type': 'bot', 'ip': f'10.0.0.{number}', 'port': port},
+                           services)
+    except Exception as e:
+        errors.put(repr(e))
+
+
+def query_worker(services, errors):
+    try:
+        for _ in range(REQUESTS):
+            handle_request({'action': 'query', 'type': 'bot'}, services)
+    except Exception as e:
+        errors.put(repr(e))
+
+
+def test_workers_register_and_query_concurrently():
+    manager = RegistryManager()
+    manager.start()
+    try:
+        services = manager.Services()
+        epoch = services.changes('bot')['epoch']
+        errors = multiprocessing.Queue()
+        workers = [
+            multiprocessing.Process(target=register_worker, args=(services, number, errors))
+            for number in range(WORKERS)
+        ] + [
+            multiprocessing.Process(target=query_worker, args=(services, errors))
+            for _ in range(WORKERS)
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join(timeout=60)
+        assert [worker.exitcode for worker in workers] == [0] * len(workers)
+        assert errors.empty()
+        assert len(services.query('bot')) == WORKERS * REQUESTS
+        changes = services.changes('bot', 0, epoch)
+        assert [event['version'] for event in changes['events']] == list(range(1, WORKERS * REQUESTS + 1))
+    finally:
+        manager.shutdown()
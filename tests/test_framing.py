@@ -0,0 +1,78 @@
+import socket
+import threading
+
+import pytest
+
+from bot_workers import _Channel
+from header_codec import BINARY_HEADER, JSON_HEADER, create_header, decode_header, encode_header
+from recv_buffer import INITIAL_SIZE, MIN_FREE, RecvBuffer
+from serializers import COMPACT_CONTENT_TYPE, JSON_CONTENT_TYPE, TEXT_CONTENT_TYPE
+
+
+@pytest.mark.parametrize('header_format', [JSON_HEADER, BINARY_HEADER])
+def test_header_round_trip_in_single_bytes(header_format):
+    header = create_header(42, JSON_CONTENT_TYPE, 'utf-8', request_id=7, keep_alive=True)
+    encoded = encode_header(header, header_format)
+    buffer = RecvBuffer()
+    for byte in encoded[:-1]:
+        buffer.extend(bytes([byte]))
+        assert decode_header(buffer) is None
+    buffer.extend(encoded[-1:])
+    decoded_format, decoded = decode_header(buffer)
+    assert decoded_format == header_format
+    assert {name: decoded[name] for name in header} == header
+    assert not buffer
+
+
+def test_buffer_starts_small_and_grows_on_demand():
+    buffer = RecvBuffer()
+    view = buffer.get_buffer(-1)
+    assert MIN_FREE <= len(view) <= INITIAL_SIZE
+    view.release()
+    data = bytes(range(256)) * 1024
+    buffer.extend(data)
+    assert len(buffer) == len(data)
+    assert buffer.take(len(data)) == data
+
+
+def test_recv_into_fills_the_free_tail():
+    left, right = socket.socketpair()
+    with left, right:
+        data = b'x' * (3 * INITIAL_SIZE)
+        left.sendall(data)
+        buffer = RecvBuffer()
+        received = 0
+        while received < len(data):
+            received += buffer.recv_into(right)
+        assert buffer.take(len(data)) == data
+
+
+@pytest.mark.parametrize('header_format', [JSON_HEADER, BINARY_HEADER])
+def test_messages_round_trip_over_a_socket(header_format):
+    left, right = socket.socketpair()
+    sender = _Channel(left, header_format)
+    receiver = _Channel(right, header_format)
+    messages = [
+        ({'action': 'PLAY', 'cards': ['SKIP', 'NORMAL'], 'count': -3}, COMPACT_CONTENT_TYPE, 'binary'),
+        ({'action': 'query', 'type': 'bot'}, JSON_CONTENT_TYPE, 'utf-8'),
+        # larger than the initial buffer and than a socket buffer
+        ('kitten ' * 100000, TEXT_CONTENT_TYPE, 'utf-8'),
+        ({'action': 'DRAW'}, COMPACT_CONTENT_TYPE, 'binary'),
+    ]
+
+    def send():
+        for request_id, (content, content_type, encoding) in enumerate(messages):
+            sender.send(content, content_type, encoding, request_id)
+
+    thread = threading.Thread(target=send)
+    thread.start()
+    try:
+        for request_id, (content, content_type, _) in enumerate(messages):
+            header, received = receiver.receive(5)
+            assert header['request-id'] == request_id
+            assert header['content-type'] == content_type
+            assert received == content
+    finally:
+        thread.join()
+        sender.close()
+        receiver.close()
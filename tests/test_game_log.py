@@ -0,0 +1,35 @@
+import pytest
+
+game_log = pytest.importorskip('game_log')
+card = pytest.importorskip('card')
+
+
+def test_cards_survive_the_log(tmp_path):
+    hand = [card.Card(card.CardType.DEFUSE), card.Card(card.CardType.SKIP)]
+    recorder = game_log.GameRecorder(7, ['a', 'b'])
+    recorder.turn(0, 'PLAY', {'hand': hand}, hand[1])
+    recorder.turn(1, 'START', {'card_type': card.CardType.NORMAL}, None)
+    recorder.finish(['b', 'a'])
+    path = str(tmp_path / 'games.log')
+    writer = game_log.GameLogWriter(path)
+    writer.write(recorder)
+    writer.close()
+
+    game, = game_log.read_games(path)
+    assert (game.seed, game.bots, game.ranking) == (7, ['a', 'b'], ['b', 'a'])
+    (bot, action, data, response), turn = game.turns
+    assert (bot, action) == (0, 'PLAY')
+    data = game_log._rebuild(data)
+    assert [c.card_type for c in data['hand']] == [card.CardType.DEFUSE, card.CardType.SKIP]
+    response = game_log._rebuild(response)
+    assert isinstance(response, card.Card) and response.card_type == card.CardType.SKIP
+    assert game_log._rebuild(turn[2]) == {'card_type': card.CardType.NORMAL}
+    # the recorded data is compared with the plain form of the arena's data
+    assert turn[2] == game_log._plain({'card_type': card.CardType.NORMAL})
+
+
+def test_logs_of_another_version_are_rejected(tmp_path):
+    path = tmp_path / 'old.log'
+    path.write_bytes(game_log.HEADER.pack(game_log.MAGIC, 1))
+    with pytest.raises(ValueError):
+        list(game_log.read_games(str(path)))
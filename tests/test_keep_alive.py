@@ -0,0 +1,115 @@
+import selectors
+import socket
+
+import pytest
+
+from client_message import KeepAliveClientMessage
+from discovery_service import process_action
+from serializers import JSON_CONTENT_TYPE
+from server_message import ServerMessage
+from services import Services
+from watchers import Watchers
+
+
+def request(**content):
+    return {'type': JSON_CONTENT_TYPE, 'encoding': 'utf-8', 'content': content}
+
+
+QUERY = request(action='query', type='bot')
+
+
+@pytest.fixture
+def connection():
+    """
+    a server and a keep-alive client connection over a socketpair, in one selector
+    """
+    selector = selectors.DefaultSelector()
+    server_socket, client_socket = socket.socketpair()
+    server_socket.setblocking(False)
+    client_socket.setblocking(False)
+    server = ServerMessage(selector, server_socket, 'client')
+    client = KeepAliveClientMessage(selector, client_socket, 'server')
+    selector.register(server_socket, selectors.EVENT_READ, data=server)
+    selector.register(client_socket, selectors.EVENT_READ, data=client)
+    yield selector, server, client
+    client.close()
+    server.close()
+    selector.close()
+
+
+def run(selector, services, done, rounds=20, watchers=None):
+    """
+    runs select rounds as the loop of the discovery service does until done() is true
+    :return: number of rounds it took
+    """
+    for count in range(1, rounds + 1):
+        for key, mask in selector.select(timeout=0.1):
+            message = key.data
+            message.process_events(mask)
+            if isinstance(message, ServerMessage):
+                process_action(message, services, watchers)
+        if watchers is not None:
+            watchers.notify(services)
+        if done():
+            return count
+    raise AssertionError(f'not done after {rounds} rounds')
+
+
+def test_push_and_request_in_the_same_round_are_both_handled(connection):
+    selector, server, client = connection
+    services = Services()
+    services.register('bot', '10.0.0.1', 1000)
+    first = client.queue_request(QUERY)
+    run(selector, services, lambda: not client.pending)
+    assert client.pop_response(first) == [{'ip': '10.0.0.1', 'port': 1000}]
+
+    # the push sets the server's mask to rw, the next request arrives before the
+    # loop selects again, so it is read in the same round as the push is written
+    server.send({'event': 'add'}, JSON_CONTENT_TYPE)
+    second = client.queue_request(QUERY)
+    client.process_events(selectors.EVENT_WRITE)
+    run(selector, services, lambda: not client.pending)
+
+    assert client.pop_response(None) == {'event': 'add'}
+    assert client.pop_response(second) == [{'ip': '10.0.0.1', 'port': 1000}]
+    assert selector.get_key(server._socket).events == selectors.EVENT_READ
+
+
+def test_pipelined_requests_are_answered_in_order(connection):
+    selector, server, client = connection
+    services = Services()
+    ids = [
+        client.queue_request(request(action='register', type='bot', ip='10.0.0.1', port=1000)),
+        client.queue_request(QUERY),
+        client.queue_request(request(action='query', type='cat')),
+        client.queue_request(request(action='nap')),
+    ]
+    assert client.pending == 4
+    run(selector, services, lambda: not client.pending)
+    uuid, bots, cats, unknown = [client.pop_response(request_id) for request_id in ids]
+    assert services.deregister(uuid) == 'OK'
+    assert bots == [{'ip': '10.0.0.1', 'port': 1000}]
+    assert cats == []
+    assert unknown == 'UNKNOWN ACTION nap'
+
+
+def test_watch_pushes_the_changes(connection):
+    selector, server, client = connection
+    services = Services()
+    watchers = Watchers()
+    watch = client.queue_request(request(action='WATCH', type='bot'))
+    run(selector, services, lambda: not client.pending, watchers=watchers)
+    snapshot = client.pop_response(watch)
+    assert snapshot['services'] == []
+
+    service_uuid = services.register('bot', '10.0.0.1', 1000)
+    services.register('cat', '10.0.0.2', 2000)
+    run(selector, services, lambda: watch in client._responses, watchers=watchers)
+    push = client.pop_response(watch)
+    assert push['epoch'] == snapshot['epoch']
+    assert [(event['event'], event['uuid']) for event in push['events']] == [('add', service_uuid)]
+
+    services.deregister(service_uuid)
+    run(selector, services, lambda: watch in client._responses, watchers=watchers)
+    push = client.pop_response(watch)
+    assert [(event['event'], event['uuid']) for event in push['events']] == [('remove', service_uuid)]
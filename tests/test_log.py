@@ -0,0 +1,41 @@
+import io
+import logging
+import threading
+
+import log
+
+
+class Payload:
+    """
+    remembers the thread that formatted it
+    """
+    def __init__(self):
+        self.thread = None
+
+    def __str__(self):
+        self.thread = threading.current_thread()
+        return 'payload'
+
+
+def test_records_are_formatted_by_the_writer_thread():
+    stream = io.StringIO()
+    log.configure(level='DEBUG', sample_rate=1.0, stream=stream)
+    try:
+        payload = Payload()
+        try:
+            raise KeyError('kitten')
+        except KeyError:
+            log.get_logger('test').exception('failed with %s', payload)
+    finally:
+        log.shutdown()
+    assert payload.thread is not None
+    assert payload.thread is not threading.current_thread()
+    output = stream.getvalue()
+    assert output.startswith('failed with payload\n')
+    assert "KeyError: 'kitten'" in output
+
+
+def teardown_module():
+    root = logging.getLogger(log.ROOT_LOGGER)
+    root.handlers = []
+    root.propagate = True
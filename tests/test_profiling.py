@@ -0,0 +1,24 @@
+import signal
+import threading
+
+import pytest
+
+from profiling import Profiler
+
+
+@pytest.mark.skipif(not hasattr(signal, 'SIGUSR1'), reason='no SIGUSR1 on this platform')
+def test_signals_are_only_installed_in_the_main_thread(tmp_path):
+    profiler = Profiler(directory=str(tmp_path))
+    errors = []
+
+    def install():
+        try:
+            profiler.install_signals()
+        except Exception as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=install)
+    thread.start()
+    thread.join()
+    assert errors == []
+    assert signal.getsignal(signal.SIGUSR1) is signal.SIG_DFL
@@ -0,0 +1,89 @@
+import os
+
+import pytest
+
+from registry_store import LOG_RECORD, RegistryStore
+from services import Services
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / 'registry')
+
+
+def restore(path, **kwargs):
+    return Services(store=RegistryStore(path, **kwargs))
+
+
+def endpoints(services, type):
+    return sorted((service['ip'], service['port']) for service in services.query(type))
+
+
+def test_registry_is_restored_from_the_log(path):
+    services = restore(path)
+    kept = services.register('bot', '10.0.0.1', 1000)
+    removed = services.register('bot', '10.0.0.2', 2000)
+    services.register('cat', '10.0.0.3', 3000)
+    services.heartbeat(kept)
+    services.deregister(removed)
+    services.close()
+
+    restored = restore(path)
+    assert len(restored) == 2
+    assert endpoints(restored, 'bot') == [('10.0.0.1', 1000)]
+    assert endpoints(restored, 'cat') == [('10.0.0.3', 3000)]
+    assert restored.heartbeat(kept) == 'OK'
+    assert restored.heartbeat(removed) == 'NOT FOUND'
+    restored.close()
+
+
+def test_registry_is_restored_from_the_snapshot_and_the_log(path):
+    services = restore(path, compact_after=1)
+    uuids = [services.register('bot', f'10.0.0.{n}', 1000 + n) for n in range(5)]
+    services.deregister(uuids[0])
+    for service_uuid in uuids[1:]:
+        services.heartbeat(service_uuid)
+    # the log has twice as many records as there are services, it is compacted
+    services.flush()
+    assert os.path.exists(path + '.snap')
+    services.register('bot', '10.0.0.9', 1009)
+    services.deregister(uuids[1])
+    services.close()
+
+    restored = restore(path)
+    assert endpoints(restored, 'bot') == [
+        ('10.0.0.2', 1002), ('10.0.0.3', 1003), ('10.0.0.4', 1004), ('10.0.0.9', 1009)
+    ]
+    restored.close()
+
+
+def test_partial_record_is_cut_off(path):
+    services = restore(path)
+    services.register('bot', '10.0.0.1', 1000)
+    services.close()
+    # a crash in the middle of writing a record
+    with open(path + '.log', 'ab') as file:
+        file.write(b'\x01' * (LOG_RECORD.size - 1))
+
+    restored = restore(path)
+    assert endpoints(restored, 'bot') == [('10.0.0.1', 1000)]
+    restored.register('bot', '10.0.0.2', 2000)
+    restored.close()
+
+    restored = restore(path)
+    assert endpoints(restored, 'bot') == [('10.0.0.1', 1000), ('10.0.0.2', 2000)]
+    restored.close()
+
+
+def test_downtime_does_not_expire_services(path):
+    clock = [0.0]
+    services = Services(timeout=5, clock=lambda: clock[0], store=RegistryStore(path))
+    services.register('bot', '10.0.0.1', 1000)
+    services.close()
+
+    clock[0] = 100.0
+    restored = Services(timeout=5, clock=lambda: clock[0], store=RegistryStore(path))
+    assert len(restored) == 1
+    clock[0] = 106.0
+    assert len(restored.expire()) == 1
+    restored.close()
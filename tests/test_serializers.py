@@ -0,0 +1,49 @@
+import pytest
+
+from serializers import BINARY, COMPACT, CompactSerializer
+
+
+def nested(depth):
+    obj = 'kitten'
+    for _ in range(depth):
+        obj = [obj]
+    return obj
+
+
+@pytest.mark.parametrize('obj', [
+    None, True, False, 0, -1, 2 ** 70, -2 ** 70, 1.5, '', 'MEOW', 'ümlaut', [], {},
+    {'action': 'PLAY', 'cards': ['SKIP', 'NORMAL'], 'data': {'count': 3, 'ok': None}},
+    nested(CompactSerializer.MAX_DEPTH),
+])
+def test_compact_round_trip(obj):
+    assert COMPACT.decode(COMPACT.encode(obj)) == obj
+
+
+def test_compact_rejects_deep_nesting():
+    with pytest.raises(ValueError):
+        COMPACT.encode(nested(CompactSerializer.MAX_DEPTH + 1))
+    # a list tag repeated without its items
+    data = bytes([CompactSerializer._LIST, 1]) * 100000
+    with pytest.raises(ValueError):
+        COMPACT.decode(data)
+
+
+def test_compact_rejects_circular_content():
+    obj = []
+    obj.append(obj)
+    with pytest.raises(ValueError):
+        COMPACT.encode(obj)
+
+
+@pytest.mark.parametrize('data', [b'', bytes([CompactSerializer._STR, 5, 0x61]), b'\x03\x80'])
+def test_compact_rejects_truncated_content(data):
+    with pytest.raises(ValueError):
+        COMPACT.decode(data)
+
+
+def test_binary_only_encodes_bytes_like_content():
+    assert BINARY.encode(bytearray(b'abc')) == b'abc'
+    assert BINARY.encode(memoryview(b'abc')) == b'abc'
+    for obj in (3, 'abc', None):
+        with pytest.raises(TypeError):
+            BINARY.encode(obj)
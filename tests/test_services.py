@@ -0,0 +1,57 @@
+import pytest
+
+from services import Services
+
+
+@pytest.fixture
+def clock():
+    now = [0.0]
+    return now
+
+
+def test_expired_services_disappear_from_query(clock):
+    # including the neighbours of expired ones in the expiry order
+    services = Services(timeout=5, clock=lambda: clock[0])
+    uuids = [services.register('bot', '127.0.0.1', port) for port in range(10)]
+    clock[0] = 4.0
+    for service_uuid in uuids[::2]:
+        services.heartbeat(service_uuid)
+    clock[0] = 6.0
+    assert [service['port'] for service in services.expire()] == [1, 3, 5, 7, 9]
+    assert [service['port'] for service in services.query('bot')] == [0, 2, 4, 6, 8]
+
+
+def test_expire_in_slices(clock):
+    services = Services(timeout=5, clock=lambda: clock[0])
+    for port in range(10):
+        services.register('bot', '127.0.0.1', port)
+    clock[0] = 6.0
+    assert len(services.expire(4)) == 4
+    assert len(services) == 6
+    assert len(services.expire()) == 6
+
+
+def test_invalid_service_registers_nothing():
+    services = Services()
+    with pytest.raises(ValueError):
+        services.register_many([
+            {'type': 'bot', 'ip': '127.0.0.1', 'port': 1},
+            {'type': 'bot', 'ip': '127.0.0.1', 'port': 70000},
+        ])
+    assert len(services) == 0
+    assert services.version() == 0
+
+
+def test_changes_since_a_version():
+    services = Services()
+    first = services.register('bot', '127.0.0.1', 1)
+    snapshot = services.changes('bot')
+    assert [service['uuid'] for service in snapshot['services']] == [first]
+    second = services.register('bot', '127.0.0.1', 2)
+    services.deregister(first)
+    changes = services.changes('bot', snapshot['version'], snapshot['epoch'])
+    assert [(event['event'], event['uuid']) for event in changes['events']] == [
+        ('add', second), ('remove', first),
+    ]
+    # versions of another registry get a snapshot
+    assert 'services' in services.changes('bot', snapshot['version'], 'other epoch')
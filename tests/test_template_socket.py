@@ -0,0 +1,31 @@
+import socket
+import threading
+
+import pytest
+
+template_socket = pytest.importorskip('template_socket')
+
+
+def test_unknown_action():
+    assert template_socket.handle_request({'action': 'dance'}) == 'UNKNOWN ACTION dance'
+
+
+def test_send_requests_to_a_closing_server(monkeypatch):
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(('127.0.0.1', 0))
+    server.listen()
+    monkeypatch.setattr(template_socket, 'PORT', server.getsockname()[1])
+
+    def close_connection():
+        conn, _ = server.accept()
+        conn.recv(65536)
+        conn.close()
+
+    thread = threading.Thread(target=close_connection)
+    thread.start()
+    try:
+        with pytest.raises(ValueError):
+            template_socket.send_requests([{'action': 'query', 'type': 'bot'}])
+    finally:
+        thread.join()
+        server.close()
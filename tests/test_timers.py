@@ -0,0 +1,80 @@
+import pytest
+
+import discovery_service
+from services import Services
+from timers import TimerWheel
+
+
+@pytest.fixture
+def clock():
+    now = [0.0]
+    return now
+
+
+@pytest.fixture
+def wheel(clock):
+    return TimerWheel(tick=0.125, slots=8, clock=lambda: clock[0])
+
+
+def test_timers_run_when_due(clock, wheel):
+    calls = []
+    wheel.schedule(0.25, calls.append, 'b')
+    wheel.schedule(0.1, calls.append, 'a')
+    clock[0] = 0.125
+    assert wheel.run_due() == 1
+    assert calls == ['a']
+    clock[0] = 0.25
+    assert wheel.run_due() == 1
+    assert calls == ['a', 'b']
+    assert len(wheel) == 0
+    assert wheel.next_timeout() is None
+
+
+def test_timers_beyond_one_turn_wait_for_their_rounds(clock, wheel):
+    # one turn of the wheel is one second
+    calls = []
+    wheel.schedule(2.0, calls.append, 'late')
+    clock[0] = 1.875
+    wheel.run_due()
+    assert calls == []
+    clock[0] = 2.0
+    wheel.run_due()
+    assert calls == ['late']
+
+
+def test_cancelled_timers_do_not_run(clock, wheel):
+    calls = []
+    timer = wheel.schedule(0.125, calls.append, 'cancelled')
+    wheel.schedule(0.125, calls.append, 'kept')
+    wheel.cancel(timer)
+    assert not timer.active
+    assert len(wheel) == 1
+    clock[0] = 0.125
+    assert wheel.run_due() == 1
+    assert calls == ['kept']
+
+
+def test_next_timeout(clock, wheel):
+    wheel.schedule(0.3, lambda: None)
+    clock[0] = 0.125
+    assert wheel.next_timeout() == pytest.approx(0.25)
+
+
+def test_maintain_expires_in_slices(clock, wheel, monkeypatch):
+    monkeypatch.setattr(discovery_service, 'EXPIRE_SLICE', 4)
+    services = Services(timeout=5, clock=lambda: clock[0])
+    for port in range(10):
+        services.register('bot', '127.0.0.1', port)
+    clock[0] = 6.0
+    wheel.run_due()
+    # queries don't expire, the maintenance does
+    assert len(services.query('bot')) == 10
+    discovery_service.maintain(wheel, services)
+    assert len(services) == 6
+    # a full slice schedules the next one for the next tick
+    assert wheel.next_timeout() == pytest.approx(0.125)
+    for _ in range(2):
+        clock[0] += 0.125
+        wheel.run_due()
+    assert len(services) == 0
+    assert services.query('bot') == []
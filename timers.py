@@ -0,0 +1,123 @@
+"""
+Hashed timer wheel for the select loops.
+Timers are kept in a ring of slots, one slot per tick, so scheduling and
+cancelling are O(1) and each tick only looks at the timers of one slot.
+Timers further away than one turn of the wheel wait for their number of rounds.
+The loop passes next_timeout() to select() and calls run_due() after it.
+"""
+import math
+import time
+
+TICK = 0.05
+SLOTS = 512
+
+
+class Timer:
+    """
+    a scheduled callback, returned by TimerWheel.schedule
+    """
+    __slots__ = ('callback', 'args', 'rounds')
+
+    def __init__(self, callback, args, rounds):
+        self.callback = callback
+        self.args = args
+        self.rounds = rounds
+
+    @property
+    def active(self):
+        return self.callback is not None
+
+
+class TimerWheel:
+    """
+    runs callbacks after a delay, with a resolution of one tick
+    """
+    def __init__(self, tick=TICK, slots=SLOTS, clock=time.monotonic):
+        """
+        constructor for the TimerWheel class
+        :param tick: seconds per slot, the resolution of the timers
+        :param slots: number of slots, one turn of the wheel is tick * slots seconds
+        :param clock: monotonic clock returning seconds
+        """
+        self._tick = tick
+        self._slots = [[] for _ in range(slots)]
+        self._clock = clock
+        self._current = 0
+        self._time = clock()
+        self._count = 0
+
+    def schedule(self, delay, callback, *args):
+        """
+        runs callback(*args) after delay seconds, rounded up to the next tick
+        :param delay: seconds
+        :param callback: the function to call
+        :return: Timer to cancel it with
+        """
+        ticks = max(1, math.ceil((self._clock() + delay - self._time) / self._tick))
+        size = len(self._slots)
+        timer = Timer(callback, args, (ticks - 1) // size)
+        self._slots[(self._current + ticks) % size].append(timer)
+        self._count += 1
+        return timer
+
+    def cancel(self, timer):
+        """
+        cancels a timer, it is removed from its slot when the wheel gets there
+        :param timer: Timer returned by schedule
+        :return: None
+        """
+        if timer.callback is not None:
+            timer.callback = None
+            timer.args = None
+            self._count -= 1
+
+    def next_timeout(self):
+        """
+        seconds until the next slot that holds timers, to be passed to select()
+        :return: float, or None if no timers are scheduled
+        """
+        if not self._count:
+            return None
+        size = len(self._slots)
+        for ticks in range(1, size + 1):
+            if self._slots[(self._current + ticks) % size]:
+                break
+        return max(0.0, self._time + ticks * self._tick - self._clock())
+
+    def run_due(self):
+        """
+        advances the wheel to the current time and runs the timers that are due
+        :return: number of timers run
+        """
+        now = self._clock()
+        size = len(self._slots)
+        count = 0
+        while self._time + self._tick <= now:
+            self._time += self._tick
+            self._current = (self._current + 1) % size
+            slot = self._slots[self._current]
+            if not slot:
+                continue
+            due = []
+            waiting = []
+            for timer in slot:
+                if timer.callback is None:
+                    continue
+                if timer.rounds:
+                    timer.rounds -= 1
+                    waiting.append(timer)
+                else:
+                    due.append(timer)
+            self._slots[self._current] = waiting
+            for timer in due:
+                # a timer may have been cancelled by an earlier callback of the same tick
+                if timer.callback is None:
+                    continue
+                callback, args = timer.callback, timer.args
+                self.cancel(timer)
+                callback(*args)
+                count += 1
+        return count
+
+    def __len__(self):
+        return self._count
@@ -0,0 +1,187 @@
+"""
+Headless tournament: plays many games across a process pool and reports
+the win rate of every bot with a 95% confidence interval.
+Every game gets its own seed, it fixes the seating order and the arena's shuffles.
+Bots that decide within a time budget, like LucaBot's rollouts, don't play the
+same way twice, so a game can only be replayed exactly from a game log (--record).
+With --processes every pool process keeps warm worker processes for the bots.
+"""
+import argparse
+import math
+import os
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import log
+from bot_workers import BotWorkerPool
+from game_log import GameLogWriter, GameRecorder
+from main import bot_classes, load_bots, play_game
+
+logger = log.get_logger(__name__)
+
+BOT_DIRECTORY = 'bots'
+# z-score of the 95% confidence interval
+Z_95 = 1.96
+
+# bot worker processes of this pool process, None runs the bots in-process
+_bot_workers = None
+
+
+def play_seeded_game(seed):
+    """
+    plays one game, the seating order and the arena's shuffles depend only on the seed
+    :param seed: int
+    :return: List of the bot names, the winner first
+    """
+    random.seed(seed)
+    return play_game(_seat_bots(seed))
+
+
+def play_recorded_game(seed):
+    """
+    plays one game like play_seeded_game and records it
+    :param seed: int
+    :return: tuple (List of the bot names the winner first, bytes of the game's log records)
+    """
+    random.seed(seed)
+    bot_list = _seat_bots(seed)
+    recorder = GameRecorder(seed, [bot.name for bot in bot_list])
+    return play_game(bot_list, recorder=recorder), bytes(recorder.data)
+
+
+def _start_bot_workers():
+    """
+    initializer of the pool processes, forks the bot workers of the process
+    """
+    global _bot_workers
+    _bot_workers = BotWorkerPool(bot_classes(BOT_DIRECTORY))
+
+
+def _seat_bots(seed):
+    """
+    :return: the bots of a game in the seating order of the seed
+    """
+    if _bot_workers is not None:
+        return _bot_workers.bots(random.Random(seed))
+    return load_bots(BOT_DIRECTORY, random.Random(seed))
+
+
+def run_tournament(games, workers=None, seed=0, record=None, processes=False):
+    """
+    plays the games across a process pool
+    :param games: number of games
+    :param workers: number of processes, defaults to the number of CPUs
+    :param seed: seed of the first game, the others follow in order
+    :param record: path of a game log to append the games to, written by this process only
+    :param processes: run the bots in worker processes instead of the pool processes
+    :return: tuple (dict name -> Standing, seconds it took)
+    """
+    workers = workers or os.cpu_count() or 1
+    chunksize = max(1, games // (workers * 8))
+    standings = {}
+    writer = GameLogWriter(record) if record else None
+    start = time.perf_counter()
+    try:
+        with ProcessPoolExecutor(
+                max_workers=workers, initializer=_start_bot_workers if processes else None
+        ) as executor:
+            for result in executor.map(
+                    play_recorded_game if writer else play_seeded_game,
+                    range(seed, seed + games), chunksize=chunksize):
+                if writer:
+                    ranking, records = result
+                    writer.write(records)
+                else:
+                    ranking = result
+                for rank, name in enumerate(ranking, 1):
+                    standings.setdefault(name, Standing()).add(rank)
+    finally:
+        if writer:
+            writer.close()
+    return standings, time.perf_counter() - start
+
+
+class Standing:
+    """
+    results of one bot over all games
+    """
+    def __init__(self):
+        self.games = 0
+        self.wins = 0
+        self.rank_total = 0
+
+    def add(self, rank):
+        """
+        adds the rank of one game, 1 is a win
+        """
+        self.games += 1
+        self.rank_total += rank
+        if rank == 1:
+            self.wins += 1
+
+    @property
+    def win_rate(self):
+        return self.wins / self.games if self.games else 0.0
+
+    @property
+    def mean_rank(self):
+        return self.rank_total / self.games if self.games else 0.0
+
+    def confidence_interval(self, z=Z_95):
+        """
+        Wilson score interval of the win rate
+        :param z: z-score of the confidence level
+        :return: tuple (low, high)
+        """
+        return wilson_interval(self.wins, self.games, z)
+
+
+def wilson_interval(successes, trials, z=Z_95):
+    """
+    Wilson score interval for a binomial proportion
+    :param successes: number of successes
+    :param trials: number of trials
+    :param z: z-score of the confidence level
+    :return: tuple (low, high)
+    """
+    if not trials:
+        return 0.0, 1.0
+    p = successes / trials
+    denominator = 1 + z * z / trials
+    center = (p + z * z / (2 * trials)) / denominator
+    margin = z * math.sqrt(p * (1 - p) / trials + z * z / (4 * trials * trials)) / denominator
+    return max(0.0, center - margin), min(1.0, center + margin)
+
+
+def report(standings, games, seconds):
+    """
+    logs the standings, best win rate first
+    :return: None
+    """
+    logger.info('%d games in %.2fs, %.1f games/s', games, seconds, games / seconds)
+    for name, standing in sorted(
+            standings.items(), key=lambda item: item[1].win_rate, reverse=True):
+        low, high = standing.confidence_interval()
+        logger.info(
+            '%-20s win rate %5.1f%% (95%% CI %5.1f%% - %5.1f%%), mean rank %.2f',
+            name, standing.win_rate * 100, low * 100, high * 100, standing.mean_rank
+        )
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='headless tournament between the bots')
+    parser.add_argument('--games', type=int, default=1000, help='number of games')
+    parser.add_argument('--workers', type=int, default=None, help='number of processes')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the first game')
+    parser.add_argument('--record', metavar='PATH', default=None,
+                        help='append the games to this game log')
+    parser.add_argument('--processes', action='store_true',
+                        help='run every bot in its own worker process')
+    args = parser.parse_args()
+    results, elapsed = run_tournament(
+        args.games, args.workers, args.seed, args.record, args.processes
+    )
+    # configured only now: the forked workers stay silent and don't queue log records
+    log.configure()
+    report(results, args.games, elapsed)
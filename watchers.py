@@ -0,0 +1,113 @@
+"""
+Push notifications for the WATCH action of the discovery service.
+A watcher is a keep-alive connection that asked for the changes of a service type.
+After the registry changed, the changes are fetched once per type and version
+and pushed to every watcher at that version, tagged with the request id of its WATCH.
+A connection is skipped while it has a request in progress, so pushes never
+overtake the response to a WATCH.
+"""
+from log import get_logger
+from server_message import response_content_type
+
+logger = get_logger(__name__)
+
+
+class Watchers:
+    """
+    the connections watching a service type, with the version each has seen.
+    Works with ServerMessage and AsyncServerMessage connections.
+    """
+    def __init__(self):
+        """
+        constructor for the Watchers class
+        """
+        self._watches = {}
+        self._version = None
+        self._behind = False
+
+    def watch(self, connection, request, services):
+        """
+        answers a WATCH request with the changes since the version in the request,
+        or with a snapshot, and keeps kept-alive connections as watchers
+        :param connection: the connection the request came in on
+        :param request: the decoded request with 'type' and optionally 'since' and 'epoch'
+        :param services: the services object
+        :return: the response
+        """
+        header = connection.request_header
+        type = request['type']
+        response = services.changes(type, request.get('since'), request.get('epoch'))
+        if header.get('keep-alive', False):
+            content_type, content_encoding = response_content_type(
+                header['content-type'], response
+            )
+            self._watches.setdefault(type, {})[connection] = _Watch(
+                header.get('request-id'),
+                response['epoch'],
+                response['version'],
+                content_type,
+                content_encoding
+            )
+        return response
+
+    def notify(self, services):
+        """
+        pushes the changes to all watchers that are behind the registry
+        :param services: the services object
+        :return: None
+        """
+        # called after every request, with workers services.version() is a call to the coordinator
+        if not self._watches:
+            return
+        version = services.version()
+        if version == self._version and not self._behind:
+            return
+        self._version = version
+        self._behind = False
+        for type, watches in list(self._watches.items()):
+            updates = {}
+            for connection, watch in list(watches.items()):
+                if connection.closed:
+                    del watches[connection]
+                    continue
+                if watch.version == version:
+                    continue
+                if connection.request_header is not None:
+                    self._behind = True
+                    continue
+                key = (watch.epoch, watch.version)
+                update = updates.get(key)
+                if update is None:
+                    update = services.changes(type, watch.version, watch.epoch)
+                    updates[key] = update
+                watch.epoch = update['epoch']
+                watch.version = update['version']
+                if 'events' in update and not update['events']:
+                    continue
+                try:
+                    connection.send(
+                        update, watch.content_type, watch.content_encoding, watch.request_id
+                    )
+                except RuntimeError as e:
+                    logger.warning('Dropping watcher %s: %s', connection.ipaddr, e)
+                    del watches[connection]
+                    connection.close()
+            if not watches:
+                del self._watches[type]
+
+    def __len__(self):
+        return sum(len(watches) for watches in self._watches.values())
+
+
+class _Watch:
+    """
+    what a watcher has seen and how its pushes are encoded
+    """
+    __slots__ = ('request_id', 'epoch', 'version', 'content_type', 'content_encoding')
+
+    def __init__(self, request_id, epoch, version, content_type, content_encoding):
+        self.request_id = request_id
+        self.epoch = epoch
+        self.version = version
+        self.content_type = content_type
+        self.content_encoding = content_encoding